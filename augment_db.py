@@ -0,0 +1,110 @@
+import sys
+import fire
+import time
+import typing
+import sqlite3
+
+from setup_db import bind_db, sqlite_connect
+
+# Copies of every table, one per row of temp."factor" (see _perturb). With factor 1 the audio is unchanged,
+# so features, frame counts and cmvn stay valid. Otherwise wav is piped through sox, durations and segment
+# times are scaled by 1 / factor, and features and cmvn are left empty to be recomputed.
+# Transcripts are shared with the original utterance.
+perturb_speaker_query = '''
+    INSERT INTO "Speaker" ("spk_id", "gender", "cmvn")
+    SELECT f."prefix" || s."spk_id", s."gender", CASE WHEN f."value" = 1 THEN s."cmvn" ELSE '' END
+    FROM "Speaker" s CROSS JOIN temp."factor" f
+    WHERE ?1 IS NULL OR s."spk_id" IN (
+        SELECT u."speaker" FROM "Utterance" u JOIN "Recording" r ON r."reco_id" = u."recording"
+        WHERE r."corpus" = ?1)'''
+perturb_recording_query = '''
+    INSERT INTO "Recording" ("reco_id", "wav", "corpus", "duration")
+    SELECT f."prefix" || r."reco_id",
+           CASE WHEN f."value" = 1 THEN r."wav"
+                WHEN r."wav" LIKE '%|' THEN r."wav" || ' sox -t wav - -t wav - speed ' || f."label" || ' |'
+                ELSE 'sox -t wav ' || r."wav" || ' -t wav - speed ' || f."label" || ' |' END,
+           r."corpus", r."duration" / f."value"
+    FROM "Recording" r CROSS JOIN temp."factor" f
+    WHERE ?1 IS NULL OR r."corpus" = ?1'''
+perturb_utterance_query = '''
+    INSERT INTO "Utterance" ("utt_id", "recording", "feat", "transcript", "speaker", "duration",
+                             "num_frames", "feat_dim", "start_time", "end_time", "is_segment")
+    SELECT f."prefix" || u."utt_id", f."prefix" || u."recording",
+           CASE WHEN f."value" = 1 THEN u."feat" ELSE '' END,
+           u."transcript", f."prefix" || u."speaker", u."duration" / f."value",
+           CASE WHEN f."value" = 1 THEN u."num_frames" END,
+           CASE WHEN f."value" = 1 THEN u."feat_dim" END,
+           ROUND(u."start_time" / f."value", 3), ROUND(u."end_time" / f."value", 3), u."is_segment"
+    FROM "Utterance" u CROSS JOIN temp."factor" f
+    WHERE ?1 IS NULL OR u."recording" IN (SELECT r."reco_id" FROM "Recording" r WHERE r."corpus" = ?1)'''
+
+
+def _perturb(conn,
+             factors: typing.List[float],
+             prefix: str,
+             corpus: typing.Optional[str]) -> typing.Dict[str, int]:
+    """
+    Adds the speed perturbed copies of every speaker, recording and utterance, in one statement per table
+    :param conn: sqlite3 connection, in a transaction
+    :param factors: Speed factors
+    :param prefix: Ids of the copies are '<prefix><factor>-<id>', as in Kaldi's perturb_data_dir_speed.sh
+    :param corpus: Only copy the recordings of this corpus, their utterances and speakers
+    :return: table -> number of rows added
+    """
+    conn.execute('CREATE TEMP TABLE "factor" ("prefix" TEXT, "label" TEXT, "value" REAL)')
+    conn.executemany('INSERT INTO temp."factor" VALUES (?, ?, ?)',
+                     [(f"{prefix}{float(factor)}-", str(float(factor)), factor) for factor in factors])
+    added = {}
+    for table, sql in [('Speaker', perturb_speaker_query),
+                       ('Recording', perturb_recording_query),
+                       ('Utterance', perturb_utterance_query)]:
+        added[table] = conn.execute(sql, (corpus,)).rowcount
+    conn.execute('DROP TABLE temp."factor"')
+    return added
+
+
+def augment_db(db_file: str,
+               factors: typing.Union[float, typing.Sequence[float]] = (0.9, 1.1),
+               prefix: str = 'sp',
+               corpus: str = None,
+               copy_originals: bool = False) -> typing.Dict[str, int]:
+    """
+    Adds speed perturbed copies of a sqlite db to itself, with set-based SQL
+    :param db_file: Full path to a sqlite db_file
+    :param factors: Speed factors, e.g. --factors 0.9,1.1. The originals already are the 1.0 copy of
+                    Kaldi's 3-way perturbation
+    :param prefix: Ids of the copies are '<prefix><factor>-<id>', e.g. sp0.9-utt1
+    :param corpus: Only augment this corpus
+    :param copy_originals: Allow factor 1.0, which adds a plain '<prefix>1.0-' duplicate of every row that keeps features
+    :return: table -> number of rows added
+    """
+    factors = [factors] if isinstance(factors, (int, float)) else list(factors)
+    if not factors or any(factor <= 0 for factor in factors):
+        raise ValueError(f"factors must be positive, got {factors}")
+    if len({float(factor) for factor in factors}) != len(factors):
+        raise ValueError(f"factors must be distinct, got {factors}")
+    if 1.0 in factors and not copy_originals:
+        raise ValueError("factor 1.0 duplicates every utterance of the db, pass --copy_originals if that is intended")
+
+    start = time.time()
+    db = bind_db(db_file)
+
+    conn = sqlite_connect(db)
+    try:
+        conn.execute('BEGIN')
+        try:
+            added = _perturb(conn, factors, prefix, corpus)
+        except sqlite3.IntegrityError as e:
+            conn.execute('ROLLBACK')
+            print(f"Perturbed ids already exist in {db_file} ({e}). Was it augmented with these factors before?")
+            sys.exit(1)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    print(f"Added {added['Utterance']} utterances, {added['Recording']} recordings and {added['Speaker']} speakers "
+          f"for factors {', '.join(str(float(factor)) for factor in factors)} in {time.time() - start:.2f}s")
+    return added
+
+
+if __name__ == '__main__':
+    fire.Fire(augment_db)
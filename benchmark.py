@@ -0,0 +1,234 @@
+import os
+import io
+import sys
+import json
+import time
+import fire
+import shutil
+import typing
+import platform
+import contextlib
+import subprocess
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+from utils import peak_rss_mb
+from data2db import main as data2db
+from db2data import db2data
+from split_db import split_db, split_keys
+
+# The generator draws its random numbers this many utterances at a time, so a corpus only
+# depends on its parameters and never has to fit in memory
+generate_chunk = 100000
+
+# Transcripts are 2 to max_words + 2 words out of vocabulary_size
+vocabulary_size = 5000
+max_words = 20
+
+
+def _sentence_texts(sentence_ids: np.ndarray) -> typing.List[str]:
+    """
+    Derives the text of every sentence from its id alone: the id in base vocabulary_size, so different ids
+    never share a text, followed by words picked with a multiplicative hash
+    """
+    ids = sentence_ids.astype(np.uint64)
+    lengths = (ids * np.uint64(2654435761) % np.uint64(max_words + 1)).astype(np.int64)
+    positions = np.arange(max_words, dtype=np.uint64)
+    words = (ids[:, None] * np.uint64(40503) + positions[None, :] * np.uint64(9973)) % np.uint64(vocabulary_size)
+    return [' '.join([f"w{i // vocabulary_size}", f"w{i % vocabulary_size}"] + [f"w{w}" for w in row[:n]])
+            for i, row, n in zip(sentence_ids.tolist(), words.tolist(), lengths.tolist())]
+
+
+def make_corpus(data_dir: str,
+                num_utts: int,
+                num_speakers: int = None,
+                duplicate_ratio: float = 0.3,
+                segments_per_recording: int = 4,
+                seed: int = 0) -> typing.Dict[str, int]:
+    """
+    Writes a deterministic synthetic Kaldi data directory: text, wav.scp, utt2spk, segments,
+    feats.scp, cmvn.scp and spk2gender, sorted like Kaldi expects
+    :param data_dir: Directory to create
+    :param num_utts: Number of utterances
+    :param num_speakers: Number of speakers, default: one per 200 utterances
+    :param duplicate_ratio: Share of utterances that reuse the transcript of an earlier one
+    :param segments_per_recording: Consecutive utterances of a speaker cut from one recording;
+                                   0 writes no segments file, every utterance is a whole recording
+    :param seed: Random seed
+    :return: Number of utterances, recordings, sentences and speakers written
+    """
+    if not 0 <= duplicate_ratio < 1:
+        raise ValueError(f"duplicate_ratio must be in [0, 1), got {duplicate_ratio}")
+    if os.path.exists(data_dir):
+        print(f"{data_dir} already exists. Remove or rename it before proceed.")
+        sys.exit(1)
+    num_speakers = num_speakers if num_speakers else max(1, num_utts // 200)
+    rng = np.random.default_rng(seed)
+    speaker_utts = rng.multinomial(num_utts, np.full(num_speakers, 1 / num_speakers))
+    speaker_start = np.concatenate([[0], np.cumsum(speaker_utts)])
+    os.makedirs(data_dir)
+
+    files = ['text', 'wav.scp', 'utt2spk', 'feats.scp'] + (['segments'] if segments_per_recording else [])
+    counts = {'utterances': num_utts, 'recordings': 0, 'sentences': 0, 'speakers': num_speakers}
+    with contextlib.ExitStack() as stack:
+        fp = {f: stack.enter_context(open(os.path.join(data_dir, f), 'w', buffering=1 << 20)) for f in files}
+        for start in range(0, num_utts, generate_chunk):
+            index = np.arange(start, min(start + generate_chunk, num_utts))
+            speaker = np.searchsorted(speaker_start, index, side='right') - 1
+            position = index - speaker_start[speaker]
+            # Fresh transcripts are numbered in order of first use, duplicates pick an earlier one
+            duplicate = rng.random(len(index)) < duplicate_ratio
+            duplicate[0] &= counts['sentences'] > 0
+            fresh = counts['sentences'] + np.cumsum(~duplicate) - 1
+            sentence = np.where(duplicate, (rng.random(len(index)) * np.maximum(fresh, 1)).astype(np.int64), fresh)
+            counts['sentences'] += int(np.count_nonzero(~duplicate))
+            starts = rng.uniform(0, 4, len(index)) + (position % max(segments_per_recording, 1)) * 20
+            ends = starts + rng.uniform(1, 15, len(index))
+
+            for s, p, text, t0, t1 in zip(speaker.tolist(), position.tolist(), _sentence_texts(sentence),
+                                          starts.tolist(), ends.tolist()):
+                utt_id = f"spk{s:06d}-{p:07d}"
+                fp['text'].write(f"{utt_id} {text}\n")
+                fp['utt2spk'].write(f"{utt_id} spk{s:06d}\n")
+                fp['feats.scp'].write(f"{utt_id} /bench/feats/raw_mfcc.{s % 32}.ark:{(p + 1) * 4013}\n")
+                if segments_per_recording:
+                    reco_id = f"spk{s:06d}-r{p // segments_per_recording:06d}"
+                    fp['segments'].write(f"{utt_id} {reco_id} {t0:.2f} {t1:.2f}\n")
+                    if p % segments_per_recording == 0:
+                        fp['wav.scp'].write(f"{reco_id} /bench/wav/{reco_id}.wav\n")
+                        counts['recordings'] += 1
+                else:
+                    fp['wav.scp'].write(f"{utt_id} /bench/wav/{utt_id}.wav\n")
+                    counts['recordings'] += 1
+
+    with open(os.path.join(data_dir, 'cmvn.scp'), 'w') as cmvn, open(os.path.join(data_dir, 'spk2gender'), 'w') as gender:
+        for s in range(num_speakers):
+            cmvn.write(f"spk{s:06d} /bench/feats/cmvn.ark:{s * 517 + 7}\n")
+            gender.write(f"spk{s:06d} {'mf'[s % 2]}\n")
+    return counts
+
+
+def _measure(func: typing.Callable[..., typing.Any], kwargs: typing.Dict[str, typing.Any]) -> typing.Dict[str, float]:
+    """
+    Runs one stage in a fresh process, with its output silenced. Peak RSS covers the stage
+    and the processes it started.
+    """
+    np.random.seed(0)
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(**kwargs)
+    return {'seconds': time.time() - start, 'peak_rss_mb': peak_rss_mb()}
+
+
+def _run_stage(func: typing.Callable[..., typing.Any], **kwargs) -> typing.Dict[str, float]:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_measure, func, kwargs).result()
+
+
+def _git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(work_dir: str,
+              sizes: typing.Union[int, typing.Sequence[int]] = (10000,),
+              ingest_engines: typing.Union[str, typing.Sequence[str]] = ('orm', 'bulk'),
+              export_engines: typing.Union[str, typing.Sequence[str]] = ('orm', 'stream'),
+              split_engines: typing.Union[str, typing.Sequence[str]] = ('orm', 'sql'),
+              split_modes: typing.Union[str, typing.Sequence[str]] = tuple(split_keys),
+              num_speakers: int = None,
+              duplicate_ratio: float = 0.3,
+              segments_per_recording: int = 4,
+              jobs: typing.Union[int, typing.Sequence[int]] = 1,
+              seed: int = 0,
+              results: str = 'benchmark_results.jsonl') -> None:
+    """
+    Times data2db, db2data and split_db on synthetic corpora (see make_corpus), each stage in its own
+    process, and appends one JSON line per stage to `results`. Every export and split reads the db of
+    the last ingest engine.
+    :param work_dir: Scratch directory for corpora, dbs and exports, created if needed
+    :param sizes: Numbers of utterances, e.g. --sizes 10000,100000,1000000
+    :param ingest_engines: data2db engines
+    :param export_engines: db2data engines
+    :param split_engines: split_db engines
+    :param split_modes: split_db split_by values
+    :param num_speakers: See make_corpus
+    :param duplicate_ratio: See make_corpus
+    :param segments_per_recording: See make_corpus
+    :param jobs: Passed to the stages that take it, e.g. --jobs 1,2,4,8 runs the bulk ingest and every
+                 split once per value, to measure how they scale with cores
+    :param seed: Seed of the corpora
+    :param results: JSON lines file to append to
+    :return: None
+    """
+    as_list = lambda value: [value] if isinstance(value, (str, int)) else list(value)
+    sizes, ingest_engines, export_engines, split_engines, split_modes, jobs = \
+        map(as_list, (sizes, ingest_engines, export_engines, split_engines, split_modes, jobs))
+    if not ingest_engines:
+        raise ValueError("At least one ingest engine is needed to export and split")
+    os.makedirs(work_dir, exist_ok=True)
+    work_dir = os.path.abspath(work_dir)
+    environment = {'commit': _git_commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+                   'cpus': os.cpu_count()}
+
+    def record(stage: str, measured: typing.Dict[str, float], **fields) -> None:
+        entry = dict(stage=stage, **fields, **corpus, **measured, **environment, timestamp=time.time())
+        with open(results, 'a') as fp:
+            fp.write(json.dumps(entry) + '\n')
+        details = ', '.join(f"{k}={v}" for k, v in fields.items())
+        print(f"{stage} ({details}) on {corpus['utterances']} utterances: "
+              f"{measured['seconds']:.2f}s, peak RSS {measured['peak_rss_mb']:.0f} MB")
+
+    for size in sizes:
+        data_dir = os.path.join(work_dir, f"corpus_{size}")
+        shutil.rmtree(data_dir, ignore_errors=True)
+        start = time.time()
+        corpus = make_corpus(data_dir, size, num_speakers=num_speakers, duplicate_ratio=duplicate_ratio,
+                             segments_per_recording=segments_per_recording, seed=seed)
+        print(f"Generated {data_dir} in {time.time() - start:.2f}s")
+        corpus = dict(utterances=corpus['utterances'], recordings=corpus['recordings'],
+                      sentences=corpus['sentences'], speakers=corpus['speakers'],
+                      duplicate_ratio=duplicate_ratio, segments_per_recording=segments_per_recording)
+
+        db_file = None
+        for engine in ingest_engines:
+            db_file = os.path.join(work_dir, f"bench_{size}_{engine}.db")
+            for num_jobs in jobs if engine == 'bulk' else [1]:
+                if os.path.exists(db_file):
+                    os.remove(db_file)
+                record('data2db', _run_stage(data2db, data_dir=data_dir, db_file=db_file, engine=engine,
+                                             jobs=num_jobs),
+                       engine=engine, jobs=num_jobs)
+
+        for engine in export_engines:
+            out_dir = os.path.join(work_dir, f"export_{size}_{engine}")
+            shutil.rmtree(out_dir, ignore_errors=True)
+            record('db2data', _run_stage(db2data, db_file=db_file, data_dir=out_dir, engine=engine),
+                   engine=engine)
+            shutil.rmtree(out_dir)
+
+        for split_by in split_modes:
+            for engine in split_engines:
+                for num_jobs in jobs:
+                    out_dir = os.path.join(work_dir, f"split_{size}_{split_by}_{engine}")
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                    record('split_db', _run_stage(split_db, db_file=db_file, split_by=split_by, data_dir=out_dir,
+                                                  engine=engine, jobs=num_jobs, save_db=False),
+                           engine=engine, split_by=split_by, jobs=num_jobs)
+                    shutil.rmtree(out_dir)
+
+        shutil.rmtree(data_dir)
+        for engine in ingest_engines:
+            os.remove(os.path.join(work_dir, f"bench_{size}_{engine}.db"))
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'corpus': make_corpus,
+        'run': benchmark
+    })
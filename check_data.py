@@ -0,0 +1,144 @@
+import fire
+import typing
+import numpy as np
+
+from kaldi_table import table_path, read_keys
+
+# What the first field of every table identifies
+table_keys = {
+    'text': 'utterance',
+    'utt2spk': 'utterance',
+    'segments': 'utterance',
+    'feats.scp': 'utterance',
+    'utt2dur': 'utterance',
+    'wav.scp': 'recording',
+    'reco2dur': 'recording',
+    'cmvn.scp': 'speaker',
+    'spk2gender': 'speaker'
+}
+
+# An utterance must be in every one of these tables that exists, like fix_data_dir.sh requires.
+# The other tables only add values, and may miss some ids.
+utterance_tables = ['text', 'utt2spk', 'segments', 'feats.scp']
+
+# Number of example ids printed per problem
+num_examples = 3
+
+
+def _examples(ids: np.ndarray) -> str:
+    shown = ', '.join(i.decode('utf-8', 'replace') for i in ids[:num_examples].tolist())
+    return f" (e.g. {shown})" if len(ids) else ''
+
+
+def _factorize(columns: typing.List[np.ndarray]) -> typing.Tuple[np.ndarray, typing.List[np.ndarray]]:
+    """
+    Replaces ids by their rank among all ids of the columns, so every later set operation is a
+    bincount or a lookup instead of another sort
+    :param columns: Id columns of one kind
+    :return: Sorted distinct ids, and the codes of every column
+    """
+    vocabulary, codes = np.unique(np.concatenate(columns), return_inverse=True)
+    return vocabulary, np.split(codes.ravel(), np.cumsum([len(c) for c in columns])[:-1])
+
+
+def consistent_ids(data_dir: str) -> typing.Tuple[typing.Dict[str, typing.Dict[str, typing.Any]],
+                                                  typing.Dict[str, np.ndarray]]:
+    """
+    Finds the utterances, recordings and speakers every table of a data directory agrees on, with
+    vectorized set operations over the id columns instead of sorting the files. An utterance is kept if
+    it is in every existing utterance_tables table exactly once, its recording is in wav.scp exactly
+    once, and it has one speaker. Recordings and speakers are kept if a kept utterance uses them.
+    :param data_dir: Full path to Kaldi data directory
+    :return: report: table -> lines, duplicates (ids on more than one line), unsorted (number of lines that
+             sort before the previous one), orphans (ids of lines that are not kept);
+             and kept ids: 'utterance'/'recording'/'speaker' -> sorted ids. Ids are byte strings
+    """
+    files = {name: table_path(data_dir, name) for name in table_keys}
+    files = {name: file for name, file in files.items() if file is not None}
+    columns = {name: read_keys(file, 2 if name in ('utt2spk', 'segments') else 1) for name, file in files.items()}
+
+    # Every id column, by kind; utterances of segments and utt2spk also refer to a recording and a speaker.
+    # Without segments, every utterance is a whole recording of the same id.
+    keys = {(name, 0): (table_keys[name], ids[0]) for name, ids in columns.items()}
+    keys[('utt2spk', 1)] = ('speaker', columns['utt2spk'][1])
+    keys[('segments', 1)] = ('recording', columns['segments'][1] if 'segments' in columns else columns['text'][0])
+    vocabulary, codes = {}, {}
+    for kind in ('utterance', 'recording', 'speaker'):
+        names = [key for key, (k, _) in keys.items() if k == kind]
+        vocabulary[kind], kind_codes = _factorize([keys[key][1] for key in names])
+        codes.update(zip(names, kind_codes))
+    counts = {key: np.bincount(c, minlength=len(vocabulary[keys[key][0]])) for key, c in codes.items()}
+
+    candidates = np.ones(len(vocabulary['utterance']), dtype=bool)
+    for name in utterance_tables:
+        if name in columns:
+            candidates &= counts[(name, 0)] == 1
+    recordings = counts[('wav.scp', 0)] == 1
+    segment_utts = codes[('segments', 0)] if 'segments' in columns else codes[('text', 0)]
+    segment_recos = codes[('segments', 1)]
+    in_segment = candidates[segment_utts] & recordings[segment_recos]
+
+    kept = {kind: np.zeros(len(v), dtype=bool) for kind, v in vocabulary.items()}
+    kept['utterance'][segment_utts[in_segment]] = True
+    kept['recording'][segment_recos[in_segment]] = True
+    kept['speaker'][codes[('utt2spk', 1)][kept['utterance'][codes[('utt2spk', 0)]]]] = True
+
+    report = {}
+    for name in columns:
+        kind, ids = keys[(name, 0)]
+        c = codes[(name, 0)]
+        report[name] = {
+            'lines': len(ids),
+            'duplicates': vocabulary[kind][counts[(name, 0)] > 1],
+            'unsorted': int(np.count_nonzero(c[1:] < c[:-1])),
+            'orphans': ids[~kept[kind][c]]
+        }
+    return report, {kind: vocabulary[kind][mask] for kind, mask in kept.items()}
+
+
+def has_problems(report: typing.Dict[str, typing.Dict[str, typing.Any]]) -> bool:
+    """
+    :param report: From consistent_ids
+    :return: Whether any table has duplicates or orphans. Unsorted tables do not matter to data2db.
+    """
+    return any(len(r['duplicates']) or len(r['orphans']) for r in report.values())
+
+
+def print_report(data_dir: str,
+                 report: typing.Dict[str, typing.Dict[str, typing.Any]],
+                 kept_ids: typing.Dict[str, np.ndarray]) -> None:
+    """
+    Prints the findings of consistent_ids, one line per table with problems
+    :param data_dir: Full path to Kaldi data directory
+    :param report: From consistent_ids
+    :param kept_ids: From consistent_ids
+    :return: None
+    """
+    for name, r in report.items():
+        problems = []
+        if len(r['duplicates']):
+            problems.append(f"{len(r['duplicates'])} duplicated ids{_examples(r['duplicates'])}")
+        if len(r['orphans']):
+            problems.append(f"{len(r['orphans'])} orphan lines{_examples(r['orphans'])}")
+        if r['unsorted']:
+            problems.append(f"{r['unsorted']} unsorted lines")
+        if problems:
+            print(f"{data_dir}/{name}: {'; '.join(problems)}")
+    print(f"{data_dir}: {len(kept_ids['utterance'])} utterances, {len(kept_ids['recording'])} recordings and "
+          f"{len(kept_ids['speaker'])} speakers are consistent")
+
+
+def check_data(data_dir: str) -> bool:
+    """
+    Checks that the tables of a Kaldi-style data directory agree, like Kaldi's validate_data_dir.sh.
+    data2db --fix ingests only the consistent part.
+    :param data_dir: Full path to Kaldi data directory
+    :return: Whether data2db can ingest data_dir as it is
+    """
+    report, kept_ids = consistent_ids(data_dir)
+    print_report(data_dir, report, kept_ids)
+    return not has_problems(report)
+
+
+if __name__ == '__main__':
+    fire.Fire(check_data)
@@ -1,217 +1,1423 @@
 import os
 import sys
 import fire
+import json
+import time
+import shutil
+import itertools
 import typing
+import concurrent.futures
 from pony.orm import *
 
-from setup_db import setup_db
+from utils import *
+from setup_db import bind_db, end_fast_ingest, release_session, text_hash
+from kaldi_table import table_path, table_name, table_chunks, read_table, segments_source, read_segments, wav_file, \
+    wav_duration, feat_location, ark_shapes, diff_table, parse_segment
+from check_data import table_keys, consistent_ids, has_problems, print_report
 
 required_files = ['text', 'wav.scp', 'utt2spk']
 optional_files_map = {
     'feats.scp': ('Utterance', 'feat'),
     'utt2dur': ('Utterance', 'duration'),
-    'reco2gender': ('Recording', 'duration'),
+    'reco2dur': ('Recording', 'duration'),
     'cmvn.scp': ('Speaker', 'cmvn'),
     'spk2gender': ('Speaker', 'gender')
 }
 
+# The bulk engine hands files to its parser processes in chunks of about this many bytes
+parse_chunk_bytes = 1 << 22
 
-def _check_segment(data_dir: str) -> bool:
+# Keys bound per query when a sync looks up the rows of changed keys
+sync_batch = 500
+
+# Primary key column and value converter for every field an optional file can set,
+# mirroring the `update` methods of the entities in setup_db.
+entity_keys = {
+    'Sentence': 'sent_id',
+    'Speaker': 'spk_id',
+    'Recording': 'reco_id',
+    'Utterance': 'utt_id'
+}
+field_types = {
+    ('Sentence', 'text'): str,
+    ('Speaker', 'gender'): str,
+    ('Speaker', 'cmvn'): str,
+    ('Recording', 'duration'): float,
+    ('Recording', 'wav'): str,
+    ('Utterance', 'feat'): str,
+    ('Utterance', 'duration'): float
+}
+
+
+def _checkpoint(num_rows: int, commit_every: typing.Optional[int]) -> None:
     """
-    Creates dummy segments file if not exists
-    :param data_dir: Full path to Kaldi data directory
-    :return: Boolean: whether segment file is dummy
-    """
-    seg_file = os.path.join(data_dir, 'segments')
-    text_file = os.path.join(data_dir, 'text')
-    if not os.path.exists(seg_file):
-        with open(seg_file, 'w+') as seg_fp:
-            with open(text_file) as utt_fp:
-                for line in utt_fp:
-                    utt_id = line.strip().split()[0]
-                    seg_fp.write(f"{utt_id} {utt_id} -1.0 -1.0\n")
-        return True
-    else:
-        return False
+    Commits and drops the session cache every `commit_every` rows.
+    :param num_rows: Rows processed so far
+    :param commit_every: Chunk size, None to keep everything in one transaction
+    :return: None
+    """
+    if commit_every and num_rows % commit_every == 0:
+        release_session()
 
 
 def _build_recordings(*, wav_file: str,
-                      corpus: str, db) -> typing.Dict[str, 'Recording']:
+                      corpus: str, db,
+                      commit_every: typing.Optional[int] = None) -> int:
     """
     Builds all recordings from wav.scp
     :param wav_file: Full path to wav file
     :param corpus: Corpus
-    :return: Dictionary that maps reco_id/utt_id -> Recording
+    :param commit_every: Commit and drop the session cache every this many rows
+    :return: Number of recordings
     """
-    recordings = {}
-    with open(wav_file, 'r') as fp:
-        for line in fp:
-            toks = line.strip().split()
-            reco_id = toks[0] 
-            path = ' '.join(toks[1:])
-            recordings[reco_id] = db.Recording(wav=path, corpus=corpus, reco_id=reco_id)
-    return recordings
+    i = 0
+    for i, (reco_id, path) in enumerate(read_table(wav_file), 1):
+        db.Recording(wav=path, corpus=corpus, reco_id=reco_id)
+        _checkpoint(i, commit_every)
+    return i
 
 
-def _build_sentences(*, text: str, db) -> typing.Dict[str, 'Sentence']:
+def _build_sentences(*, text: str, db,
+                     commit_every: typing.Optional[int] = None) -> typing.Tuple[typing.Dict[str, str], int]:
     """
     Builds all sentences from 'text'
     :param text: Full path to Kaldi style text file
-    :return: utt_id -> Sentence indexer
+    :param commit_every: Commit and drop the session cache every this many rows
+    :return: utt_id -> sent_id indexer, number of sentences
     """
     seen_transcripts = {}
     sentences = {}
-    with open(text, 'r') as fp:
-        for line in fp:
-            tokens = line.strip().split()
-            utt_id = tokens[0]
-            length = len(tokens) - 1
-            transcript = ' '.join(tokens[1:])
-
-            if transcript not in seen_transcripts:
-                sent_id = f"sent_{str(len(seen_transcripts)).zfill(5)}"
-                sentences[utt_id] = db.Sentence(sent_id=sent_id,
-                                                text=transcript,
-                                                length=length)
-                seen_transcripts[transcript] = sentences[utt_id]
-            else:
-                sentences[utt_id] = seen_transcripts[transcript]
-    return sentences
+    for utt_id, transcript in read_table(text):
+        if transcript not in seen_transcripts:
+            sent_id = f"sent_{str(len(seen_transcripts)).zfill(5)}"
+            db.Sentence(sent_id=sent_id,
+                        text=transcript,
+                        length=len(transcript.split()),
+                        text_hash=text_hash(transcript))
+            seen_transcripts[transcript] = sent_id
+            _checkpoint(len(seen_transcripts), commit_every)
+        sentences[utt_id] = seen_transcripts[transcript]
+    return sentences, len(seen_transcripts)
 
 
-def _build_speakers(*, utt2spk: str, db) -> typing.Dict[str, 'Speaker']:
+def _build_speakers(*, utt2spk: str, db,
+                    commit_every: typing.Optional[int] = None) -> typing.Tuple[typing.Dict[str, str], int]:
     """
     Builds speakers from utt2spk
     :param utt2spk: Kaldi style utt2spk file
-    :return: utt_id  -> Speaker indexer
+    :param commit_every: Commit and drop the session cache every this many rows
+    :return: utt_id  -> spk_id indexer, number of speakers
     """
     speakers = {}
-    seen_speaker = {}
-    with open(utt2spk, 'r') as fp:
-        for line in fp:
-            utt_id, spk_id = line.strip().split()
-            if spk_id not in seen_speaker:
-                seen_speaker[spk_id] = db.Speaker(spk_id=spk_id)
-            speakers[utt_id] = seen_speaker[spk_id]
-    return speakers
+    seen_speaker = set()
+    for utt_id, spk_id in read_table(utt2spk):
+        if spk_id not in seen_speaker:
+            db.Speaker(spk_id=spk_id)
+            seen_speaker.add(spk_id)
+            _checkpoint(len(seen_speaker), commit_every)
+        speakers[utt_id] = spk_id
+    return speakers, len(seen_speaker)
 
 
-def _build_utterances(*, segments: str, db,
-                      recordings: typing.Dict[str, 'Recording'],
-                      sentences: typing.Dict[str, 'Sentence'],
-                      speakers: typing.Dict[str, 'Speaker']) -> None:
+def _build_utterances(*, segments: typing.Iterable[typing.Tuple[str, str, str, str]], db,
+                      sentences: typing.Dict[str, str],
+                      speakers: typing.Dict[str, str],
+                      commit_every: typing.Optional[int] = None) -> int:
     """
     Builds all utterances from built Speaker, Sentence, and Recording.
-    :param segments: Kaldi style segments file, either provided or a faked dummy.
-    :param recordings: Indexer, reco_id -> Recording
-    :param sentences: Indexer, utt_id -> Sentence
-    :param speakers: Indexer, utt_id -> Speaker
-    :return: None
+    Related entities are referenced by primary key, so they need not be in the session cache.
+    :param segments: Segments from kaldi_table.read_segments, possibly virtual
+    :param sentences: Indexer, utt_id -> sent_id
+    :param speakers: Indexer, utt_id -> spk_id
+    :param commit_every: Commit and drop the session cache every this many rows
+    :return: Number of utterances
     """
-    with open(segments, 'r') as fp:
-        for line in fp:
-            utt_id, reco_id, start_time, end_time = line.strip().split()
-            record = recordings[reco_id]
+    i = 0
+    for i, (utt_id, reco_id, start_time, end_time) in enumerate(segments, 1):
+        try:
             spk = speakers[utt_id]
             sent = sentences[utt_id]
-            if start_time != '-1.0' and end_time != '-1.0':
-                utt = db.Utterance(utt_id=utt_id,
-                                   transcript=sent,
-                                   speaker=spk,
-                                   recording=record,
-                                   start_time=float(start_time),
-                                   end_time=float(end_time),
-                                   duration=float(end_time) - float(start_time),
-                                   is_segment=True)
-            else:
-                utt = db.Utterance(utt_id=utt_id,
-                                   transcript=sent,
-                                   speaker=spk,
-                                   recording=record,
-                                   is_segment=False)
-            spk.utterances.add(utt)
-            sent.utterances.add(utt)
-            record.utterances.add(utt)
+        except KeyError:
+            raise ValueError(f"Utterance {utt_id} is missing from utt2spk or text, see data2db --validate") from None
+        if start_time != '-1.0' and end_time != '-1.0':
+            db.Utterance(utt_id=utt_id,
+                         transcript=sent,
+                         speaker=spk,
+                         recording=reco_id,
+                         start_time=float(start_time),
+                         end_time=float(end_time),
+                         duration=float(end_time) - float(start_time),
+                         is_segment=True)
+        else:
+            db.Utterance(utt_id=utt_id,
+                         transcript=sent,
+                         speaker=spk,
+                         recording=reco_id,
+                         is_segment=False)
+        _checkpoint(i, commit_every)
+    return i
 
 
 def _update_db_from_file(*, db,
                          file: str,
                          entity: str,
-                         field: str) -> None:
+                         field: str,
+                         commit_every: typing.Optional[int] = None) -> int:
     """
     Updates Table given a Kaldi style file.
     :param file: Kaldi style file
     :param entity: What table to update, can be either Utterance, Speaker, Sentence, or Recording
     :param field: Field/column to update.
-    :return: None
+    :param commit_every: Commit and drop the session cache every this many rows
+    :return: Number of updated rows
+    """
+    i = 0
+    for i, (index, value) in enumerate(read_table(file), 1):
+        if entity == 'Sentence':
+            db.Sentence[index].update(field, value)
+        elif entity == 'Utterance':
+            db.Utterance[index].update(field, value)
+        elif entity == 'Speaker':
+            db.Speaker[index].update(field, value)
+        elif entity == 'Recording':
+            db.Recording[index].update(field, value)
+        else:
+            raise ValueError(f"Unknown entity {entity}")
+        _checkpoint(i, commit_every)
+    return i
+
+
+def _insert_many(*, db,
+                 table: str,
+                 columns: typing.List[str],
+                 rows: typing.Iterable[tuple],
+                 batch_size: int,
+                 commit_every: typing.Optional[int] = None) -> int:
+    """
+    Inserts rows into a table with one prepared statement, batch by batch.
+    :param table: Table name, as mapped by setup_db
+    :param columns: Column names, in the order of each row tuple
+    :param rows: Iterable of row tuples, consumed lazily
+    :param batch_size: Number of rows handed to each executemany call
+    :param commit_every: Commit once at least this many rows are pending
+    :return: Number of inserted rows
+    """
+    column_list = ', '.join(f'"{c}"' for c in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    sql = f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders})'
+    num_rows = 0
+    pending = 0
+    for batch in batched(rows, batch_size):
+        db.get_connection().executemany(sql, batch)
+        num_rows += len(batch)
+        pending += len(batch)
+        if commit_every and pending >= commit_every:
+            release_session()
+            pending = 0
+    return num_rows
+
+
+def _parse_chunk(*, file: str, start: int, end: typing.Optional[int],
+                 segments: bool = False,
+                 virtual: bool = False,
+                 sentences: bool = False,
+                 convert: typing.Callable[[str], typing.Any] = None) -> typing.List[tuple]:
+    """
+    Parses a byte range of a Kaldi table into the values the writer inserts, so the parser
+    processes also do the per-row conversions and hashing. Runs in the parser processes.
+    :param file: Kaldi table, possibly gzipped
+    :param start: First byte, from kaldi_table.table_chunks
+    :param end: Last byte + 1, from kaldi_table.table_chunks
+    :param segments: Parse as segments, see kaldi_table.read_segments
+    :param virtual: Derive the segments from text
+    :param sentences: Parse as text, adding the length and text_hash of every transcript
+    :param convert: Converts the values of other tables, e.g. float for utt2dur
+    :return: [(index, value)], [(utt_id, transcript, length, text_hash)] for sentences, or
+             [(utt_id, reco_id, start_time, end_time)] for segments, with times None for whole recordings
+    """
+    if segments:
+        return [(utt_id, *_segment(reco_id, start_time, end_time))
+                for utt_id, reco_id, start_time, end_time in read_segments(file, virtual=virtual, start=start, end=end)]
+    if sentences:
+        hashes = {}
+        rows = []
+        for utt_id, transcript in read_table(file, start=start, end=end):
+            if transcript not in hashes:
+                hashes[transcript] = (transcript.count(' ') + 1 if transcript else 0, text_hash(transcript))
+            rows.append((utt_id, transcript, *hashes[transcript]))
+        return rows
+    if convert is not None:
+        return [(index, convert(value)) for index, value in read_table(file, start=start, end=end)]
+    return list(read_table(file, start=start, end=end))
+
+
+def _parse_files(tasks: typing.List[typing.Dict[str, typing.Any]],
+                 jobs: int,
+                 profiler: Profiler) -> typing.Iterator[typing.Iterator[tuple]]:
     """
-    with open(file, 'r') as fp:
-        for line in fp:
-            tokens = line.strip().split()
-            index = tokens[0]
-            value = ' '.join(tokens[1:])
-            if entity == 'Sentence':
-                db.Sentence[index].update(field, value)
-            elif entity == 'Utterance':
-                db.Utterance[index].update(field, value)
-            elif entity == 'Speaker':
-                db.Speaker[index].update(field, value)
-            elif entity == 'Recording':
-                db.Recording[index].update(field, value)
+    Parses files in a process pool, chunk by chunk, ahead of the writer consuming them.
+    Each file must be consumed completely before asking for the next one.
+    :param tasks: _parse_chunk arguments without the byte range, one per file, in the order
+                  the writer consumes them
+    :param jobs: Number of parser processes, 1 parses lazily in this process
+    :param profiler: Adds the time spent parsing, or waiting for the parser processes, to
+                     'parse_seconds' of the stage consuming the lines
+    :return: Iterator over files, each an iterator over its parsed lines
+    """
+    chunks = [(i, dict(task, start=start, end=end))
+              for i, task in enumerate(tasks) for start, end in table_chunks(task['file'], parse_chunk_bytes)]
+    results = profiler.timed(parallel_imap(_parse_chunk, [c for _, c in chunks], jobs=jobs), 'parse_seconds')
+    parsed = zip((i for i, _ in chunks), results)
+    for _, group in itertools.groupby(parsed, key=lambda chunk: chunk[0]):
+        yield itertools.chain.from_iterable(lines for _, lines in group)
+
+
+def _ingest_tasks(data_dir: str, jobs: int = 1) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Files the bulk engine reads from one data directory, in the order it consumes them
+    :param data_dir: Full path to Kaldi data directory
+    :param jobs: Number of parser processes. With several, they also hash the transcripts, which
+                 costs hashing duplicates again but takes the work off the writer
+    :return: _parse_chunk arguments, existing optional files first
+    """
+    optional = [(table_path(data_dir, file), field_types.get(t)) for file, t in optional_files_map.items()]
+    segments, virtual = segments_source(data_dir)
+    return [{'file': file, 'convert': convert} for file, convert in optional if file is not None] + \
+           [{'file': table_path(data_dir, 'wav.scp')},
+            {'file': table_path(data_dir, 'text'), 'sentences': jobs > 1},
+            {'file': table_path(data_dir, 'utt2spk')},
+            {'file': segments, 'segments': True, 'virtual': virtual}]
+
+
+def _keep_rows(rows: typing.Iterable[tuple], keep: typing.Set[str]) -> typing.Iterator[tuple]:
+    """
+    :param rows: Parsed lines of a Kaldi table
+    :param keep: Ids to keep
+    :return: Lines whose id is in keep
+    """
+    return (row for row in rows if row[0] in keep)
+
+
+def _read_optional_columns(data_dir: str,
+                           parsed) -> typing.Dict[str, typing.Dict[str, typing.Dict[str, typing.Any]]]:
+    """
+    Reads all existing optional files, so their values can be inserted with the rows
+    instead of updated afterwards.
+    :param data_dir: Full path to Kaldi data directory
+    :param parsed: _parse_files iterator, positioned at the optional files of data_dir
+    :return: entity -> field -> (index -> value)
+    """
+    columns = {}
+    for file, t in optional_files_map.items():
+        entity, field = t
+        if table_path(data_dir, file) is None:
+            continue
+        if (entity, field) not in field_types:
+            raise ValueError(f"Entity {entity} cannot update {field}")
+        # Converted by the parsers, see _ingest_tasks
+        columns.setdefault(entity, {}).setdefault(field, {}).update(next(parsed))
+    return columns
+
+
+def _drop_indexes(conn, table: str) -> typing.List[str]:
+    """
+    Drops the secondary indexes of a table, to be rebuilt once after a bulk load.
+    :param conn: DB-API connection of the bound sqlite database
+    :param table: Table name, as mapped by setup_db
+    :return: CREATE INDEX statements of the dropped indexes
+    """
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master "
+                           "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                           (table,)).fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX "{name}"')
+    return [sql for _, sql in indexes]
+
+
+def _bulk_recordings(*, db, wav: typing.Iterable[typing.Tuple[str, str]],
+                     corpus: str,
+                     optional: typing.Dict[str, typing.Dict[str, typing.Any]],
+                     batch_size: int,
+                     commit_every: typing.Optional[int]) -> int:
+    """
+    Bulk inserts all recordings from wav.scp
+    :param wav: Parsed wav.scp, (reco_id, wav)
+    :param corpus: Corpus
+    :param optional: field -> (reco_id -> value), from optional files
+    :return: Number of recordings
+    """
+    durations = optional.get('duration', {})
+
+    def rows():
+        for reco_id, wav_path in wav:
+            yield reco_id, wav_path, corpus, durations.get(reco_id)
+
+    return _insert_many(db=db,
+                        table='Recording',
+                        columns=['reco_id', 'wav', 'corpus', 'duration'],
+                        rows=rows(),
+                        batch_size=batch_size,
+                        commit_every=commit_every)
+
+
+def _find_sentence(conn, text: str, transcript_hash: str = None) -> typing.Optional[str]:
+    """
+    Looks up an existing sentence through the text_hash index
+    :param conn: DB-API connection of the bound sqlite database
+    :param text: Transcript
+    :param transcript_hash: text_hash of text, if already computed
+    :return: sent_id, or None if no sentence has this text
+    """
+    row = conn.execute('SELECT "sent_id" FROM "Sentence" WHERE "text_hash" = ? AND "text" = ?',
+                       (transcript_hash or text_hash(text), text)).fetchone()
+    return row[0] if row else None
+
+
+def _next_sentence_number(conn) -> int:
+    """
+    Finds the first free number for sent_XXXXX ids, without loading sentences
+    :param conn: DB-API connection of the bound sqlite database
+    :return: Number of the next sentence
+    """
+    row = conn.execute('SELECT MAX(CAST(SUBSTR("sent_id", 6) AS INTEGER)) FROM "Sentence" '
+                       'WHERE "sent_id" GLOB \'sent_[0-9]*\'').fetchone()
+    return 0 if row[0] is None else row[0] + 1
+
+
+def _bulk_sentences(*, db, text: typing.Iterable[tuple],
+                    seen_transcripts: typing.Dict[str, str],
+                    batch_size: int,
+                    commit_every: typing.Optional[int],
+                    append: bool = False) -> typing.Dict[str, str]:
+    """
+    Bulk inserts all distinct sentences from 'text'
+    :param text: Parsed Kaldi style text file, (utt_id, transcript), or (utt_id, transcript, length, text_hash)
+                 from the parser processes
+    :param seen_transcripts: transcript -> sent_id of the sentences inserted by this run,
+                             shared between data directories and extended in place
+    :param append: The db already has sentences: reuse those with the same text, and
+                   number new ones after them
+    :return: utt_id -> sent_id indexer, number of inserted sentences
+    """
+    sentences = {}
+    next_sent = _next_sentence_number(db.get_connection()) if append or seen_transcripts else 0
+
+    def rows():
+        nonlocal next_sent
+        for utt_id, transcript, *computed in text:
+            if transcript not in seen_transcripts:
+                length, transcript_hash = computed or (transcript.count(' ') + 1 if transcript else 0,
+                                                       text_hash(transcript))
+                sent_id = _find_sentence(db.get_connection(), transcript, transcript_hash) if append else None
+                if sent_id is None:
+                    sent_id = f"sent_{str(next_sent).zfill(5)}"
+                    next_sent += 1
+                    yield sent_id, transcript, length, transcript_hash
+                seen_transcripts[transcript] = sent_id
+            sentences[utt_id] = seen_transcripts[transcript]
+
+    num_rows = _insert_many(db=db,
+                            table='Sentence',
+                            columns=['sent_id', 'text', 'length', 'text_hash'],
+                            rows=rows(),
+                            batch_size=batch_size,
+                            commit_every=commit_every)
+    return sentences, num_rows
+
+
+def _bulk_speakers(*, db, utt2spk: typing.Iterable[typing.Tuple[str, str]],
+                   seen_speakers: typing.Set[str],
+                   optional: typing.Dict[str, typing.Dict[str, typing.Any]],
+                   batch_size: int,
+                   commit_every: typing.Optional[int],
+                   append: bool = False) -> typing.Dict[str, str]:
+    """
+    Bulk inserts speakers from utt2spk
+    :param utt2spk: Parsed Kaldi style utt2spk file, (utt_id, spk_id)
+    :param seen_speakers: spk_id of the speakers inserted by this run, shared between
+                          data directories and extended in place
+    :param optional: field -> (spk_id -> value), from optional files
+    :param append: The db already has speakers: reuse those with the same spk_id, filling in
+                   their empty gender and cmvn from the optional files. Differing values are kept
+                   and reported
+    :return: utt_id -> spk_id indexer, number of inserted speakers
+    """
+    speakers = {}
+    genders = optional.get('gender', {})
+    cmvns = optional.get('cmvn', {})
+    updates = {'gender': [], 'cmvn': []}
+    conflicts = []
+
+    def rows():
+        for utt_id, spk_id in utt2spk:
+            if spk_id not in seen_speakers:
+                seen_speakers.add(spk_id)
+                existing = db.get_connection().execute(
+                    'SELECT "gender", "cmvn" FROM "Speaker" WHERE "spk_id" = ?', (spk_id,)).fetchone() \
+                    if append else None
+                if existing is None:
+                    yield spk_id, genders.get(spk_id, ''), cmvns.get(spk_id, '')
+                else:
+                    for field, values, old in (('gender', genders, existing[0]), ('cmvn', cmvns, existing[1])):
+                        new = values.get(spk_id, '')
+                        if new and not old:
+                            updates[field].append((new, spk_id))
+                        elif new and new != old:
+                            conflicts.append(spk_id)
+            speakers[utt_id] = spk_id
+
+    num_rows = _insert_many(db=db,
+                            table='Speaker',
+                            columns=['spk_id', 'gender', 'cmvn'],
+                            rows=rows(),
+                            batch_size=batch_size,
+                            commit_every=commit_every)
+    for field, field_updates in updates.items():
+        db.get_connection().executemany(f'UPDATE "Speaker" SET "{field}" = ? WHERE "spk_id" = ?', field_updates)
+    if conflicts:
+        conflicts = list(dict.fromkeys(conflicts))
+        print(f"Kept the gender or cmvn already in the db for {len(conflicts)} speakers whose new value differs, "
+              f"e.g. {', '.join(conflicts[:5])}")
+    return speakers, num_rows
+
+
+def _bulk_utterances(*, db, segments: typing.Iterable[typing.Tuple[str, str, typing.Optional[float],
+                                                                    typing.Optional[float]]],
+                     sentences: typing.Dict[str, str],
+                     speakers: typing.Dict[str, str],
+                     optional: typing.Dict[str, typing.Dict[str, typing.Any]],
+                     batch_size: int,
+                     commit_every: typing.Optional[int]) -> int:
+    """
+    Bulk inserts all utterances, referencing already inserted rows by key.
+    :param segments: Parsed segments, possibly virtual, (utt_id, reco_id, start_time, end_time),
+                     times None for whole recordings
+    :param sentences: Indexer, utt_id -> sent_id
+    :param speakers: Indexer, utt_id -> spk_id
+    :param optional: field -> (utt_id -> value), from optional files
+    :return: Number of utterances
+    """
+    feats = optional.get('feat', {})
+    durations = optional.get('duration', {})
+
+    def rows():
+        for utt_id, reco_id, start_time, end_time in segments:
+            try:
+                spk_id = speakers[utt_id]
+                sent_id = sentences[utt_id]
+            except KeyError:
+                raise ValueError(f"Utterance {utt_id} is missing from utt2spk or text, "
+                                 f"see data2db --validate") from None
+            feat = feats.get(utt_id, '')
+            if start_time is not None:
+                duration = durations.get(utt_id, end_time - start_time)
+                yield (utt_id, reco_id, sent_id, spk_id, feat,
+                       start_time, end_time, duration, True)
             else:
-                raise ValueError(f"Unknown entity {entity}")
+                yield (utt_id, reco_id, sent_id, spk_id, feat,
+                       None, None, durations.get(utt_id), False)
+
+    return _insert_many(db=db,
+                        table='Utterance',
+                        columns=['utt_id', 'recording', 'transcript', 'speaker', 'feat',
+                                 'start_time', 'end_time', 'duration', 'is_segment'],
+                        rows=rows(),
+                        batch_size=batch_size,
+                        commit_every=commit_every)
+
+
+def _bulk_ingest(*, db, data_dirs: typing.List[typing.Tuple[str, str]],
+                 batch_size: int,
+                 commit_every: typing.Optional[int],
+                 append: bool = False,
+                 jobs: int = 1,
+                 keep_ids: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Set[str]]]] = None,
+                 profiler: Profiler = None) -> int:
+    """
+    Ingests Kaldi data directories with set-based inserts instead of per-row entities.
+    Files are tokenized by a pool of `jobs` parser processes, while this process writes
+    the already parsed chunks; every file of every directory is queued up front, so the
+    parsers keep working through the next files during the inserts.
+    Optional files are merged into the inserted rows. Into a new db, secondary indexes
+    are rebuilt once at the end, and the load runs inside a db_session(ddl=True), which
+    has sqlite foreign keys switched off; references are checked once after loading.
+    When appending, indexes are kept and foreign keys are checked per row, so the cost
+    does not depend on the size of the existing db.
+    :param data_dirs: [(full path to Kaldi data directory, corpus)]
+    :param batch_size: Number of rows per executemany call
+    :param commit_every: Commit every this many rows, None for a single transaction
+    :param append: Add to a db that already has rows, reusing its sentences and speakers
+    :param jobs: Number of parser processes
+    :param keep_ids: data_dir -> 'utterance'/'recording'/'speaker' -> ids to ingest, skipping every other
+                     line of the directory (see check_data.consistent_ids). Directories not in it are ingested whole
+    :param profiler: Measures every table of every directory, and the index rebuild, as a stage
+    :return: Number of inserted rows
+    """
+    profiler = profiler if profiler is not None else Profiler('data2db')
+    tasks = [(data_dir, task) for data_dir, _ in data_dirs for task in _ingest_tasks(data_dir, jobs)]
+    parsed = _parse_files([task for _, task in tasks], jobs, profiler)
+    if keep_ids:
+        parsed = (_keep_rows(rows, keep_ids[data_dir][table_keys[table_name(task['file'])]])
+                  if data_dir in keep_ids else rows
+                  for (data_dir, task), rows in zip(tasks, parsed))
+    indexes = [] if append else \
+        [sql for table in entity_keys for sql in _drop_indexes(db.get_connection(), table)]
+
+    # Directories share sentences and speakers like an append would, without db lookups
+    seen_transcripts = {}
+    seen_speakers = set()
+    num_rows = 0
+    for data_dir, corpus in data_dirs:
+        with profiler.stage('optional files', corpus=corpus):
+            optional = _read_optional_columns(data_dir, parsed)
+        with profiler.stage('recordings', corpus=corpus) as stage:
+            stage['rows'] = _bulk_recordings(db=db,
+                                             wav=next(parsed),
+                                             corpus=corpus,
+                                             optional=optional.get('Recording', {}),
+                                             batch_size=batch_size,
+                                             commit_every=commit_every)
+        num_rows += stage['rows']
+        with profiler.stage('sentences', corpus=corpus) as stage:
+            sentences, stage['rows'] = _bulk_sentences(db=db,
+                                                       text=next(parsed),
+                                                       seen_transcripts=seen_transcripts,
+                                                       batch_size=batch_size,
+                                                       commit_every=commit_every,
+                                                       append=append)
+        num_rows += stage['rows']
+        with profiler.stage('speakers', corpus=corpus) as stage:
+            speakers, stage['rows'] = _bulk_speakers(db=db,
+                                                     utt2spk=next(parsed),
+                                                     seen_speakers=seen_speakers,
+                                                     optional=optional.get('Speaker', {}),
+                                                     batch_size=batch_size,
+                                                     commit_every=commit_every,
+                                                     append=append)
+        num_rows += stage['rows']
+        with profiler.stage('utterances', corpus=corpus) as stage:
+            stage['rows'] = _bulk_utterances(db=db,
+                                             segments=next(parsed),
+                                             sentences=sentences,
+                                             speakers=speakers,
+                                             optional=optional.get('Utterance', {}),
+                                             batch_size=batch_size,
+                                             commit_every=commit_every)
+        num_rows += stage['rows']
+
+    if append:
+        return num_rows
+    conn = db.get_connection()
+    with profiler.stage('indexes'):
+        for sql in indexes:
+            conn.execute(sql)
+
+    with profiler.stage('foreign key check'):
+        violations = conn.execute('PRAGMA foreign_key_check').fetchmany(5)
+    if violations:
+        raise ValueError(f"Rows reference missing parents (table, rowid, parent, fk): {violations}")
+    return num_rows
 
 
-def main(data_dir: str,
+def _orm_ingest(*, db, data_dir: str, corpus: str,
+                commit_every: typing.Optional[int],
+                profiler: Profiler = None) -> int:
+    """
+    Ingests a Kaldi data directory by creating one Pony entity per row.
+    Must be called inside a db_session.
+    :param data_dir: Full path to Kaldi data directory
+    :param corpus: Corpus
+    :param commit_every: Commit and drop the session cache every this many rows,
+                         None for a single transaction
+    :param profiler: Measures every table and optional file as a stage. Without commit_every,
+                     the entities are only inserted by the final commit
+    :return: Number of created rows
+    """
+    profiler = profiler if profiler is not None else Profiler('data2db')
+    num_rows = 0
+    with profiler.stage('recordings') as stage:
+        stage['rows'] = _build_recordings(wav_file=table_path(data_dir, 'wav.scp'),
+                                          corpus=corpus,
+                                          db=db,
+                                          commit_every=commit_every)
+    num_rows += stage['rows']
+    with profiler.stage('sentences') as stage:
+        sentences, stage['rows'] = _build_sentences(text=table_path(data_dir, 'text'),
+                                                    db=db,
+                                                    commit_every=commit_every)
+    num_rows += stage['rows']
+    with profiler.stage('speakers') as stage:
+        speakers, stage['rows'] = _build_speakers(utt2spk=table_path(data_dir, 'utt2spk'),
+                                                  db=db,
+                                                  commit_every=commit_every)
+    num_rows += stage['rows']
+    with profiler.stage('utterances') as stage:
+        stage['rows'] = _build_utterances(speakers=speakers,
+                                          sentences=sentences,
+                                          segments=read_segments(*segments_source(data_dir)),
+                                          db=db,
+                                          commit_every=commit_every)
+    num_rows += stage['rows']
+
+    # Build from optional files
+    for file, t in optional_files_map.items():
+        entity, field = t
+        path = table_path(data_dir, file)
+        if path is not None:
+            with profiler.stage(file) as stage:
+                stage['rows'] = _update_db_from_file(db=db,
+                                                     file=path,
+                                                     entity=entity,
+                                                     field=field,
+                                                     commit_every=commit_every)
+    return num_rows
+
+
+def _probe_wav(wav: str) -> typing.Tuple[typing.Optional[float], bool]:
+    """
+    Reads the duration of a recording from its wav header. Runs in the probing threads.
+    :param wav: wav.scp entry of the recording
+    :return: Seconds of audio or None, and whether the entry names a file at all
+    """
+    file = wav_file(wav)
+    if file is None:
+        return None, False
+    try:
+        return wav_duration(file), True
+    except (OSError, ValueError):
+        return None, True
+
+
+def _probe_durations(*, db, corpora: typing.List[str],
+                     threads: int,
+                     batch_size: int) -> typing.Dict[str, int]:
+    """
+    Fills in Recording.duration of recordings without one by reading the RIFF/WAV headers of
+    their files in a thread pool, then gives unsegmented utterances without a duration the
+    duration of their recording. Piped wav.scp entries are skipped. Must be called inside a db_session.
+    :param corpora: Only recordings of these corpora are probed
+    :param threads: Number of threads reading headers
+    :param batch_size: Recordings probed and updated per round
+    :return: Counts of probed, failed and skipped recordings, and of filled utterances
+    """
+    flush()
+    conn = db.get_connection()
+    in_corpora = f'"corpus" IN ({", ".join("?" * len(corpora))})'
+    stats = {'probed': 0, 'failed': 0, 'skipped': 0, 'utterances': 0}
+    last_reco_id = ''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            recordings = conn.execute(f'SELECT "reco_id", "wav" FROM "Recording" WHERE "duration" IS NULL '
+                                      f'AND {in_corpora} AND "reco_id" > ? ORDER BY "reco_id" LIMIT ?',
+                                      (*corpora, last_reco_id, batch_size)).fetchall()
+            if not recordings:
+                break
+            durations = []
+            for (reco_id, _), (duration, is_file) in zip(recordings,
+                                                         pool.map(_probe_wav, [wav for _, wav in recordings])):
+                if duration is not None:
+                    durations.append((duration, reco_id))
+                stats['probed' if duration is not None else 'failed' if is_file else 'skipped'] += 1
+            conn.executemany('UPDATE "Recording" SET "duration" = ? WHERE "reco_id" = ?', durations)
+            last_reco_id = recordings[-1][0]
+
+    stats['utterances'] = conn.execute(
+        'UPDATE "Utterance" SET "duration" = (SELECT r."duration" FROM "Recording" r '
+        'WHERE r."reco_id" = "Utterance"."recording") '
+        f'WHERE NOT "is_segment" AND "duration" IS NULL AND "recording" IN '
+        f'(SELECT "reco_id" FROM "Recording" WHERE "duration" IS NOT NULL AND {in_corpora})',
+        corpora).rowcount
+    return stats
+
+
+def _index_ark(*, ark: str,
+               entries: typing.List[typing.Tuple[str, int, typing.Dict[str, int]]]
+               ) -> typing.List[typing.Tuple[int, int, str]]:
+    """
+    Reads the matrix shapes of the utterances stored in one ark. Runs in the indexing processes.
+    :param ark: Path to the ark
+    :param entries: (utt_id, offset, row/column ranges), see kaldi_table.feat_location
+    :return: (num_frames, feat_dim, utt_id) of every readable entry
+    """
+    try:
+        shapes = ark_shapes(ark, [offset for _, offset, _ in entries])
+    except (OSError, ValueError):
+        return []
+    indexed = []
+    for (utt_id, _, ranges), shape in zip(entries, shapes):
+        if shape is not None:
+            rows, cols = shape
+            num_frames = ranges.get('row_end', rows - 1) - ranges.get('row_start', 0) + 1
+            feat_dim = ranges.get('col_end', cols - 1) - ranges.get('col_start', 0) + 1
+            indexed.append((num_frames, feat_dim, utt_id))
+    return indexed
+
+
+def _index_feats(*, db, corpora: typing.List[str],
+                 jobs: int) -> typing.Dict[str, int]:
+    """
+    Fills in Utterance.num_frames and feat_dim of utterances without them from the matrix
+    headers their feats.scp entries point at. Entries are grouped by ark, so every ark is
+    mapped once and read in offset order, by `jobs` processes in parallel.
+    Must be called inside a db_session.
+    :param corpora: Only utterances of these corpora are indexed
+    :param jobs: Number of processes reading arks
+    :return: Counts of indexed utterances, utterances whose header could not be read,
+             and utterances whose feats.scp entry is not an ark offset
+    """
+    flush()
+    conn = db.get_connection()
+    in_corpora = f'r."corpus" IN ({", ".join("?" * len(corpora))})'
+    arks = {}
+    stats = {'indexed': 0, 'failed': 0, 'skipped': 0}
+    for utt_id, feat in conn.execute('SELECT u."utt_id", u."feat" FROM "Utterance" u '
+                                     'JOIN "Recording" r ON r."reco_id" = u."recording" '
+                                     f'WHERE u."num_frames" IS NULL AND u."feat" != \'\' AND {in_corpora}',
+                                     corpora):
+        location = feat_location(feat)
+        if location is None:
+            stats['skipped'] += 1
+            continue
+        ark, offset, ranges = location
+        arks.setdefault(ark, []).append((utt_id, offset, ranges))
+
+    tasks = [{'ark': ark, 'entries': entries} for ark, entries in arks.items()]
+    for task, indexed in zip(tasks, parallel_imap(_index_ark, tasks, jobs=jobs)):
+        conn.executemany('UPDATE "Utterance" SET "num_frames" = ?, "feat_dim" = ? WHERE "utt_id" = ?', indexed)
+        stats['indexed'] += len(indexed)
+        stats['failed'] += len(task['entries']) - len(indexed)
+    return stats
+
+
+def _scan_files(data_dir: str,
+                manifest: typing.Dict[str, typing.Dict[str, typing.Any]]
+                ) -> typing.Tuple[typing.Set[str], typing.Dict[str, typing.Dict[str, typing.Any]]]:
+    """
+    Compares the Kaldi files of a data directory against a manifest. Files whose size and
+    mtime match the manifest are not read, others are hashed.
+    :param data_dir: Full path to Kaldi data directory
+    :param manifest: file name -> {size, mtime, sha1}, as of the last sync
+    :return: Names of added, removed or modified files, and the manifest of data_dir now
+    """
+    changed = set()
+    current = {}
+    for name in required_files + ['segments'] + list(optional_files_map):
+        path = table_path(data_dir, name)
+        if path is None:
+            if name in manifest:
+                changed.add(name)
+            continue
+        stat = os.stat(path)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        old = manifest.get(name)
+        if old and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+            entry['sha1'] = old['sha1']
+        else:
+            entry['sha1'] = file_digest(path)
+            if not old or old['sha1'] != entry['sha1']:
+                changed.add(name)
+        current[name] = entry
+    return changed, current
+
+
+def _previous_dir(manifest_file: str) -> str:
+    """
+    :param manifest_file: JSON manifest of a synced db
+    :return: Directory next to it with a copy of the Kaldi files as of the last sync
+    """
+    return f"{os.path.splitext(manifest_file)[0]}.files"
+
+
+def _table_rows(data_dir: str, name: str) -> typing.Iterator[tuple]:
+    """
+    :param data_dir: Full path to Kaldi data directory
+    :param name: Table name; segments are virtual without a segments file
+    :return: Iterator over the rows of the table, none if data_dir has no such table
+    """
+    if name == 'segments':
+        file, virtual = segments_source(data_dir)
+        return read_segments(file, virtual) if file is not None else iter(())
+    path = table_path(data_dir, name)
+    return read_table(path) if path is not None else iter(())
+
+
+def _diff_table(previous_dir: str, data_dir: str, name: str) -> typing.Tuple[typing.Dict[str, tuple], typing.Set[str]]:
+    """
+    Compares a table with its copy from the last sync; only the lines that differ are parsed
+    :param previous_dir: Copy of the data directory, see _previous_dir
+    :param data_dir: Full path to Kaldi data directory
+    :param name: Table name
+    :return: key -> other fields of every added or changed row, and the keys of removed rows
+    """
+    if name == 'segments':
+        (old_file, old_virtual), (new_file, new_virtual) = segments_source(previous_dir), segments_source(data_dir)
+        if old_virtual != new_virtual:
+            # A segments file was added or removed: every row may differ
+            new = set(_table_rows(data_dir, name))
+            old = set(_table_rows(previous_dir, name))
+        else:
+            added, gone = diff_table(old_file, new_file)
+            new = {parse_segment(*row, new_virtual) for row in added}
+            old = {parse_segment(*row, old_virtual) for row in gone}
+    else:
+        added, gone = diff_table(table_path(previous_dir, name), table_path(data_dir, name))
+        new, old = set(added), set(gone)
+    changed = {row[0]: row[1:] for row in new - old}
+    return changed, {row[0] for row in old - new} - changed.keys()
+
+
+def _rows_for_keys(conn, sql: str, keys: typing.Iterable[str], params: tuple = ()) -> typing.Iterator[tuple]:
+    """
+    Runs a query over a set of keys, sync_batch keys at a time
+    :param conn: DB-API connection of the bound sqlite database
+    :param sql: Query whose {keys} is replaced by the placeholders of a batch
+    :param keys: Keys to bind
+    :param params: Parameters bound after the keys
+    :return: Iterator over the rows of all batches
+    """
+    for batch in batched(keys, sync_batch):
+        yield from conn.execute(sql.format(keys=', '.join('?' * len(batch))), (*batch, *params))
+
+
+def _segment(reco_id: str, start_time: str, end_time: str) -> typing.Tuple[str, typing.Optional[float],
+                                                                           typing.Optional[float]]:
+    # Segment of a segments row as stored in the db, times of whole recordings are NULL
+    if start_time != '-1.0' and end_time != '-1.0':
+        return reco_id, float(start_time), float(end_time)
+    return reco_id, None, None
+
+
+def _sync_structure(*, db, data_dir: str, corpus: str,
+                    previous_dir: typing.Optional[str],
+                    changed: typing.Set[str]) -> typing.Tuple[typing.Dict[str, int], typing.Dict[str, typing.Set[str]]]:
+    """
+    Brings the recordings and utterances of a corpus, and the sentences and speakers they use,
+    in line with wav.scp, text, utt2spk and segments. Only the keys whose rows differ from the
+    copy of the last sync are looked up in the db, and only differing rows are written; rows of
+    other corpora merged into the same db are left alone. Must be called inside a db_session.
+    :param data_dir: Full path to Kaldi data directory
+    :param corpus: Corpus the data directory was ingested as
+    :param previous_dir: Copy of the data directory from the last sync, None to compare every
+                         row with the db
+    :param changed: Names of the files changed since the last sync
+    :return: Change counts, and entity -> keys of the rows created, or utterances whose segment
+             times changed, which take the values of the optional files
+    """
+    stats = {'recordings': 0, 'speakers': 0, 'sentences': 0, 'utterances': 0, 'deleted': 0}
+    created = {'Recording': set(), 'Speaker': set(), 'Utterance': set()}
+    tables = {}
+
+    def table(name):
+        # Whole tables are only read for rows the diffs do not cover
+        if name not in tables:
+            tables[name] = {row[0]: row[1:] for row in _table_rows(data_dir, name)}
+        return tables[name]
+
+    flush()
+    conn = db.get_connection()
+    structural = ['wav.scp', 'text', 'utt2spk', 'segments']
+    if previous_dir is None:
+        diffs = {name: (table(name), set()) for name in structural}
+        diffs['wav.scp'][1].update(row[0] for row in conn.execute(
+            'SELECT "reco_id" FROM "Recording" WHERE "corpus" = ?', (corpus,)) if row[0] not in table('wav.scp'))
+        diffs['segments'][1].update(row[0] for row in conn.execute(
+            'SELECT u."utt_id" FROM "Utterance" u JOIN "Recording" r ON r."reco_id" = u."recording" '
+            'WHERE r."corpus" = ?', (corpus,)) if row[0] not in table('segments'))
+    else:
+        # Virtual segments follow text
+        diffs = {name: _diff_table(previous_dir, data_dir, name)
+                 if name in changed or (name == 'segments' and 'text' in changed and segments_source(data_dir)[1])
+                 else ({}, set())
+                 for name in structural}
+
+    wavs, removed_recordings = diffs['wav.scp']
+    db_wavs = dict(_rows_for_keys(conn, 'SELECT "reco_id", "wav" FROM "Recording" WHERE "reco_id" IN ({keys})',
+                                  sorted(wavs)))
+    for reco_id, (wav,) in wavs.items():
+        if reco_id not in db_wavs:
+            db.Recording(reco_id=reco_id, wav=wav, corpus=corpus)
+            created['Recording'].add(reco_id)
+            stats['recordings'] += 1
+        elif db_wavs[reco_id] != wav:
+            db.Recording[reco_id].update('wav', wav)
+            stats['recordings'] += 1
+
+    texts, _ = diffs['text']
+    utt2spk, _ = diffs['utt2spk']
+    segments, removed_utts = diffs['segments']
+    candidates = sorted(texts.keys() | utt2spk.keys() | segments.keys() | removed_utts)
+    db_utts = {row[0]: row[1:] for row in _rows_for_keys(
+        conn, 'SELECT u."utt_id", t."text", u."speaker", u."recording", u."start_time", u."end_time", '
+              'u."transcript" FROM "Utterance" u JOIN "Sentence" t ON t."sent_id" = u."transcript" '
+              'JOIN "Recording" r ON r."reco_id" = u."recording" WHERE u."utt_id" IN ({keys}) AND r."corpus" = ?',
+        candidates, (corpus,))}
+
+    def value(utt_id, name, diff, db_value):
+        if utt_id in diff:
+            return diff[utt_id]
+        if utt_id in db_utts:
+            return db_value
+        try:
+            return table(name)[utt_id]
+        except KeyError:
+            raise ValueError(f"Utterance {utt_id} is missing from {name}, see data2db --validate") from None
+
+    rows = {}
+    for utt_id in candidates:
+        if utt_id in removed_utts:
+            continue
+        if utt_id in segments:
+            segment = _segment(*segments[utt_id])
+        elif utt_id in db_utts:
+            segment = db_utts[utt_id][2:5]
+        elif utt_id in table('segments'):
+            segment = _segment(*table('segments')[utt_id])
+        else:
+            # In text or utt2spk only, not an utterance
+            continue
+        row = (value(utt_id, 'text', texts, db_utts.get(utt_id, ('',))[:1])[0],
+               value(utt_id, 'utt2spk', utt2spk, db_utts.get(utt_id, ('', ''))[1:2])[0]) + segment
+        if db_utts.get(utt_id, ())[:5] != row:
+            rows[utt_id] = row
+
+    db_speakers = set(row[0] for row in _rows_for_keys(
+        conn, 'SELECT "spk_id" FROM "Speaker" WHERE "spk_id" IN ({keys})', sorted({r[1] for r in rows.values()})))
+    for spk_id in sorted({r[1] for r in rows.values()} - db_speakers):
+        db.Speaker(spk_id=spk_id)
+        created['Speaker'].add(spk_id)
+        stats['speakers'] += 1
+
+    next_sent = _next_sentence_number(conn)
+    sent_ids = {}
+    for utt_id, (text, spk_id, reco_id, start_time, end_time) in rows.items():
+        if text not in sent_ids:
+            sent_ids[text] = _find_sentence(conn, text)
+        if sent_ids[text] is None:
+            sent_ids[text] = f"sent_{str(next_sent).zfill(5)}"
+            next_sent += 1
+            db.Sentence(sent_id=sent_ids[text], text=text, length=len(text.split()),
+                        text_hash=text_hash(text))
+            stats['sentences'] += 1
+        values = dict(transcript=sent_ids[text],
+                      speaker=spk_id,
+                      recording=reco_id,
+                      start_time=start_time,
+                      end_time=end_time,
+                      is_segment=start_time is not None)
+        old = db_utts.get(utt_id)
+        # utt2dur is applied again to utterances whose times change
+        if old is None or old[3:5] != (start_time, end_time):
+            values['duration'] = end_time - start_time if start_time is not None else None
+            created['Utterance'].add(utt_id)
+        if old is None:
+            db.Utterance(utt_id=utt_id, **values)
+        else:
+            db.Utterance[utt_id].set(**values)
+        stats['utterances'] += 1
+
+    for utt_id in removed_utts & db_utts.keys():
+        db.Utterance[utt_id].delete()
+        stats['deleted'] += 1
+
+    # Drop the sentences, speakers and recordings this sync left without utterances
+    flush()
+    touched = [utt for utt in db_utts if utt in rows or utt in removed_utts]
+    orphans = {
+        'Sentence': [sent_id for sent_id in sorted({db_utts[utt][5] for utt in touched})
+                     if conn.execute('SELECT 1 FROM "Utterance" WHERE "transcript" = ? LIMIT 1',
+                                     (sent_id,)).fetchone() is None],
+        'Speaker': [spk_id for spk_id in sorted({db_utts[utt][1] for utt in touched})
+                    if conn.execute('SELECT 1 FROM "Utterance" WHERE "speaker" = ? LIMIT 1',
+                                    (spk_id,)).fetchone() is None],
+        'Recording': [row[0] for row in _rows_for_keys(
+            conn, 'SELECT "reco_id" FROM "Recording" WHERE "reco_id" IN ({keys}) AND "corpus" = ?',
+            sorted(removed_recordings), (corpus,))]
+    }
+    for entity, keys in orphans.items():
+        for index in keys:
+            getattr(db, entity)[index].delete()
+        stats['deleted'] += len(keys)
+    return stats, created
+
+
+# Current value of a field for a batch of keys ({keys}), if the row belongs to a corpus (bound last)
+field_queries = {
+    'Recording': 'SELECT k."reco_id", k."{field}" FROM "Recording" k WHERE k."reco_id" IN ({keys}) AND k."corpus" = ?',
+    'Utterance': 'SELECT k."utt_id", k."{field}" FROM "Utterance" k JOIN "Recording" r ON r."reco_id" = k."recording" '
+                 'WHERE k."utt_id" IN ({keys}) AND r."corpus" = ?',
+    'Speaker': 'SELECT k."spk_id", k."{field}" FROM "Speaker" k WHERE k."spk_id" IN ({keys}) AND EXISTS '
+               '(SELECT 1 FROM "Utterance" u JOIN "Recording" r ON r."reco_id" = u."recording" '
+               'WHERE u."speaker" = k."spk_id" AND r."corpus" = ?)'
+}
+
+# Rows of one corpus, per entity with optional files
+corpus_scopes = {
+    'Recording': 'SELECT "reco_id" FROM "Recording" WHERE "corpus" = ?',
+    'Utterance': 'SELECT "utt_id" FROM "Utterance" JOIN "Recording" ON "recording" = "reco_id" WHERE "corpus" = ?',
+    'Speaker': 'SELECT DISTINCT "speaker" FROM "Utterance" JOIN "Recording" ON "recording" = "reco_id" '
+               'WHERE "corpus" = ?',
+}
+
+
+def _sync_optional(*, db, data_dir: str, file: str, corpus: str, entity: str, field: str,
+                   previous_dir: typing.Optional[str],
+                   changed: bool,
+                   keys: typing.Set[str] = frozenset()) -> int:
+    """
+    Brings one column in line with an optional file, through the entities' update methods.
+    Values of the corpus missing from the file are reset. Must be called inside a db_session.
+    :param data_dir: Full path to Kaldi data directory
+    :param file: Optional file name, e.g. 'feats.scp'
+    :param corpus: Corpus the file belongs to, rows of other corpora are left alone
+    :param entity: What table to update, can be either Utterance, Speaker, Sentence, or Recording
+    :param field: Field/column to update.
+    :param previous_dir: Copy of the data directory from the last sync, None to compare every
+                         row of the corpus with the file
+    :param changed: The file changed since the last sync: its rows that differ from the copy are applied
+    :param keys: Rows to bring in line with the file whether it changed or not
+    :return: Number of updated rows
+    """
+    if (entity, field) not in field_types:
+        raise ValueError(f"Entity {entity} cannot update {field}")
+    convert = field_types[(entity, field)]
+    flush()
+    conn = db.get_connection()
+
+    full = None
+    if changed and previous_dir is None:
+        full = {index: value for index, value in _table_rows(data_dir, file)}
+        diff, removed = full, set()
+        candidates = full.keys() | {row[0] for row in conn.execute(corpus_scopes[entity], (corpus,))}
+    elif changed:
+        diff, removed = _diff_table(previous_dir, data_dir, file)
+        diff = {index: value for index, (value,) in diff.items()}
+        candidates = diff.keys() | removed | keys
+    else:
+        diff, removed = {}, set()
+        candidates = set(keys)
+    if not candidates:
+        return 0
+
+    current = dict(_rows_for_keys(conn, field_queries[entity].format(field=field, keys='{keys}'),
+                                  sorted(candidates), (corpus,)))
+    # What a fresh ingest would store without the file: segments give utterances a duration
+    defaults = {}
+    if (entity, field) == ('Utterance', 'duration'):
+        defaults = {utt_id: end_time - start_time for utt_id, start_time, end_time in _rows_for_keys(
+            conn, 'SELECT "utt_id", "start_time", "end_time" FROM "Utterance" WHERE "is_segment" AND "utt_id" IN ({keys})',
+            sorted(current))}
+    default = '' if convert is str else None
+
+    table = getattr(db, entity)
+    num_updated = 0
+    for index in sorted(current.keys()):
+        if index in diff:
+            value = diff[index]
+        elif changed and index in removed:
+            value = None
+        else:
+            # Unchanged line of a row the structure sync created
+            if full is None:
+                full = {i: v for i, v in _table_rows(data_dir, file)}
+            value = full.get(index)
+        if value is not None:
+            if current[index] != convert(value):
+                table[index].update(field, value)
+                num_updated += 1
+        elif current[index] != defaults.get(index, default):
+            if (entity, field) == ('Utterance', 'feat'):
+                table[index].update(field, defaults.get(index, default))
+            else:
+                table[index].set(**{field: defaults.get(index, default)})
+            num_updated += 1
+    return num_updated
+
+
+def _sync(*, db, data_dir: str, corpus: str, manifest_file: str) -> None:
+    """
+    Applies the changes of a data directory since the last sync to an existing db.
+    Unchanged files are skipped after comparing size and mtime, changed files are compared
+    with their copy from the last sync, and only the rows of differing keys are looked up and
+    written. Without a copy (a manifest of an older version), every row is compared with the db.
+    :param data_dir: Full path to Kaldi data directory
+    :param corpus: Corpus of added recordings
+    :param manifest_file: JSON manifest written by the last sync
+    :return: None
+    """
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)['files']
+    changed, current = _scan_files(data_dir, manifest)
+    if not changed:
+        print(f"{data_dir} unchanged since last sync")
+        _write_manifest(manifest_file, data_dir, current, changed)
+        return
+
+    previous_dir = _previous_dir(manifest_file)
+    previous_dir = previous_dir if manifest and os.path.isdir(previous_dir) else None
+    stats = {}
+    created = {}
+    with db_session:
+        if changed & {'wav.scp', 'text', 'utt2spk', 'segments'}:
+            structure_stats, created = _sync_structure(db=db,
+                                                       data_dir=data_dir,
+                                                       corpus=corpus,
+                                                       previous_dir=previous_dir,
+                                                       changed=changed)
+            stats.update(structure_stats)
+        for file, (entity, field) in optional_files_map.items():
+            keys = created.get(entity, set()) if file in current else set()
+            if file in changed or keys:
+                stats[file] = _sync_optional(db=db,
+                                             data_dir=data_dir,
+                                             file=file,
+                                             corpus=corpus,
+                                             entity=entity,
+                                             field=field,
+                                             previous_dir=previous_dir,
+                                             changed=file in changed,
+                                             keys=keys)
+        commit()
+    _write_manifest(manifest_file, data_dir, current, changed)
+    print(f"Synced {sorted(changed)}: " + ', '.join(f"{k} {v}" for k, v in stats.items()))
+
+
+def _write_manifest(manifest_file: str,
+                    data_dir: str,
+                    files: typing.Dict[str, typing.Dict[str, typing.Any]],
+                    changed: typing.Optional[typing.Set[str]] = None) -> None:
+    """
+    Writes the sync manifest of a db, and refreshes the copy of the data directory next to it
+    (see _previous_dir) that the next sync compares changed files with
+    :param manifest_file: JSON file to write
+    :param data_dir: Full path to the synced Kaldi data directory
+    :param files: file name -> {size, mtime, sha1}
+    :param changed: Files that changed since the copy was made, default: copy all
+    :return: None
+    """
+    previous_dir = _previous_dir(manifest_file)
+    os.makedirs(previous_dir, exist_ok=True)
+    for name in required_files + ['segments'] + list(optional_files_map):
+        path, copy = table_path(data_dir, name), table_path(previous_dir, name)
+        if copy is not None and (path is None or changed is None or name in changed or
+                                 os.path.basename(copy) != os.path.basename(path)):
+            os.remove(copy)
+            copy = None
+        if path is not None and copy is None:
+            shutil.copyfile(path, os.path.join(previous_dir, os.path.basename(path)))
+    with open(manifest_file, 'w') as fp:
+        json.dump({'data_dir': os.path.abspath(data_dir), 'files': files}, fp, indent=1)
+
+
+def _ingest(*, db, data_dirs: typing.List[str],
+            corpora: typing.List[str],
+            engine: str,
+            batch_size: int,
+            commit_every: typing.Optional[int],
+            append: bool,
+            jobs: int,
+            keep_ids: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Set[str]]]] = None,
+            profiler: Profiler = None) -> None:
+    """
+    Ingests data directories with either engine, and reports the ingest rate
+    :param data_dirs: Full paths to Kaldi data directories, a single one for the 'orm' engine
+    :param corpora: Corpus of each data directory
+    :param append: The db already has rows
+    :param keep_ids: Only ingest these ids of some data directories ('bulk' engine), see _bulk_ingest
+    :param profiler: Measures the stages of either engine, and the final commit
+    :return: None
+    """
+    profiler = profiler if profiler is not None else Profiler('data2db')
+    start = time.time()
+    with db_session(ddl=engine == 'bulk' and not append):
+        if engine == 'bulk':
+            num_rows = _bulk_ingest(db=db,
+                                    data_dirs=list(zip(data_dirs, corpora)),
+                                    batch_size=batch_size,
+                                    commit_every=commit_every,
+                                    append=append,
+                                    jobs=jobs,
+                                    keep_ids=keep_ids,
+                                    profiler=profiler)
+        else:
+            num_rows = _orm_ingest(db=db,
+                                   data_dir=data_dirs[0],
+                                   corpus=corpora[0],
+                                   commit_every=commit_every,
+                                   profiler=profiler)
+
+        with profiler.stage('commit'):
+            commit()
+    elapsed = time.time() - start
+    print(f"Ingested {num_rows} rows in {elapsed:.2f}s "
+          f"({num_rows / max(elapsed, 1e-9):.0f} rows/sec, engine={engine}, jobs={jobs})")
+
+
+def main(data_dir: typing.Union[str, typing.Sequence[str]],
          db_file: str = None,
          db_provider: str = 'sqlite',
-         corpus: str = None) -> None:
+         corpus: typing.Union[str, typing.Sequence[str]] = None,
+         engine: str = 'orm',
+         batch_size: int = 10000,
+         commit_every: int = None,
+         fast_ingest: bool = False,
+         sync: bool = False,
+         append: bool = False,
+         jobs: int = 1,
+         probe_durations: bool = False,
+         probe_threads: int = 32,
+         index_feats: bool = False,
+         validate: bool = False,
+         fix: bool = False,
+         profile: typing.Union[bool, str] = False) -> None:
+    """
+    Converts a Kaldi-style data directory to a database
+    :param data_dir: Full path to Kaldi data directory. The bulk engine also takes several,
+                     e.g. --data_dir data/a,data/b, ingested into one db in one run
+    :param db_file: Full path to db_file to create
+    :param db_provider: db type.
+    :param corpus: Value of Recording.corpus, defaults to the name of data_dir. One per
+                   data_dir when several are given, e.g. --corpus a,b
+    :param engine: 'orm' builds one Pony entity per row, 'bulk' uses batched
+                   executemany inserts (sqlite only)
+    :param batch_size: Rows per executemany call for the 'bulk' engine
+    :param commit_every: Commit and drop the session cache every this many rows, so
+                         memory stays bounded. Default: one transaction for everything
+    :param fast_ingest: Use setup_db.fast_ingest_pragmas (WAL, no fsync, large cache) while loading,
+                        then switch the db back to a rollback journal (setup_db.end_fast_ingest)
+    :param sync: Keep a manifest next to db_file, and if db_file already exists, only apply
+                 what changed in data_dir since the last sync instead of refusing to run
+    :param append: Merge data_dir into an existing db (bulk engine only). Sentences are
+                   deduplicated against the db through Sentence.text_hash, speakers with the
+                   same spk_id are shared, and recordings are tagged with corpus
+    :param jobs: Number of processes parsing the Kaldi files for the 'bulk' engine, while
+                 this process writes to the db
+    :param probe_durations: Read the wav headers of recordings without a duration (sqlite only),
+                            and give unsegmented utterances the duration of their recording
+    :param probe_threads: Number of threads reading wav headers
+    :param index_feats: Read num_frames and feat_dim of every utterance from the ark header its
+                        feats.scp entry points at (sqlite only), in `jobs` processes
+    :param validate: Check that the files of every data_dir agree before ingesting (see check_data.py),
+                     and stop at duplicated ids or ids missing from another file
+    :param fix: Validate, and only ingest the utterances, recordings and speakers all files agree on,
+                like fix_data_dir.sh (bulk engine)
+    :param profile: Report wall time, rows/sec, peak RSS and SQL statements of every stage as one JSON
+                    line, printed at the end, or appended to this file (see utils.Profiler)
+    :return: None
+    """
+    # fire keeps "data/a,data/b" as one string, it only splits lists of bare names
+    data_dirs = data_dir.split(',') if isinstance(data_dir, str) else list(data_dir)
+    if corpus is None:
+        corpora = [os.path.basename(os.path.normpath(d)) for d in data_dirs]
+    else:
+        corpora = corpus.split(',') if isinstance(corpus, str) else \
+            [str(c) for c in (corpus if isinstance(corpus, (list, tuple)) else [corpus])]
+    if len(corpora) != len(data_dirs):
+        raise ValueError(f"Got {len(corpora)} corpora for {len(data_dirs)} data dirs")
+    if len(data_dirs) > 1 and (engine != 'bulk' or sync):
+        raise ValueError("Several data dirs require engine 'bulk' and cannot be synced")
+    if len(data_dirs) > 1 and db_file is None:
+        raise ValueError("db_file is required with several data dirs")
+    if append and engine != 'bulk':
+        raise ValueError(f"append requires engine 'bulk', got {engine}")
+    if append and sync:
+        raise ValueError("append and sync cannot be combined")
+    if engine not in ('orm', 'bulk'):
+        raise ValueError(f"engine can be either 'orm' or 'bulk', got {engine}")
+    if engine == 'bulk' and db_provider != 'sqlite':
+        raise ValueError(f"engine 'bulk' only supports sqlite, got {db_provider}")
+    if fix and (engine != 'bulk' or sync):
+        raise ValueError("fix requires engine 'bulk' and cannot be combined with sync")
+    data_dir = data_dirs[0]
     db_file = db_file if db_file is not None else os.path.basename(data_dir)
     # Set up database
-    if os.path.exists(db_file):
+    db_exists = os.path.exists(db_file)
+    if db_exists and not (sync or append):
         print(f"{db_file} already exist. Remove or rename it before proceed.")
         sys.exit(1)
+    for d in data_dirs:
+        missing = [f for f in required_files if table_path(d, f) is None]
+        if missing:
+            print(f"{d} is missing required files: {', '.join(missing)}")
+            sys.exit(1)
 
-    db = setup_db()
-    db.bind(provider=db_provider,
-            filename=db_file,
-            create_db=True)
-    db.generate_mapping(create_tables=True)
-
-    assert all(os.path.exists(os.path.join(data_dir, f)) for f in required_files), \
-        f"Required these file to exist in {data_dir}:\n\t{required_files}"
+    profiler = Profiler('data2db', profile)
+    keep_ids = {}
+    if validate or fix:
+        start = time.time()
+        with profiler.stage('validate') as stage:
+            stage['rows'] = 0
+            for d in data_dirs:
+                report, kept_ids = consistent_ids(d)
+                print_report(d, report, kept_ids)
+                stage['rows'] += sum(r['lines'] for r in report.values())
+                if not has_problems(report):
+                    continue
+                if not fix:
+                    print(f"{d} is inconsistent. Fix it, or ingest the consistent part with --fix.")
+                    sys.exit(1)
+                keep_ids[d] = {kind: {i.decode('utf-8') for i in ids.tolist()} for kind, ids in kept_ids.items()}
+        print(f"Validated {len(data_dirs)} data dirs in {time.time() - start:.2f}s")
 
-    corpus = corpus if corpus else os.path.basename(data_dir)
-    dummy_segment = _check_segment(data_dir)
+    with profiler.stage('setup'):
+        db = bind_db(db_file, db_provider, create_db=True, fast_ingest=fast_ingest)
+    profiler.watch(db)
+    if profiler.enabled:
+        with db_session:
+            # Pony keeps this connection open between sessions
+            profiler.trace(db.get_connection())
+    manifest_file = f"{db.provider.pool.filename if db_provider == 'sqlite' else db_file}.manifest.json"
 
-    # Build from required files
-    with db_session:
-        recordings = _build_recordings(wav_file=os.path.join(data_dir, 'wav.scp'),
-                                       corpus=corpus,
-                                       db=db)
-        sentences = _build_sentences(text=os.path.join(data_dir, 'text'),
-                                     db=db)
-        speakers = _build_speakers(utt2spk=os.path.join(data_dir, 'utt2spk'),
-                                   db=db)
-        _build_utterances(recordings=recordings,
-                          speakers=speakers,
-                          sentences=sentences,
-                          segments=os.path.join(data_dir, 'segments'),
-                          db=db)
-
-        # Build from optional files
-        for file, t in optional_files_map.items():
-            entity, field = t
-            file = os.path.join(data_dir, file)
-            if os.path.exists(file):
-                _update_db_from_file(db=db,
-                                     file=file,
-                                     entity=entity,
-                                     field=field)
+    if db_exists and sync:
+        with profiler.stage('sync'):
+            _sync(db=db,
+                  data_dir=data_dir,
+                  corpus=corpora[0],
+                  manifest_file=manifest_file)
+    else:
+        _ingest(db=db,
+                data_dirs=data_dirs,
+                corpora=corpora,
+                engine=engine,
+                batch_size=batch_size,
+                commit_every=commit_every,
+                append=append and db_exists,
+                jobs=jobs,
+                keep_ids=keep_ids,
+                profiler=profiler)
+        if sync:
+            _write_manifest(manifest_file, data_dir, _scan_files(data_dir, {})[1])
 
-        commit()
-        if dummy_segment:
-            os.remove(os.path.join(data_dir, 'segments'))
+    if probe_durations:
+        if db_provider != 'sqlite':
+            raise ValueError(f"probe_durations only supports sqlite, got {db_provider}")
+        start = time.time()
+        with db_session, profiler.stage('probe durations') as stage:
+            stats = _probe_durations(db=db,
+                                     corpora=corpora,
+                                     threads=probe_threads,
+                                     batch_size=batch_size)
+            commit()
+            stage.update(stats)
+        print(f"Probed wav headers in {time.time() - start:.2f}s: " +
+              ', '.join(f"{k} {v}" for k, v in stats.items()))
+    if index_feats:
+        if db_provider != 'sqlite':
+            raise ValueError(f"index_feats only supports sqlite, got {db_provider}")
+        start = time.time()
+        with db_session, profiler.stage('index feats') as stage:
+            stats = _index_feats(db=db,
+                                 corpora=corpora,
+                                 jobs=jobs)
+            commit()
+            stage.update(stats)
+        print(f"Indexed feature arks in {time.time() - start:.2f}s: " +
+              ', '.join(f"{k} {v}" for k, v in stats.items()))
+    if fast_ingest:
+        with profiler.stage('end fast ingest'):
+            end_fast_ingest(db_file, db_provider)
+    profiler.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+import sys
+import typing
+import importlib
+
+
+class DataManager:
+    """
+    In-process API over the command line tools, to drive many ingests, exports and splits from Python
+    without starting a process per call. The tool modules, and with them pony, numpy and fire, are only
+    imported by the first call that needs them. Databases are opened through setup_db.bind_db, so all
+    calls on the same file share one bound mapping and connection until close().
+    Where a tool exits on a user error (e.g. an existing data_dir), a RuntimeError is raised instead.
+    """
+
+    def __init__(self, *, db_provider: str = 'sqlite',
+                 jobs: int = 1,
+                 cache_dir: str = None,
+                 profile: typing.Union[bool, str] = False):
+        """
+        :param db_provider: db type of every call
+        :param jobs: Default jobs of ingest and split
+        :param cache_dir: Default export cache of export and split, see db2data
+        :param profile: Default profile of ingest, export and split, see utils.Profiler
+        """
+        self.db_provider = db_provider
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.profile = profile
+
+    def __enter__(self) -> 'DataManager':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    @staticmethod
+    def _run(module: str, function: str, **kwargs) -> typing.Any:
+        func = getattr(importlib.import_module(module), function)
+        try:
+            return func(**kwargs)
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError(f"{module}.{function} failed, see its output above") from None
+            return None
+
+    def db(self, db_file: str, create: bool = False):
+        """
+        Bound Database of a file, with its mapping generated, shared by every call on that file.
+        Use it inside pony's db_session
+        :param db_file: Full path to db_file
+        :param create: Create the db and its tables if they do not exist
+        :return: Database
+        """
+        return importlib.import_module('setup_db').bind_db(db_file, self.db_provider, create_db=create)
+
+    def ingest(self, data_dir: typing.Union[str, typing.Sequence[str]], db_file: str, **options) -> None:
+        """
+        Converts Kaldi data directories to a database, see data2db.main for the options
+        """
+        options = dict(dict(jobs=self.jobs, profile=self.profile, db_provider=self.db_provider), **options)
+        self._run('data2db', 'main', data_dir=data_dir, db_file=db_file, **options)
+
+    def export(self, db_file: str, data_dir: str, **options) -> None:
+        """
+        Writes a database to a Kaldi data directory, see db2data.db2data for the options
+        """
+        options = dict(dict(cache_dir=self.cache_dir, profile=self.profile, db_provider=self.db_provider), **options)
+        self._run('db2data', 'db2data', db_file=db_file, data_dir=data_dir, **options)
+
+    def split(self, db_file: str, split_by: str, **options) -> None:
+        """
+        Splits a database into subsets, see split_db.split_db for the options
+        """
+        options = dict(dict(jobs=self.jobs, cache_dir=self.cache_dir, profile=self.profile,
+                            db_provider=self.db_provider), **options)
+        self._run('split_db', 'split_db', db_file=db_file, split_by=split_by, **options)
+
+    def query(self, db_file: str, data_dir: str = None, **filters) -> typing.Dict[str, typing.Any]:
+        """
+        Counts, and optionally exports, the utterances matching filters, see query_db.query_db
+        :return: Number of utterances and their hours of audio
+        """
+        return self._run('query_db', 'query_db', db_file=db_file, data_dir=data_dir, **filters)
+
+    def augment(self, db_file: str, **options) -> typing.Dict[str, int]:
+        """
+        Adds speed perturbed copies to a database, see augment_db.augment_db for the options
+        :return: table -> number of rows added
+        """
+        return self._run('augment_db', 'augment_db', db_file=db_file, **options)
+
+    def check(self, data_dir: str) -> bool:
+        """
+        Checks that the files of a Kaldi data directory agree, see check_data.check_data
+        :return: Whether data2db can ingest data_dir as it is
+        """
+        return self._run('check_data', 'check_data', data_dir=data_dir)
+
+    def lookup(self, db_file: str, **options):
+        """
+        Batched, cached utt_id lookups for data loaders, see lookup_db.UtteranceLookup for the options.
+        It reads the db through its own read-only connection, not the bound one
+        :return: UtteranceLookup
+        """
+        return importlib.import_module('lookup_db').UtteranceLookup(db_file, **options)
+
+    def close(self, db_file: str = None) -> None:
+        """
+        Closes the connections of the databases opened so far
+        :param db_file: Only this db, default: all
+        :return: None
+        """
+        if 'setup_db' in sys.modules:
+            sys.modules['setup_db'].release_db(db_file, self.db_provider)
@@ -1,27 +1,148 @@
 import os
 import sys
 import fire
+import time
 import typing
+import itertools
+import contextlib
+import collections
+import numpy as np
 from pony.orm import *
 
 from utils import *
-from setup_db import setup_db
+from setup_db import bind_db, db_path
+from export_cache import ExportCache
 
 
-speaker_files = ['spk2gender', 'spk2utt', 'cmvn.scp']
+speaker_files = ['spk2gender', 'cmvn.scp']
 recording_files = ['wav.scp', 'reco2dur']
-utterance_files = ['utt2spk', 'text', 'feats.scp', 'utt2dur', 'segments']
+utterance_files = ['utt2spk', 'text', 'feats.scp', 'utt2dur', 'utt2num_frames', 'segments']
+
+# Joined, ordered queries used by the 'stream' engine. Related ids are read straight
+# from the foreign key columns, only the transcript text needs a join.
+recording_query = '''
+    SELECT r."reco_id", r."wav", r."duration"
+    FROM "Recording" r
+    ORDER BY r."reco_id"'''
+speaker_query = '''
+    SELECT s."spk_id", s."gender", s."cmvn"
+    FROM "Speaker" s
+    ORDER BY s."spk_id"'''
+# Same ORDER BY as every other file, so spk2utt follows the sort order of utt2spk.
+spk2utt_query = '''
+    SELECT s."spk_id", u."utt_id"
+    FROM "Speaker" s LEFT JOIN "Utterance" u ON u."speaker" = s."spk_id"
+    ORDER BY s."spk_id", u."utt_id"'''
+utterance_query = '''
+    SELECT u."utt_id", t."text", u."speaker", u."feat", u."recording",
+           u."start_time", u."end_time", u."duration", u."is_segment", u."num_frames"
+    FROM "Utterance" u JOIN "Sentence" t ON t."sent_id" = u."transcript"
+    ORDER BY u."utt_id"'''
+
+# The same queries, restricted to the utterances in temp."selected" and the rows they use
+selected_recording_query = '''
+    SELECT r."reco_id", r."wav", r."duration"
+    FROM "Recording" r
+    WHERE r."reco_id" IN (SELECT u."recording" FROM temp."selected" sel JOIN "Utterance" u ON u."utt_id" = sel."utt_id")
+    ORDER BY r."reco_id"'''
+selected_speaker_query = '''
+    SELECT s."spk_id", s."gender", s."cmvn"
+    FROM "Speaker" s
+    WHERE s."spk_id" IN (SELECT u."speaker" FROM temp."selected" sel JOIN "Utterance" u ON u."utt_id" = sel."utt_id")
+    ORDER BY s."spk_id"'''
+selected_spk2utt_query = '''
+    SELECT u."speaker", u."utt_id"
+    FROM temp."selected" sel JOIN "Utterance" u ON u."utt_id" = sel."utt_id"
+    ORDER BY u."speaker", u."utt_id"'''
+selected_utterance_query = '''
+    SELECT u."utt_id", t."text", u."speaker", u."feat", u."recording",
+           u."start_time", u."end_time", u."duration", u."is_segment", u."num_frames"
+    FROM temp."selected" sel JOIN "Utterance" u ON u."utt_id" = sel."utt_id"
+    JOIN "Sentence" t ON t."sent_id" = u."transcript"
+    ORDER BY u."utt_id"'''
+
+# Used when writing split{N}: recordings with the speakers of their utterances, since a
+# recording goes to every shard one of its speakers is in, and the weight of every speaker
+recording_speaker_query = '''
+    SELECT r."reco_id", r."wav", r."duration", u."speaker"
+    FROM "Recording" r LEFT JOIN "Utterance" u ON u."recording" = r."reco_id"
+    ORDER BY r."reco_id"'''
+selected_recording_speaker_query = '''
+    SELECT r."reco_id", r."wav", r."duration", u."speaker"
+    FROM temp."selected" sel JOIN "Utterance" u ON u."utt_id" = sel."utt_id"
+    JOIN "Recording" r ON r."reco_id" = u."recording"
+    ORDER BY r."reco_id"'''
+speaker_weight_query = '''
+    SELECT s."spk_id", COUNT(u."utt_id"), COALESCE(SUM(u."duration"), 0)
+    FROM "Speaker" s LEFT JOIN "Utterance" u ON u."speaker" = s."spk_id"
+    GROUP BY s."spk_id"'''
+selected_speaker_weight_query = '''
+    SELECT u."speaker", COUNT(*), COALESCE(SUM(u."duration"), 0)
+    FROM temp."selected" sel JOIN "Utterance" u ON u."utt_id" = sel."utt_id"
+    GROUP BY u."speaker"'''
+
+
+class _Shards:
+    """
+    Writes the Kaldi-style files of split{N}/1..N, every speaker to one shard. Lines are buffered
+    and appended to their files when the buffers get large, so the number of open files does not
+    grow with the number of shards.
+    """
+    def __init__(self, dirs: typing.List[str],
+                 speaker_shard: typing.Dict[str, int],
+                 buffer_size: int = 1 << 26):
+        self.dirs = dirs
+        self.speaker_shard = speaker_shard
+        self.buffer_size = buffer_size
+        self.buffers = collections.defaultdict(list)
+        self.buffered = 0
+
+    def write_to(self, shard: int, file: str, line: str) -> None:
+        self.buffers[shard, file].append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write(self, spk_id: str, file: str, line: str) -> None:
+        self.write_to(self.speaker_shard[spk_id], file, line)
+
+    def flush(self) -> None:
+        for (shard, file), lines in self.buffers.items():
+            with open(os.path.join(self.dirs[shard], file), 'a') as fp:
+                fp.write(''.join(lines))
+        self.buffers.clear()
+        self.buffered = 0
+
+
+def _assign_shards(*, db,
+                   num_splits: int,
+                   balance: str,
+                   selected: bool = False) -> typing.Dict[str, int]:
+    """
+    Assigns speakers to num_splits shards of about equal size. Must be called inside a db_session.
+    :param num_splits: Number of shards
+    :param balance: 'count' balances the number of utterances, 'duration' their total duration
+    :param selected: Only count the utterances in temp."selected"
+    :return: spk_id -> shard
+    """
+    rows = db.get_connection().execute(selected_speaker_weight_query if selected else speaker_weight_query).fetchall()
+    if len(rows) < num_splits:
+        raise ValueError(f"Cannot split {len(rows)} speakers into {num_splits} shards")
+    shard = balanced_assignment([row[1] if balance == 'count' else row[2] for row in rows], num_splits)
+    sizes = np.bincount(shard, weights=[row[1] for row in rows], minlength=num_splits)
+    print(f"Split {len(rows)} speakers into {num_splits} shards of {int(sizes.min())} to {int(sizes.max())} utterances")
+    return {row[0]: s for row, s in zip(rows, shard)}
 
 
 def _write_from_table(*, db,
                       data_dir: str,
                       table: str,
-                      condition: typing.Callable[['db.Entity'], bool] = lambda _: True) -> None:
+                      condition: typing.Callable[['db.Entity'], bool] = lambda _: True) -> int:
     """
     Writes a specified table to Kaldi-style files
     :param data_dir: Full path to Kaldi-style files
     :param table: Can be either Recording, Speaker, or Utterance
-    :return: None
+    :return: Number of rows written
     """
     if table == 'Utterance':
         files = utterance_files
@@ -38,50 +159,311 @@ def _write_from_table(*, db,
     handler = {f: open(os.path.join(data_dir, f), 'w+')
                for f in files}
 
+    num_rows = 0
     for row in iterator:
         if condition(row):
             content = row.to_file()
             for file_name, fp in handler.items():
                 if file_name in content:
                     fp.write(content[file_name])
+            num_rows += 1
 
     for file_name, fp in handler.items():
         fp.close()
+    return num_rows
+
+
+def _stream_rows(*, db, sql: str, chunk_size: int) -> typing.Iterator[tuple]:
+    """
+    Streams the result of a query through a cursor, fetching chunk_size rows at a time.
+    Must be called inside a db_session.
+    :param sql: Query to run
+    :param chunk_size: Number of rows per fetchmany call
+    :return: Iterator over row tuples
+    """
+    cursor = db.get_connection().cursor()
+    cursor.execute(sql)
+    rows = cursor.fetchmany(chunk_size)
+    while rows:
+        yield from rows
+        rows = cursor.fetchmany(chunk_size)
+
+
+@contextlib.contextmanager
+def _open_files(data_dir: str,
+                files: typing.List[str],
+                buffer_size: int) -> typing.Iterator[typing.Dict[str, typing.TextIO]]:
+    """
+    Opens buffered writers for Kaldi-style files, and closes them all on exit
+    :param data_dir: Full path to Kaldi-style files
+    :param files: File names
+    :param buffer_size: Write buffer size per file, in bytes
+    :return: file name -> writer
+    """
+    with contextlib.ExitStack() as stack:
+        yield {f: stack.enter_context(open(os.path.join(data_dir, f), 'w+', buffering=buffer_size))
+               for f in files}
+
+
+def _stream_table(*, db,
+                  data_dir: str,
+                  table: str,
+                  chunk_size: int = 10000,
+                  buffer_size: int = 1 << 20,
+                  selected: bool = False,
+                  shards: typing.Optional[_Shards] = None) -> int:
+    """
+    Writes a specified table to Kaldi-style files from one joined, ordered query,
+    without loading the table or any related entity into memory.
+    Output is identical to _write_from_table.
+    :param data_dir: Full path to Kaldi-style files
+    :param table: Can be either Recording, Speaker, or Utterance
+    :param chunk_size: Number of rows fetched from the cursor at a time
+    :param buffer_size: Write buffer size per file, in bytes
+    :param selected: Only write the utterances in temp."selected", and the rows they use
+    :param shards: Also write every line to the shard of its speaker, in the same pass
+    :return: Number of rows written
+    """
+    num_rows = 0
+    if table == 'Utterance':
+        with _open_files(data_dir, utterance_files, buffer_size) as fp:
+            for utt_id, text, spk_id, feat, reco_id, start_time, end_time, duration, is_segment, num_frames \
+                    in _stream_rows(db=db, sql=selected_utterance_query if selected else utterance_query,
+                                   chunk_size=chunk_size):
+                lines = {
+                    'text': f"{utt_id} {text}\n",
+                    'utt2spk': f"{utt_id} {spk_id}\n"
+                }
+                if feat:
+                    lines['feats.scp'] = f"{utt_id} {feat}\n"
+                if is_segment:
+                    lines['segments'] = f"{utt_id} {reco_id} {start_time} {end_time}\n"
+                if duration:
+                    lines['utt2dur'] = f"{utt_id} {duration}\n"
+                if num_frames is not None:
+                    lines['utt2num_frames'] = f"{utt_id} {num_frames}\n"
+                for file, line in lines.items():
+                    fp[file].write(line)
+                    if shards is not None:
+                        shards.write(spk_id, file, line)
+                num_rows += 1
+    elif table == 'Speaker':
+        with _open_files(data_dir, speaker_files, buffer_size) as fp:
+            for spk_id, gender, cmvn in _stream_rows(db=db,
+                                                     sql=selected_speaker_query if selected else speaker_query,
+                                                     chunk_size=chunk_size):
+                # Speakers without features (e.g. speed perturbed copies) have no cmvn yet
+                lines = {}
+                if gender:
+                    lines['spk2gender'] = f"{spk_id} {gender}\n"
+                if cmvn:
+                    lines['cmvn.scp'] = f"{spk_id} {cmvn}\n"
+                for file, line in lines.items():
+                    fp[file].write(line)
+                    if shards is not None:
+                        shards.write(spk_id, file, line)
+                num_rows += 1
+    elif table == 'Recording' and shards is not None:
+        # A recording is written once, and to every shard one of its speakers is in
+        rows = _stream_rows(db=db,
+                            sql=selected_recording_speaker_query if selected else recording_speaker_query,
+                            chunk_size=chunk_size)
+        with _open_files(data_dir, recording_files, buffer_size) as fp:
+            for (reco_id, wav, duration), speakers in itertools.groupby(rows, key=lambda row: row[:3]):
+                lines = {'wav.scp': f"{reco_id} {wav}\n"}
+                if duration:
+                    lines['reco2dur'] = f"{reco_id} {duration}\n"
+                reco_shards = sorted({shards.speaker_shard[row[3]] for row in speakers if row[3] is not None})
+                for file, line in lines.items():
+                    fp[file].write(line)
+                    for shard in reco_shards:
+                        shards.write_to(shard, file, line)
+                num_rows += 1
+    elif table == 'Recording':
+        with _open_files(data_dir, recording_files, buffer_size) as fp:
+            for reco_id, wav, duration in _stream_rows(db=db,
+                                                       sql=selected_recording_query if selected else recording_query,
+                                                       chunk_size=chunk_size):
+                fp['wav.scp'].write(f"{reco_id} {wav}\n")
+                if duration:
+                    fp['reco2dur'].write(f"{reco_id} {duration}\n")
+                num_rows += 1
+    else:
+        raise ValueError(f"table can be either Utterance, Speaker, or Recording, got {table}")
+    return num_rows
+
+
+def _write_spk2utt(*, db,
+                   data_dir: str,
+                   chunk_size: int = 10000,
+                   buffer_size: int = 1 << 20,
+                   selected: bool = False,
+                   shards: typing.Optional[_Shards] = None) -> int:
+    """
+    Writes spk2utt from one ordered scan over speakers and their utterances, one line
+    per speaker as soon as its last utterance is read.
+    :param data_dir: Full path to Kaldi-style files
+    :param chunk_size: Number of rows fetched from the cursor at a time
+    :param buffer_size: Write buffer size, in bytes
+    :param selected: Only write the utterances in temp."selected"
+    :param shards: Also write every speaker to its shard
+    :return: Number of speakers written
+    """
+    num_speakers = 0
+    with _open_files(data_dir, ['spk2utt'], buffer_size) as fp:
+        rows = _stream_rows(db=db, sql=selected_spk2utt_query if selected else spk2utt_query, chunk_size=chunk_size)
+        for spk_id, utts in itertools.groupby(rows, key=lambda row: row[0]):
+            utt_ids = ' '.join(utt_id for _, utt_id in utts if utt_id is not None)
+            fp['spk2utt'].write(f"{spk_id} {utt_ids}\n")
+            if shards is not None:
+                shards.write(spk_id, 'spk2utt', f"{spk_id} {utt_ids}\n")
+            num_speakers += 1
+    return num_speakers
+
+
+def _export(*, db_file: str,
+            data_dir: str,
+            db_provider: str,
+            engine: str,
+            chunk_size: int,
+            selection: typing.Optional[typing.Tuple[str, typing.Sequence[typing.Any]]],
+            num_splits: typing.Optional[int],
+            split_balance: str,
+            profiler: Profiler) -> None:
+    """
+    Writes a db to a new Kaldi-style directory, see db2data
+    :param profiler: Measures setup, every table and the shards as stages
+    :return: None
+    """
+    with profiler.stage('setup'):
+        db = bind_db(db_file, db_provider)
+    profiler.watch(db)
+    os.mkdir(data_dir)
+
+    with db_session:
+        profiler.trace(db.get_connection())
+        if selection is not None:
+            with profiler.stage('select') as stage:
+                sql, params = selection
+                conn = db.get_connection()
+                conn.execute('CREATE TEMP TABLE "selected" ("utt_id" TEXT PRIMARY KEY)')
+                stage['rows'] = conn.execute(f'INSERT OR IGNORE INTO temp."selected" {sql}', params).rowcount
+        shards = None
+        if num_splits is not None:
+            with profiler.stage('assign shards'):
+                shard_dirs = [os.path.join(data_dir, f"split{num_splits}", str(i + 1)) for i in range(num_splits)]
+                for shard_dir in shard_dirs:
+                    os.makedirs(shard_dir)
+                shards = _Shards(shard_dirs, _assign_shards(db=db,
+                                                            num_splits=num_splits,
+                                                            balance=split_balance,
+                                                            selected=selection is not None))
+        for table in ['Recording', 'Speaker', 'Utterance']:
+            with profiler.stage(f"{table.lower()}s") as stage:
+                if engine == 'stream':
+                    stage['rows'] = _stream_table(db=db,
+                                                  data_dir=data_dir,
+                                                  table=table,
+                                                  chunk_size=chunk_size,
+                                                  selected=selection is not None,
+                                                  shards=shards)
+                else:
+                    stage['rows'] = _write_from_table(db=db,
+                                                      data_dir=data_dir,
+                                                      table=table)
+        with profiler.stage('spk2utt') as stage:
+            stage['rows'] = _write_spk2utt(db=db,
+                                           data_dir=data_dir,
+                                           chunk_size=chunk_size,
+                                           selected=selection is not None,
+                                           shards=shards)
+        if shards is not None:
+            with profiler.stage('flush shards'):
+                shards.flush()
+        if selection is not None:
+            db.get_connection().execute('DROP TABLE temp."selected"')
+
+    remove_empty(data_dir)
+    if num_splits is not None:
+        for shard_dir in shard_dirs:
+            remove_empty(shard_dir)
 
 
 def db2data(db_file: str,
             data_dir: str,
-            db_provider: str = 'sqlite', ) -> None:
+            db_provider: str = 'sqlite',
+            engine: str = 'orm',
+            chunk_size: int = 10000,
+            selection: typing.Optional[typing.Tuple[str, typing.Sequence[typing.Any]]] = None,
+            num_splits: int = None,
+            split_balance: str = 'count',
+            profile: typing.Union[bool, str] = False,
+            cache_dir: str = None,
+            cache_max_gb: float = 10.0) -> None:
     """
     Writes a db to Kaldi-style file directory
     :param db_file: Full path to db_file
     :param data_dir: Full path to Kaldi-style directory
     :param db_provider: db type.
+    :param engine: 'orm' loads every table through Pony, 'stream' writes from joined
+                   queries through a cursor, with constant memory
+    :param chunk_size: Rows fetched at a time by the 'stream' engine
+    :param selection: Only write the utterances returned by this (sql, params) query of utt_ids,
+                      and the recordings, speakers and sentences they use ('stream' engine, sqlite only).
+                      See query_db.utterance_selection
+    :param num_splits: Also write split{num_splits}/1..num_splits, like Kaldi's split_data.sh --per-spk,
+                       in the same pass over the db ('stream' engine). Every speaker goes to one shard
+    :param split_balance: Balance the shards by utterance 'count' or 'duration'
+    :param profile: Report wall time, rows/sec, peak RSS and SQL statements of every stage as one JSON
+                    line, printed at the end, or appended to this file (see utils.Profiler)
+    :param cache_dir: Keep every export in this directory, keyed by the content of db_file and the options
+                      that change the output, and hard link data_dir from there when the same export was
+                      made before, without opening the db (see export_cache.py, sqlite only)
+    :param cache_max_gb: Evict the least recently used exports beyond this size of cache_dir
     :return: None
     """
-
-    db = setup_db()
-    db.bind(provider=db_provider,
-            filename=db_file,
-            create_db=False)
-    db.generate_mapping(create_tables=False)
+    if engine not in ('orm', 'stream'):
+        raise ValueError(f"engine can be either 'orm' or 'stream', got {engine}")
+    if selection is not None and (engine != 'stream' or db_provider != 'sqlite'):
+        raise ValueError("selection requires engine 'stream' and sqlite")
+    if num_splits is not None and (engine != 'stream' or num_splits < 1):
+        raise ValueError(f"num_splits requires engine 'stream' and must be positive, got {num_splits}")
+    if split_balance not in ('count', 'duration'):
+        raise ValueError(f"split_balance can be either 'count' or 'duration', got {split_balance}")
+    if cache_dir is not None and db_provider != 'sqlite':
+        raise ValueError(f"cache_dir only supports sqlite, got {db_provider}")
     if os.path.exists(data_dir):
         print(f"{data_dir} already exists. Remove or rename it before proceed.")
         sys.exit(1)
-    os.mkdir(data_dir)
 
-    with db_session:
-        _write_from_table(db=db,
-                          data_dir=data_dir,
-                          table='Recording')
-        _write_from_table(db=db,
-                          data_dir=data_dir,
-                          table='Speaker')
-        _write_from_table(db=db,
-                          data_dir=data_dir,
-                          table='Utterance')
-
-    remove_empty(data_dir)
+    profiler = Profiler('db2data', profile)
+    options = dict(db_file=db_file,
+                   db_provider=db_provider,
+                   engine=engine,
+                   chunk_size=chunk_size,
+                   selection=selection,
+                   num_splits=num_splits,
+                   split_balance=split_balance,
+                   profiler=profiler)
+    if cache_dir is None:
+        _export(data_dir=data_dir, **options)
+    else:
+        start = time.time()
+        with ExportCache(cache_dir, max_gb=cache_max_gb) as cache:
+            with profiler.stage('cache lookup') as stage:
+                # Both engines write the same files, so they share entries
+                key = cache.key(db_path(db_file),
+                                selection=None if selection is None else [selection[0], list(selection[1])],
+                                num_splits=num_splits,
+                                split_balance=split_balance)
+                stage['hit'] = hit = cache.has(key)
+            if not hit:
+                cache.store(key, lambda export_dir: _export(data_dir=export_dir, **options))
+            with profiler.stage('cache link') as stage:
+                cache.link(key, data_dir)
+                stage['evicted'] = cache.evict(keep=key)
+        print(f"{'Linked' if hit else 'Exported and cached'} {data_dir} in {time.time() - start:.2f}s")
+    profiler.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+import os
+import fire
+import json
+import time
+import shutil
+import typing
+import sqlite3
+import hashlib
+import tempfile
+
+from utils import file_digest
+
+# Part of every key, bump when the layout of cache entries changes
+cache_format = 1
+
+# Files whose code decides what an export contains; editing them invalidates the cache
+exporter_files = ['db2data.py', 'setup_db.py']
+
+# fingerprint: cheap identity of a db file (see _stat_key) -> digest of its content, so an unchanged
+# file is never hashed twice. entry: one exported directory per key, for eviction by last use.
+index_schema = [
+    'CREATE TABLE IF NOT EXISTS "fingerprint" ("stat" TEXT PRIMARY KEY, "digest" TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS "entry" ("key" TEXT PRIMARY KEY, "bytes" INTEGER NOT NULL, '
+    '"last_used" REAL NOT NULL)'
+]
+
+
+class ExportCache:
+    """
+    Directory of finished exports, one per key (see key), with an index.db of content fingerprints
+    and entry sizes. Exports are written to a temporary directory inside the cache and renamed into
+    place, so an entry is either complete or absent, also with concurrent writers.
+    """
+
+    def __init__(self, cache_dir: str, max_gb: float = 10.0):
+        """
+        :param cache_dir: Cache directory, created if needed
+        :param max_gb: evict keeps the cache below this many GB
+        """
+        self.cache_dir = cache_dir
+        self.max_gb = max_gb
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'), isolation_level=None, timeout=60)
+        for sql in index_schema:
+            self.conn.execute(sql)
+
+    def __enter__(self) -> 'ExportCache':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.conn.close()
+
+    def db_digest(self, db_file: str) -> str:
+        """
+        Digest of a db file's content (and its WAL). Only computed when the file changed since the
+        last call, otherwise read from the index
+        :param db_file: Full path to a sqlite file
+        :return: sha1 hex digest
+        """
+        stat = _stat_key(db_file)
+        row = self.conn.execute('SELECT "digest" FROM "fingerprint" WHERE "stat" = ?', (stat,)).fetchone()
+        if row is not None:
+            return row[0]
+        digest = file_digest(db_file)
+        if os.path.exists(f"{db_file}-wal"):
+            digest = hashlib.sha1(f"{digest}:{file_digest(f'{db_file}-wal')}".encode()).hexdigest()
+        self.conn.execute('INSERT OR REPLACE INTO "fingerprint" VALUES (?, ?)', (stat, digest))
+        return digest
+
+    def key(self, db_file: str, **options) -> str:
+        """
+        Key of an export: the content of the db, the exporter code and the options that change the output
+        :param db_file: Full path to a sqlite file
+        :param options: Export options, JSON serializable
+        :return: sha1 hex digest
+        """
+        here = os.path.dirname(os.path.abspath(__file__))
+        code = [file_digest(os.path.join(here, f)) for f in exporter_files]
+        return hashlib.sha1(json.dumps([cache_format, self.db_digest(db_file), code, options],
+                                       sort_keys=True).encode()).hexdigest()
+
+    def has(self, key: str) -> bool:
+        return os.path.isdir(os.path.join(self.cache_dir, key))
+
+    def store(self, key: str, export: typing.Callable[[str], None]) -> None:
+        """
+        Adds an entry
+        :param key: From key
+        :param export: Writes the export to the directory it is given, which does not exist yet
+        :return: None
+        """
+        entry = os.path.join(self.cache_dir, key)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            export(os.path.join(tmp_dir, 'export'))
+            try:
+                os.rename(os.path.join(tmp_dir, 'export'), entry)
+            except OSError:
+                # Stored by a concurrent export of the same key
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.conn.execute('INSERT OR REPLACE INTO "entry" VALUES (?, ?, ?)', (key, _tree_bytes(entry), time.time()))
+
+    def link(self, key: str, data_dir: str) -> None:
+        """
+        Creates data_dir from an entry, see link_tree, and marks the entry as used
+        :param key: Key of an existing entry
+        :param data_dir: Directory to create
+        :return: None
+        """
+        entry = os.path.join(self.cache_dir, key)
+        link_tree(entry, data_dir)
+        if not self.conn.execute('UPDATE "entry" SET "last_used" = ? WHERE "key" = ?', (time.time(), key)).rowcount:
+            self.conn.execute('INSERT OR REPLACE INTO "entry" VALUES (?, ?, ?)', (key, _tree_bytes(entry), time.time()))
+
+    def evict(self, keep: str = None) -> int:
+        """
+        Removes the least recently used entries until the cache holds at most max_gb. Directories
+        linked from removed entries keep their files
+        :param keep: Key never to evict
+        :return: Number of removed entries
+        """
+        rows = self.conn.execute('SELECT "key", "bytes" FROM "entry" ORDER BY "last_used"').fetchall()
+        total = sum(size for _, size in rows)
+        removed = 0
+        for key, size in rows:
+            if total <= self.max_gb * (1 << 30):
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            self.conn.execute('DELETE FROM "entry" WHERE "key" = ?', (key,))
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        :return: Number of entries and their size in GB
+        """
+        entries, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM("bytes"), 0) FROM "entry"').fetchone()
+        return {'entries': entries, 'gb': round(size / (1 << 30), 3)}
+
+
+def _stat_key(db_file: str) -> str:
+    """
+    Identifies a db file and its state without reading it: path, inode, size and mtime of the file
+    and of its WAL, and the change counter sqlite keeps in the file header
+    :param db_file: Full path to a sqlite file
+    :return: Key of the fingerprint table
+    """
+    parts = [os.path.realpath(db_file)]
+    for path in [db_file, f"{db_file}-wal"]:
+        if os.path.exists(path):
+            st = os.stat(path)
+            parts.append(f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}")
+    with open(db_file, 'rb') as fp:
+        parts.append(fp.read(100)[24:28].hex())
+    return '|'.join(parts)
+
+
+def _tree_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def link_tree(src: str, dst: str) -> None:
+    """
+    Recreates a directory tree with hard links to its files, or copies where linking fails
+    (e.g. across file systems). Linked files share their content with the cache: replace them,
+    never edit them in place
+    :param src: Existing directory
+    :param dst: Directory to create
+    :return: None
+    """
+    for root, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for f in files:
+            try:
+                os.link(os.path.join(root, f), os.path.join(target, f))
+            except OSError:
+                shutil.copyfile(os.path.join(root, f), os.path.join(target, f))
+
+
+def cache_stats(cache_dir: str) -> typing.Dict[str, typing.Any]:
+    """
+    :param cache_dir: Export cache directory
+    :return: Number of entries and their size in GB
+    """
+    with ExportCache(cache_dir) as cache:
+        return cache.stats()
+
+
+def evict(cache_dir: str, max_gb: float = 10.0) -> int:
+    """
+    Removes the least recently used exports until the cache holds at most max_gb
+    :param cache_dir: Export cache directory
+    :param max_gb: Size limit, 0 empties the cache
+    :return: Number of removed exports
+    """
+    with ExportCache(cache_dir, max_gb=max_gb) as cache:
+        return cache.evict()
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'stats': cache_stats,
+        'evict': evict
+    })
@@ -0,0 +1,345 @@
+import os
+import re
+import gzip
+import mmap
+import struct
+import typing
+import numpy as np
+
+# Number of whitespace separated fields per line of each Kaldi table: (min, max), None for no max
+table_fields = {
+    'text': (1, None),
+    'wav.scp': (2, None),
+    'utt2spk': (2, 2),
+    'segments': (4, 4),
+    'feats.scp': (2, None),
+    'cmvn.scp': (2, None),
+    'spk2gender': (2, 2),
+    'utt2dur': (2, 2),
+    'reco2dur': (2, 2),
+}
+
+# feats.scp entry of a matrix in an ark: path:offset, optionally [rows] or [rows,cols] ranges
+feat_pattern = re.compile(r'(?P<ark>.+):(?P<offset>\d+)'
+                          r'(?:\[(?P<row_start>\d*):(?P<row_end>\d*)(?:,(?P<col_start>\d*):(?P<col_end>\d*))?\])?')
+
+# Plain files are decoded this many bytes at a time
+block_bytes = 1 << 22
+
+
+class KaldiTableError(ValueError):
+    """
+    Raised for a line of a Kaldi table that cannot be parsed
+    """
+    def __init__(self, file: str, line_no: int, message: str):
+        super().__init__(f"{file}:{line_no}: {message}")
+        self.file = file
+        self.line_no = line_no
+        self.message = message
+
+    def __reduce__(self):
+        # Raised in parser processes, so it must survive pickling
+        return type(self), (self.file, self.line_no, self.message)
+
+
+def table_path(data_dir: str, name: str) -> typing.Optional[str]:
+    """
+    Finds a Kaldi table in a data directory, either plain or gzipped
+    :param data_dir: Full path to Kaldi data directory
+    :param name: Table name, e.g. 'wav.scp'
+    :return: Full path to `name` or `name.gz`, None if neither exists
+    """
+    for path in (os.path.join(data_dir, name), os.path.join(data_dir, name + '.gz')):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def table_name(file: str) -> str:
+    """
+    :param file: Path to a Kaldi table, possibly gzipped
+    :return: Table name, e.g. 'wav.scp' for data/wav.scp.gz
+    """
+    name = os.path.basename(file)
+    return name[:-len('.gz')] if name.endswith('.gz') else name
+
+
+def table_chunks(file: str, chunk_bytes: int) -> typing.List[typing.Tuple[int, typing.Optional[int]]]:
+    """
+    Cuts a plain file into byte ranges of about chunk_bytes, ending at line ends, so they
+    can be parsed independently. Gzipped files cannot be cut and make a single range.
+    :param file: Kaldi table
+    :param chunk_bytes: Approximate size of every range
+    :return: [(start, end)], at least one range even for an empty file
+    """
+    if file.endswith('.gz'):
+        return [(0, None)]
+    size = os.path.getsize(file)
+    chunks = []
+    start = 0
+    with open(file, 'rb') as fp:
+        while start < size:
+            fp.seek(min(start + chunk_bytes, size))
+            fp.readline()
+            end = min(fp.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks if chunks else [(0, 0)]
+
+
+def _lines(file: str, start: int, end: typing.Optional[int]) -> typing.Iterator[str]:
+    """
+    Streams the lines of a byte range. Plain files are memory mapped and decoded a block at a time.
+    :param file: Kaldi table, possibly gzipped
+    :param start: First byte, at a line start
+    :param end: Last byte + 1 at a line end, None for the end of file
+    :return: Iterator over lines, without line ends
+    """
+    if file.endswith('.gz'):
+        if start != 0 or end is not None:
+            raise ValueError(f"{file} is gzipped and can only be read as a whole")
+        with gzip.open(file, 'rt', encoding='utf-8', newline='\n') as fp:
+            for line in fp:
+                yield line.rstrip('\n')
+        return
+
+    end = os.path.getsize(file) if end is None else end
+    if end <= start:
+        return
+    with open(file, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < end:
+            stop = mm.find(b'\n', min(start + block_bytes, end) - 1, end)
+            stop = end if stop < 0 else stop + 1
+            lines = mm[start:stop].decode('utf-8').split('\n')
+            if lines[-1] == '':
+                lines.pop()
+            yield from lines
+            start = stop
+
+
+def _line_number(file: str, start: int, index: int) -> int:
+    """
+    Turns the index of a line within a byte range into its line number in the file,
+    only computed when reporting an error
+    """
+    if start == 0:
+        return index + 1
+    with open(file, 'rb') as fp:
+        return fp.read(start).count(b'\n') + index + 1
+
+
+def read_table(file: str, *,
+               start: int = 0,
+               end: typing.Optional[int] = None) -> typing.Iterator[typing.Tuple[str, str]]:
+    """
+    Streams a Kaldi table, checking the number of fields of known tables (see table_fields).
+    Blank lines are skipped.
+    :param file: Kaldi table, possibly gzipped
+    :param start: First byte to read, from table_chunks
+    :param end: Last byte + 1 to read, from table_chunks
+    :return: Iterator over (index, rest of the line), the rest joined by single spaces
+    """
+    return _parse_lines(file, enumerate(_lines(file, start, end)), lambda i: _line_number(file, start, i))
+
+
+def _parse_lines(file: str,
+                 lines: typing.Iterable[typing.Tuple[int, str]],
+                 line_number: typing.Callable[[int], int]) -> typing.Iterator[typing.Tuple[str, str]]:
+    """
+    Splits lines of a Kaldi table into (index, rest of the line), checking their number of fields
+    :param file: Kaldi table the lines come from, for its name and error messages
+    :param lines: (index, line) pairs
+    :param line_number: Turns an index into a line number, only called when reporting an error
+    """
+    min_fields, max_fields = table_fields.get(table_name(file), (1, None))
+    for i, line in lines:
+        tokens = line.split()
+        if not tokens:
+            continue
+        if len(tokens) < min_fields or (max_fields is not None and len(tokens) > max_fields):
+            expected = min_fields if min_fields == max_fields else f"at least {min_fields}"
+            raise KaldiTableError(file, line_number(i),
+                                  f"expected {expected} fields, got {len(tokens)}: {line!r}")
+        yield tokens[0], ' '.join(tokens[1:])
+
+
+def diff_table(old_file: typing.Optional[str],
+               new_file: typing.Optional[str]) -> typing.Tuple[typing.List[typing.Tuple[str, str]],
+                                                               typing.List[typing.Tuple[str, str]]]:
+    """
+    Compares two versions of a Kaldi table line by line, and only splits and checks the lines
+    that differ, so small edits of large tables stay cheap
+    :param old_file: Earlier version of the table, None for none
+    :param new_file: Current version of the table, None for none
+    :return: Rows of the lines only in new_file, and rows of the lines only in old_file, as read_table.
+             A line that only changed its spacing is in both
+    """
+    old_lines = list(_lines(old_file, 0, None)) if old_file is not None else []
+    new_lines = list(_lines(new_file, 0, None)) if new_file is not None else []
+    old_set, new_set = set(old_lines), set(new_lines)
+    added = [(i, line) for i, line in enumerate(new_lines) if line not in old_set]
+    removed = [(i, line) for i, line in enumerate(old_lines) if line not in new_set]
+    return (list(_parse_lines(new_file, added, lambda i: i + 1)) if added else [],
+            list(_parse_lines(old_file, removed, lambda i: i + 1)) if removed else [])
+
+
+def read_keys(file: str, num_fields: int = 1) -> typing.List[np.ndarray]:
+    """
+    Reads the first fields of every line of a Kaldi table as byte strings, for vectorized
+    checks. Byte strings compare like `sort` in the C locale, which Kaldi expects tables to follow.
+    Blank lines are skipped.
+    :param file: Kaldi table, possibly gzipped
+    :param num_fields: Number of leading fields to read, e.g. 2 for the utt_id and spk_id of utt2spk
+    :return: One array per field, in file order
+    """
+    columns = [[] for _ in range(num_fields)]
+    with (gzip.open(file, 'rb') if file.endswith('.gz') else open(file, 'rb')) as fp:
+        for line_no, line in enumerate(fp, 1):
+            tokens = line.split(None, num_fields)
+            if not tokens:
+                continue
+            if len(tokens) < num_fields:
+                raise KaldiTableError(file, line_no, f"expected at least {num_fields} fields, got {len(tokens)}")
+            for column, token in zip(columns, tokens):
+                column.append(token)
+    return [np.array(column, dtype=np.bytes_) for column in columns]
+
+
+def segments_source(data_dir: str) -> typing.Tuple[str, bool]:
+    """
+    :param data_dir: Full path to Kaldi data directory
+    :return: The table read_segments reads: segments if there is one, else text, and whether
+             the segments are virtual
+    """
+    segments = table_path(data_dir, 'segments')
+    if segments is not None:
+        return segments, False
+    return table_path(data_dir, 'text'), True
+
+
+def read_segments(file: str,
+                  virtual: bool = False, *,
+                  start: int = 0,
+                  end: typing.Optional[int] = None) -> typing.Iterator[typing.Tuple[str, str, str, str]]:
+    """
+    Streams segments. Without a segments file, every utterance of text is a whole recording
+    of the same id, marked by start and end times of -1.0; nothing is written to the data dir.
+    :param file: segments, or text when virtual (see segments_source)
+    :param virtual: Derive the segments from text
+    :param start: First byte to read, from table_chunks
+    :param end: Last byte + 1 to read, from table_chunks
+    :return: Iterator over (utt_id, reco_id, start_time, end_time), times as in the file
+    """
+    for utt_id, segment in read_table(file, start=start, end=end):
+        yield parse_segment(utt_id, segment, virtual)
+
+
+def parse_segment(utt_id: str, segment: str, virtual: bool = False) -> typing.Tuple[str, str, str, str]:
+    """
+    :param utt_id: Index of a row of segments, or of text when virtual
+    :param segment: Rest of the row, as read_table returns it
+    :param virtual: The row is from text, see read_segments
+    :return: (utt_id, reco_id, start_time, end_time)
+    """
+    if virtual:
+        return utt_id, utt_id, '-1.0', '-1.0'
+    reco_id, start_time, end_time = segment.split()
+    return utt_id, reco_id, start_time, end_time
+
+
+def wav_file(wav: str) -> typing.Optional[str]:
+    """
+    :param wav: wav.scp entry of a recording
+    :return: The file it names, None for piped commands and other entries that need running
+    """
+    tokens = wav.split()
+    if len(tokens) != 1 or tokens[0].endswith('|') or tokens[0] == '-':
+        return None
+    return tokens[0]
+
+
+def wav_duration(file: str) -> float:
+    """
+    Computes the duration of a RIFF/WAV (or RF64) file from its headers, without reading samples
+    :param file: Path to the wav file
+    :return: Seconds of audio
+    """
+    with open(file, 'rb') as fp:
+        riff = fp.read(12)
+        if len(riff) < 12 or riff[:4] not in (b'RIFF', b'RF64') or riff[8:12] != b'WAVE':
+            raise ValueError(f"{file} is not a RIFF/WAVE file")
+        byte_rate = None
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{file} has no data chunk")
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = fp.read(size + size % 2)
+                if len(fmt) < 12:
+                    raise ValueError(f"{file} has a truncated fmt chunk")
+                byte_rate = struct.unpack_from('<I', fmt, 8)[0]
+            elif chunk_id == b'data':
+                if not byte_rate:
+                    raise ValueError(f"{file} has no usable fmt chunk before its data")
+                # Streamed and RF64 files leave the size open; truncated files hold less than declared
+                remaining = os.fstat(fp.fileno()).st_size - fp.tell()
+                return (remaining if size == 0xFFFFFFFF else min(size, remaining)) / byte_rate
+            else:
+                fp.seek(size + size % 2, os.SEEK_CUR)
+
+
+def feat_location(feat: str) -> typing.Optional[typing.Tuple[str, int, typing.Dict[str, int]]]:
+    """
+    Splits a feats.scp entry into the ark and offset of its matrix
+    :param feat: feats.scp entry, e.g. 'raw_mfcc.1.ark:12345' or 'raw_mfcc.1.ark:12345[0:99]'
+    :return: ark path, byte offset, and the row/column range bounds it sets
+             (row_start, row_end, col_start, col_end, inclusive), None if feat is not an ark offset
+    """
+    match = feat_pattern.fullmatch(feat.strip())
+    if not match:
+        return None
+    ranges = {k: int(v) for k, v in match.groupdict().items()
+              if k not in ('ark', 'offset') and v}
+    return match['ark'], int(match['offset']), ranges
+
+
+def matrix_shape(buffer, offset: int) -> typing.Tuple[int, int]:
+    """
+    Reads the shape of a binary Kaldi matrix from its header, plain (FM, DM) or compressed (CM, CM2, CM3)
+    :param buffer: Contents of an ark, e.g. an mmap
+    :param offset: Position of the matrix, right after its key
+    :return: Number of rows and columns
+    """
+    if buffer[offset:offset + 2] != b'\0B':
+        raise ValueError(f"No binary Kaldi object at offset {offset}")
+    token_end = buffer.find(b' ', offset + 2, offset + 8)
+    if token_end < 0:
+        raise ValueError(f"No Kaldi matrix token at offset {offset}")
+    token = bytes(buffer[offset + 2:token_end])
+    if token in (b'FM', b'DM'):
+        size_rows, rows, size_cols, cols = struct.unpack_from('<bibi', buffer, token_end + 1)
+        if size_rows != 4 or size_cols != 4:
+            raise ValueError(f"Unexpected matrix header at offset {offset}")
+    elif token in (b'CM', b'CM2', b'CM3'):
+        _, _, rows, cols = struct.unpack_from('<ffii', buffer, token_end + 1)
+    else:
+        raise ValueError(f"{token!r} at offset {offset} is not a matrix")
+    return rows, cols
+
+
+def ark_shapes(ark: str, offsets: typing.List[int]) -> typing.List[typing.Optional[typing.Tuple[int, int]]]:
+    """
+    Reads the shapes of many matrices of one ark, mapping it once and visiting the offsets in file order
+    :param ark: Path to the ark
+    :param offsets: Positions of the matrices
+    :return: (rows, columns) at each offset, in the order of offsets; None for unreadable headers
+    """
+    shapes = [None] * len(offsets)
+    with open(ark, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in sorted(range(len(offsets)), key=offsets.__getitem__):
+            try:
+                shapes[i] = matrix_shape(mm, offsets[i])
+            except (ValueError, struct.error):
+                pass
+    return shapes
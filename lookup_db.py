@@ -0,0 +1,164 @@
+import os
+import fire
+import typing
+import sqlite3
+import threading
+import collections
+import urllib.request
+
+from setup_db import db_path, apply_pragmas
+
+UtteranceInfo = collections.namedtuple('UtteranceInfo', ['utt_id', 'feat', 'text', 'speaker', 'duration'])
+
+# Unsegmented utterances are their whole recording, and take its duration when they have none
+lookup_query = '''
+    SELECT u."utt_id", u."feat", t."text", u."speaker",
+           COALESCE(u."duration", CASE WHEN NOT u."is_segment" THEN r."duration" END)
+    FROM "Utterance" u
+    JOIN "Sentence" t ON t."sent_id" = u."transcript"
+    LEFT JOIN "Recording" r ON r."reco_id" = u."recording"
+    WHERE u."utt_id" IN ({})'''
+
+# Memory mapped reads share the page cache between worker processes
+lookup_pragmas = {
+    'mmap_size': 1 << 28,
+    'cache_size': -65536
+}
+
+# Most ids bound by one statement. Batches are padded to a power of two up to this, so a few
+# prepared statements serve every batch size
+max_batch = 512
+
+# Cached result of an id that is not in the db
+_missing = object()
+
+
+class UtteranceLookup:
+    """
+    Read-only, batched utt_id -> UtteranceInfo lookups for data loaders, with a bounded LRU cache.
+    Uses its own read-only sqlite connection, opened on first use in every process: instances can be
+    created before a DataLoader forks its workers, or pickled to spawned ones (without their cache).
+    Thread safe.
+    """
+
+    def __init__(self, db_file: str,
+                 cache_size: int = 100000,
+                 immutable: bool = False):
+        """
+        :param db_file: Full path to a sqlite db_file
+        :param cache_size: Number of utterances kept in the LRU cache, 0 disables it
+        :param immutable: Promise sqlite that nobody writes to the db while it is read, which skips
+                          file locking. Results are undefined if the db does change
+        """
+        self.db_file = db_path(db_file)
+        if not os.path.exists(self.db_file):
+            raise ValueError(f"{db_file} does not exist")
+        self.cache_size = cache_size
+        self.immutable = immutable
+        self._reset()
+
+    def _reset(self) -> None:
+        self._conn = None
+        self._pid = None
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self) -> typing.Dict[str, typing.Any]:
+        return {'db_file': self.db_file, 'cache_size': self.cache_size, 'immutable': self.immutable}
+
+    def __setstate__(self, state: typing.Dict[str, typing.Any]) -> None:
+        self.__dict__.update(state)
+        self._reset()
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection must not cross a fork, so a forked worker opens its own
+        if self._pid != os.getpid():
+            uri = f"file:{urllib.request.pathname2url(self.db_file)}?mode=ro" + ('&immutable=1' if self.immutable else '')
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            apply_pragmas(self._conn, lookup_pragmas)
+            self._pid = os.getpid()
+            self._cache.clear()
+        return self._conn
+
+    def _fetch(self, utt_ids: typing.List[str]) -> typing.Dict[str, UtteranceInfo]:
+        conn = self._connection()
+        found = {}
+        for start in range(0, len(utt_ids), max_batch):
+            batch = utt_ids[start:start + max_batch]
+            size = 1 << (len(batch) - 1).bit_length()
+            # Padding repeats an id, which IN ignores
+            params = batch + [batch[-1]] * (size - len(batch))
+            for row in conn.execute(lookup_query.format(', '.join('?' * size)), params):
+                found[row[0]] = UtteranceInfo._make(row)
+        return found
+
+    def get_many(self, utt_ids: typing.Sequence[str]) -> typing.List[typing.Optional[UtteranceInfo]]:
+        """
+        Looks up a batch of utterances, with one query per max_batch ids not in the cache
+        :param utt_ids: Utterance ids, duplicates allowed
+        :return: UtteranceInfo of every id, in order, None for ids not in the db
+        """
+        with self._lock:
+            self._connection()
+            cache = self._cache
+            results = [cache.get(utt_id) for utt_id in utt_ids]
+            todo = list(dict.fromkeys(utt_id for utt_id, r in zip(utt_ids, results) if r is None))
+            self.misses += len(todo)
+            self.hits += len(utt_ids) - len(todo)
+            if todo:
+                found = self._fetch(todo)
+                for utt_id in todo:
+                    cache[utt_id] = found.get(utt_id, _missing)
+                results = [cache[utt_id] if r is None else r for utt_id, r in zip(utt_ids, results)]
+            if self.cache_size:
+                for utt_id in utt_ids:
+                    cache.move_to_end(utt_id)
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+            else:
+                cache.clear()
+        return [None if r is _missing else r for r in results]
+
+    def __getitem__(self, utt_id: str) -> UtteranceInfo:
+        info = self.get_many([utt_id])[0]
+        if info is None:
+            raise KeyError(utt_id)
+        return info
+
+    def close(self) -> None:
+        """
+        Closes the connection of this process, and empties the cache
+        :return: None
+        """
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+            self._pid = None
+            self._cache.clear()
+
+
+def lookup(db_file: str, utt_ids: typing.Union[str, int, typing.Sequence[typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """
+    Prints the feat, transcript, speaker and duration of utterances
+    :param db_file: Full path to a sqlite db_file
+    :param utt_ids: Utterance ids, e.g. --utt_ids utt1,utt2
+    :return: utt_id -> fields, None for unknown ids
+    """
+    # fire passes numeric ids as ints
+    if isinstance(utt_ids, str):
+        utt_ids = utt_ids.split(',')
+    else:
+        utt_ids = [str(u) for u in (utt_ids if isinstance(utt_ids, (list, tuple)) else [utt_ids])]
+    table = UtteranceLookup(db_file, cache_size=0)
+    try:
+        return {utt_id: None if info is None else info._asdict()
+                for utt_id, info in zip(utt_ids, table.get_many(utt_ids))}
+    finally:
+        table.close()
+
+
+if __name__ == '__main__':
+    fire.Fire(lookup)
@@ -0,0 +1,150 @@
+import fire
+import time
+import typing
+from pony.orm import *
+
+from setup_db import bind_db
+from db2data import db2data
+
+
+def _as_list(value: typing.Union[None, str, int, typing.Sequence[typing.Any]]) -> typing.List[str]:
+    """
+    :param value: One value, several values (e.g. --speaker spk1,spk2), or None. fire passes numeric ids
+                  as ints and keeps values like spk-1,spk-2 as one string
+    :return: Values as a list of strings, empty for None
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.split(',')
+    return [str(v) for v in (value if isinstance(value, (list, tuple)) else [value])]
+
+
+def utterance_selection(*, min_duration: float = None,
+                        max_duration: float = None,
+                        speaker: typing.Union[str, typing.Sequence[str]] = None,
+                        corpus: typing.Union[str, typing.Sequence[str]] = None,
+                        min_length: int = None,
+                        max_length: int = None,
+                        is_segment: bool = None,
+                        max_hours: float = None) -> typing.Tuple[str, typing.List[typing.Any]]:
+    """
+    Builds a query of the utt_ids matching all given filters. Every filter maps to an indexed
+    column: Utterance.duration, the Utterance.speaker foreign key and Recording.corpus.
+    :param min_duration: Minimal utterance duration, in seconds
+    :param max_duration: Maximal utterance duration, in seconds
+    :param speaker: Speaker(s) to keep
+    :param corpus: Corpus/corpora to keep
+    :param min_length: Minimal number of words of the transcript
+    :param max_length: Maximal number of words of the transcript
+    :param is_segment: Keep only segments (True) or only whole recordings (False)
+    :param max_hours: Keep matching utterances in utt_id order until they add up to this many hours
+    :return: SQL returning one utt_id column, and its parameters
+    """
+    joins = []
+    conditions = []
+    params = []
+    if min_duration is not None:
+        conditions.append('u."duration" >= ?')
+        params.append(min_duration)
+    if max_duration is not None:
+        conditions.append('u."duration" <= ?')
+        params.append(max_duration)
+    speakers = _as_list(speaker)
+    if speakers:
+        conditions.append(f'u."speaker" IN ({", ".join("?" * len(speakers))})')
+        params += speakers
+    corpora = _as_list(corpus)
+    if corpora:
+        joins.append('JOIN "Recording" r ON r."reco_id" = u."recording"')
+        conditions.append(f'r."corpus" IN ({", ".join("?" * len(corpora))})')
+        params += corpora
+    if min_length is not None or max_length is not None:
+        joins.append('JOIN "Sentence" t ON t."sent_id" = u."transcript"')
+        if min_length is not None:
+            conditions.append('t."length" >= ?')
+            params.append(min_length)
+        if max_length is not None:
+            conditions.append('t."length" <= ?')
+            params.append(max_length)
+    if is_segment is not None:
+        conditions.append('u."is_segment" = ?')
+        params.append(1 if is_segment else 0)
+
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    if max_hours is None:
+        return f'SELECT u."utt_id" FROM "Utterance" u {" ".join(joins)} {where}', params
+    # Running total over the matching utterances; utterances without a duration count as 0
+    return (f'SELECT "utt_id" FROM (SELECT u."utt_id", SUM(COALESCE(u."duration", 0)) OVER '
+            f'(ORDER BY u."utt_id") AS "total" FROM "Utterance" u {" ".join(joins)} {where}) '
+            f'WHERE "total" <= ?', params + [max_hours * 3600])
+
+
+def select_utterances(db, **filters) -> typing.Dict[str, typing.Any]:
+    """
+    Counts the utterances matching the filters of utterance_selection. Must be called inside a db_session.
+    :param db: Database bound to a sqlite db
+    :param filters: Keyword arguments of utterance_selection
+    :return: Number of utterances and their hours of audio
+    """
+    sql, params = utterance_selection(**filters)
+    num_utts, seconds = db.get_connection().execute(
+        f'SELECT COUNT(*), SUM(u."duration") FROM "Utterance" u WHERE u."utt_id" IN ({sql})', params).fetchone()
+    return {'utterances': num_utts, 'hours': (seconds or 0.0) / 3600}
+
+
+def query_db(db_file: str,
+             data_dir: str = None,
+             min_duration: float = None,
+             max_duration: float = None,
+             speaker: typing.Union[str, typing.Sequence[str]] = None,
+             corpus: typing.Union[str, typing.Sequence[str]] = None,
+             min_length: int = None,
+             max_length: int = None,
+             is_segment: bool = None,
+             max_hours: float = None,
+             chunk_size: int = 10000) -> typing.Dict[str, typing.Any]:
+    """
+    Selects utterances with filters evaluated by sqlite, and optionally exports them
+    (with the recordings, speakers and sentences they use) as a Kaldi-style directory
+    :param db_file: Full path to a sqlite db_file
+    :param data_dir: Kaldi-style directory to write the selection to, default: only count
+    :param min_duration: Minimal utterance duration, in seconds
+    :param max_duration: Maximal utterance duration, in seconds
+    :param speaker: Speaker(s) to keep, e.g. --speaker spk1,spk2
+    :param corpus: Corpus/corpora to keep
+    :param min_length: Minimal number of words of the transcript
+    :param max_length: Maximal number of words of the transcript
+    :param is_segment: Keep only segments (True) or only whole recordings (False)
+    :param max_hours: Keep matching utterances in utt_id order until they add up to this many hours
+    :param chunk_size: Rows fetched at a time while exporting
+    :return: Number of utterances and their hours of audio
+    """
+    filters = dict(min_duration=min_duration,
+                   max_duration=max_duration,
+                   speaker=speaker,
+                   corpus=corpus,
+                   min_length=min_length,
+                   max_length=max_length,
+                   is_segment=is_segment,
+                   max_hours=max_hours)
+    start = time.time()
+    db = bind_db(db_file)
+    with db_session:
+        selected = select_utterances(db, **filters)
+    print(f"Selected {selected['utterances']} utterances, {selected['hours']:.2f} hours "
+          f"in {time.time() - start:.2f}s")
+
+    if data_dir is not None:
+        start = time.time()
+        db2data(db_file=db_file,
+                data_dir=data_dir,
+                engine='stream',
+                chunk_size=chunk_size,
+                selection=utterance_selection(**filters))
+        print(f"Exported to {data_dir} in {time.time() - start:.2f}s")
+    return selected
+
+
+if __name__ == '__main__':
+    fire.Fire(query_db)
@@ -1,14 +1,222 @@
+import os
 import typing
+import sqlite3
+import hashlib
 from pony.orm import *
 
+# SQLite settings for loading data that can be rebuilt from its source: no fsync,
+# WAL journal, 256MB page cache, temp b-trees in memory.
+fast_ingest_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY'
+}
 
-def setup_db():
+# Restored by end_fast_ingest. Only journal_mode is stored in the db file; synchronous, cache_size
+# and temp_store end with the connections that set them
+restored_pragmas = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL'
+}
+
+# Columns added to the schema over time: (table, column, sql definition, backfill expression, indexed)
+schema_upgrades = [
+    ('Sentence', 'text_hash', "TEXT NOT NULL DEFAULT ''", 'text_hash("text")', True),
+    ('Utterance', 'num_frames', 'INTEGER', None, False),
+    ('Utterance', 'feat_dim', 'INTEGER', None, False)
+]
+
+# Databases returned by bind_db: (provider, file, fast_ingest) -> (Database, (st_dev, st_ino) of the sqlite file)
+_bound = {}
+
+# Indexes added to existing columns over time: (table, column)
+index_upgrades = [
+    ('Utterance', 'duration'),
+    ('Recording', 'corpus')
+]
+
+
+def apply_pragmas(connection,
+                  pragmas: typing.Dict[str, typing.Any],
+                  schema: str = None) -> None:
+    """
+    Sets sqlite pragmas on a connection
+    :param connection: sqlite3 connection
+    :param pragmas: pragma -> value
+    :param schema: Attached database the pragmas apply to, default: main
+    :return: None
+    """
+    prefix = f"{schema}." if schema else ''
+    cursor = connection.cursor()
+    for pragma, value in pragmas.items():
+        cursor.execute(f"PRAGMA {prefix}{pragma} = {value}")
+
+
+def sqlite_connect(db) -> sqlite3.Connection:
+    """
+    Opens a separate autocommit connection to the sqlite file a Database is bound to,
+    for statements Pony cannot issue inside its own transactions (ATTACH, PRAGMA).
+    :param db: Database bound with provider='sqlite'
+    :return: sqlite3 connection
+    """
+    return sqlite3.connect(db.provider.pool.filename, isolation_level=None)
+
+
+def text_hash(text: str) -> str:
+    """
+    Hashes a transcript for Sentence.text_hash, so duplicates can be found through an
+    index instead of comparing full texts
+    :param text: Transcript
+    :return: 16 hex digits
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def upgrade_schema(db) -> None:
+    """
+    Adds the columns and indexes introduced after a sqlite db was created, so it
+    can be mapped and queried by the current setup_db. Call after bind and before generate_mapping.
+    :param db: Database bound with provider='sqlite'
+    :return: None
+    """
+    if db.provider_name != 'sqlite':
+        return
+    conn = sqlite_connect(db)
+    try:
+        conn.create_function('text_hash', 1, text_hash, deterministic=True)
+        for table, column, definition, backfill, index in schema_upgrades:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+            if not columns or column in columns:
+                continue
+            conn.execute('BEGIN')
+            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+            if backfill:
+                conn.execute(f'UPDATE "{table}" SET "{column}" = {backfill}')
+            if index:
+                conn.execute(f'CREATE INDEX "idx_{table.lower()}__{column}" ON "{table}" ("{column}")')
+            conn.execute('COMMIT')
+        for table, column in index_upgrades:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+            if column in columns:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table.lower()}__{column}" ON "{table}" ("{column}")')
+    finally:
+        conn.close()
+
+
+def db_path(db_file: str) -> str:
+    """
+    The file Pony opens for a sqlite db_file: relative paths are resolved against the directory
+    of these modules, not the working directory
+    :param db_file: Path given to the tools
+    :return: Absolute path
+    """
+    if db_file == ':memory:':
+        return db_file
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.expanduser(db_file))
+
+
+def _file_id(path: str) -> typing.Optional[typing.Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def bind_db(db_file: str,
+            db_provider: str = 'sqlite',
+            create_db: bool = False,
+            fast_ingest: bool = False):
+    """
+    Defines the entities on a Database, binds it, upgrades its schema and generates the mapping,
+    once per process and file: later calls return the same Database and its open connection, so
+    in-process callers neither redo this work nor pile up connections. A sqlite file that was
+    removed or replaced since it was bound is bound again.
+    :param db_file: Full path to db_file
+    :param db_provider: db type.
+    :param create_db: Create the db and its tables if they do not exist
+    :param fast_ingest: Apply fast_ingest_pragmas to every sqlite connection, see setup_db
+    :return: Database with its mapping generated
+    """
+    path = db_path(db_file) if db_provider == 'sqlite' else db_file
+    key = (db_provider, path, fast_ingest)
+    file_id = _file_id(path) if db_provider == 'sqlite' else None
+    if key in _bound:
+        db, bound_id = _bound[key]
+        if bound_id == file_id:
+            return db
+        release_db(db_file, db_provider)
+    db = setup_db(fast_ingest=fast_ingest)
+    db.bind(provider=db_provider,
+            filename=path,
+            create_db=create_db)
+    upgrade_schema(db)
+    db.generate_mapping(create_tables=create_db)
+    _bound[key] = (db, _file_id(path) if db_provider == 'sqlite' else None)
+    return db
+
+
+def release_db(db_file: str = None, db_provider: str = 'sqlite') -> None:
+    """
+    Closes the connections of Databases returned by bind_db and forgets them
+    :param db_file: Only this db, default: all
+    :param db_provider: db type.
+    :return: None
+    """
+    path = None if db_file is None else db_path(db_file) if db_provider == 'sqlite' else db_file
+    for key in [k for k in _bound if db_file is None or k[:2] == (db_provider, path)]:
+        db, _ = _bound.pop(key)
+        db.disconnect()
+
+
+def end_fast_ingest(db_file: str, db_provider: str = 'sqlite') -> None:
+    """
+    Finishes a load with fast_ingest_pragmas: closes the connections bind_db opened to the db and
+    switches its file back from WAL to a rollback journal, which checkpoints the WAL into it.
+    Must be called outside of a db_session.
+    :param db_file: Full path to db_file
+    :param db_provider: db type, other than sqlite nothing is done
+    :return: None
+    """
+    if db_provider != 'sqlite':
+        return
+    release_db(db_file, db_provider)
+    conn = sqlite3.connect(db_path(db_file))
+    try:
+        apply_pragmas(conn, restored_pragmas)
+    finally:
+        conn.close()
+
+
+def release_session() -> None:
+    """
+    Commits the current db_session and drops Pony's identity map, so a long
+    running session only holds the entities of the current chunk.
+    :return: None
+    """
+    commit()
+    rollback()
+
+
+def setup_db(fast_ingest: bool = False):
+    """
+    Defines all entities on a new, unbound Database.
+    :param fast_ingest: Apply fast_ingest_pragmas to every sqlite connection
+    :return: Database
+    """
     db = Database()
 
+    if fast_ingest:
+        @db.on_connect(provider='sqlite')
+        def _apply_fast_ingest_pragmas(_, connection):
+            apply_pragmas(connection, fast_ingest_pragmas)
+
     class Sentence(db.Entity):
         sent_id = PrimaryKey(str)
         text = Required(str)
         length = Required(int)
+        text_hash = Optional(str, index=True)
 
         utterances = Set("Utterance", reverse='transcript')
 
@@ -18,13 +226,15 @@ def setup_db():
             if field == 'text':
                 self.text = value
                 self.length = len(self.text.strip().split())
+                self.text_hash = text_hash(value)
             else:
                 raise ValueError(f"Entity Sentence cannot update {field}")
 
         def make_copy(self, new_db):
             return new_db.Sentence(sent_id=self.sent_id,
                                    text=self.text,
-                                   length=self.length)
+                                   length=self.length,
+                                   text_hash=self.text_hash)
 
     class Speaker(db.Entity):
         spk_id = PrimaryKey(str)
@@ -47,11 +257,14 @@ def setup_db():
             return ' '.join(sorted(list(u.utt_id for u in self.utterances)))
 
         def to_file(self) -> typing.Dict[str, str]:
-            return {
-                'spk2gender': f"{self.spk_id} {self.gender}\n",
-                'cmvn.scp': f"{self.spk_id} {self.cmvn}\n",
-                'spk2utt': f"{self.spk_id} {self.get_utt_in_str()}\n"
-            }
+            # spk2utt is written by db2data from one ordered scan over all speakers,
+            # get_utt_in_str would cost one query per speaker.
+            lines = {}
+            if self.gender:
+                lines['spk2gender'] = f"{self.spk_id} {self.gender}\n"
+            if self.cmvn:
+                lines['cmvn.scp'] = f"{self.spk_id} {self.cmvn}\n"
+            return lines
 
         def make_copy(self, new_db):
             return new_db.Speaker(spk_id=self.spk_id,
@@ -62,7 +275,7 @@ def setup_db():
         reco_id = PrimaryKey(str)
         wav = Required(str)
 
-        corpus = Optional(str)
+        corpus = Optional(str, index=True)
         duration = Optional(float)
 
         utterances = Set("Utterance", reverse='recording')
@@ -96,7 +309,11 @@ def setup_db():
         transcript = Required(Sentence, cascade_delete=False)
         speaker = Required(Speaker, cascade_delete=False)
 
-        duration = Optional(float)
+        duration = Optional(float, index=True)
+
+        # Shape of the feature matrix, read from the ark header (see data2db --index_feats)
+        num_frames = Optional(int)
+        feat_dim = Optional(int)
 
         # Used if utterance is a segment
         start_time = Optional(float)
@@ -105,6 +322,8 @@ def setup_db():
 
         def update(self, field: str, value: str):
             if field == 'feat':
+                if value != self.feat:
+                    self.num_frames = self.feat_dim = None
                 self.feat = value
             elif field == 'duration':
                 self.duration = float(value)
@@ -114,13 +333,16 @@ def setup_db():
         def to_file(self):
             lines = {
                 'text': f"{self.utt_id} {self.transcript.text}\n",
-                'utt2spk': f"{self.utt_id} {self.speaker.spk_id}\n",
-                'feats.scp': f"{self.utt_id} {self.feat}\n"
+                'utt2spk': f"{self.utt_id} {self.speaker.spk_id}\n"
             }
+            if self.feat:
+                lines['feats.scp'] = f"{self.utt_id} {self.feat}\n"
             if self.is_segment:
                 lines['segments'] = f"{self.utt_id} {self.recording.reco_id} {self.start_time} {self.end_time}\n"
             if self.duration:
                 lines['utt2dur'] = f"{self.utt_id} {self.duration}\n"
+            if self.num_frames is not None:
+                lines['utt2num_frames'] = f"{self.utt_id} {self.num_frames}\n"
             return lines
 
         def make_copy(self, new_db):
@@ -136,6 +358,8 @@ def setup_db():
                                        transcript=new_db.Sentence[self.transcript.sent_id],
                                        feat=self.feat,
                                        duration=self.duration,
+                                       num_frames=self.num_frames,
+                                       feat_dim=self.feat_dim,
                                        start_time=self.start_time,
                                        end_time=self.end_time,
                                        is_segment=self.is_segment)
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import fire
+import shutil
+import typing
+import sqlite3
+import urllib.request
+import numpy as np
+
+from setup_db import setup_db, bind_db, db_path, sqlite_connect
+
+# Bumped whenever the layout of snapshot.json or the column files changes
+snapshot_format = 1
+
+# NULL of nullable int columns; float columns use NaN
+int_null = -1
+
+
+class StringColumn:
+    """
+    Column of strings held as one utf-8 byte pool and the offsets of every string in it,
+    so both arrays can be memory mapped
+    """
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def take(self, indices: typing.Sequence[int]) -> typing.List[str]:
+        """
+        :param indices: Rows to read
+        :return: Strings of the rows, in the order of indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if not len(indices):
+            return []
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        first, last = int(starts.min()), int(ends.max())
+        pool = self.data[first:last].tobytes()
+        return [pool[s:e].decode('utf-8') for s, e in zip((starts - first).tolist(), (ends - first).tolist())]
+
+    def lengths(self) -> np.ndarray:
+        """
+        :return: Length of every string, in bytes
+        """
+        return np.diff(self.offsets)
+
+    def index(self, value: str) -> int:
+        """
+        Binary search for a value of a column sorted like sqlite sorts TEXT, e.g. a primary key
+        :param value: String to find
+        :return: Row of value
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self) or self[lo] != value:
+            raise KeyError(value)
+        return lo
+
+
+def snapshot_schema(db) -> typing.Dict[str, typing.Dict[str, str]]:
+    """
+    Derives the snapshot columns of every entity of setup_db, in an order where
+    referenced tables come first
+    :param db: Database from setup_db, bound or not
+    :return: table -> column -> kind: 'str', 'float', 'int', 'bool', or 'ref:<table>' for
+             foreign keys, stored as the row of the referenced entity
+    """
+    kinds = {str: 'str', float: 'float', int: 'int', bool: 'bool'}
+    schema = {}
+    for name, entity in db.entities.items():
+        columns = {}
+        for attr in entity._attrs_:
+            if attr.is_collection:
+                continue
+            if attr.py_type in db.entities.values():
+                columns[attr.name] = f"ref:{attr.py_type.__name__}"
+            else:
+                columns[attr.name] = kinds[attr.py_type]
+        schema[name] = columns
+    return schema
+
+
+def _primary_key(db, table: str) -> str:
+    return db.entities[table]._pk_attrs_[0].name
+
+
+class _StringWriter:
+    """
+    Writes chunks of strings as <path>.offsets.npy and <path>.bytes.npy, streaming the bytes
+    through a temporary file so the pool never has to fit in memory
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = [np.zeros(1, dtype=np.int64)]
+        self.size = 0
+        self.fp = open(f"{path}.bytes.tmp", 'wb')
+
+    def write(self, values: typing.Sequence[str]) -> None:
+        encoded = [v.encode('utf-8') for v in values]
+        ends = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))) + self.size
+        self.fp.write(b''.join(encoded))
+        self.offsets.append(ends)
+        if len(ends):
+            self.size = int(ends[-1])
+
+    def close(self) -> None:
+        self.fp.close()
+        np.save(f"{self.path}.offsets.npy", np.concatenate(self.offsets))
+        with open(f"{self.path}.bytes.npy", 'wb') as out, open(f"{self.path}.bytes.tmp", 'rb') as fp:
+            np.lib.format.write_array_header_1_0(out, {'descr': '|u1', 'fortran_order': False, 'shape': (self.size,)})
+            shutil.copyfileobj(fp, out)
+        os.remove(f"{self.path}.bytes.tmp")
+
+
+def _to_array(values: typing.Sequence, kind: str) -> np.ndarray:
+    if kind == 'float':
+        return np.array(values, dtype=np.float64)
+    if kind == 'int':
+        return np.array([int_null if v is None else v for v in values], dtype=np.int64)
+    if kind == 'bool':
+        return np.array(values, dtype=np.bool_)
+    return np.array(values, dtype=np.int32)
+
+
+def db2snapshot(db_file: str,
+                snapshot_dir: str,
+                chunk_size: int = 100000) -> typing.Dict[str, int]:
+    """
+    Exports a sqlite db as a columnar snapshot: one .npy per column of every table, rows ordered by
+    primary key. Strings are stored as offsets + byte pool, foreign keys as rows of the referenced table,
+    NULL as NaN (float) or -1 (int). The db is only read.
+    :param db_file: Full path to a sqlite db_file
+    :param snapshot_dir: Directory to write the snapshot to
+    :param chunk_size: Rows fetched at a time
+    :return: Number of rows of every table
+    """
+    start = time.time()
+    db = setup_db()
+    schema = snapshot_schema(db)
+    conn = sqlite3.connect(f"file:{urllib.request.pathname2url(db_path(db_file))}?mode=ro", uri=True)
+    rows = {}
+    try:
+        for table in schema:
+            pk = _primary_key(db, table)
+            conn.execute(f'CREATE TEMP TABLE "{table}_row" ("id" TEXT PRIMARY KEY, "row" INTEGER) WITHOUT ROWID')
+            conn.execute(f'INSERT INTO temp."{table}_row" '
+                         f'SELECT "{pk}", ROW_NUMBER() OVER (ORDER BY "{pk}") - 1 FROM "{table}"')
+
+        for table, columns in schema.items():
+            pk = _primary_key(db, table)
+            table_dir = os.path.join(snapshot_dir, table)
+            os.makedirs(table_dir, exist_ok=True)
+            present = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+            selects, joins = [], []
+            for column, kind in columns.items():
+                if kind.startswith('ref:'):
+                    selects.append(f'"{column}_row"."row"')
+                    joins.append(f'JOIN temp."{kind[4:]}_row" "{column}_row" ON "{column}_row"."id" = t."{column}"')
+                elif column in present:
+                    selects.append(f't."{column}"')
+                else:
+                    # Column added by a later schema_upgrades than the db has seen
+                    selects.append("''" if kind == 'str' else 'NULL')
+            cursor = conn.execute(f'SELECT {", ".join(selects)} FROM "{table}" t {" ".join(joins)} '
+                                  f'ORDER BY t."{pk}"')
+
+            names = list(columns)
+            strings = {column: _StringWriter(os.path.join(table_dir, column))
+                       for column, kind in columns.items() if kind == 'str'}
+            arrays = {column: [] for column, kind in columns.items() if kind != 'str'}
+            num_rows = 0
+            for chunk in iter(lambda: cursor.fetchmany(chunk_size), []):
+                num_rows += len(chunk)
+                for column, values in zip(names, zip(*chunk)):
+                    if column in strings:
+                        strings[column].write(values)
+                    else:
+                        arrays[column].append(_to_array(values, columns[column]))
+            for writer in strings.values():
+                writer.close()
+            for column, chunks in arrays.items():
+                array = np.concatenate(chunks) if chunks else _to_array([], columns[column])
+                np.save(os.path.join(table_dir, f"{column}.npy"), array)
+            rows[table] = num_rows
+    finally:
+        conn.close()
+
+    with open(os.path.join(snapshot_dir, 'snapshot.json'), 'w') as fp:
+        json.dump({'format': snapshot_format, 'rows': rows, 'schema': schema}, fp, indent=2)
+    print(f"Wrote snapshot of {sum(rows.values())} rows to {snapshot_dir} in {time.time() - start:.2f}s")
+    return rows
+
+
+def load_snapshot(snapshot_dir: str,
+                  mmap_mode: typing.Optional[str] = 'r') -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """
+    Opens a snapshot written by db2snapshot. With mmap_mode, nothing is read until used.
+    :param snapshot_dir: Directory of the snapshot
+    :param mmap_mode: Passed to np.load, None reads every column into memory
+    :return: table -> column -> np.ndarray, or StringColumn for strings
+    """
+    with open(os.path.join(snapshot_dir, 'snapshot.json')) as fp:
+        meta = json.load(fp)
+    if meta['format'] != snapshot_format:
+        raise ValueError(f"{snapshot_dir} has snapshot format {meta['format']}, expected {snapshot_format}")
+    tables = {}
+    for table, columns in meta['schema'].items():
+        path = os.path.join(snapshot_dir, table)
+        tables[table] = {}
+        for column, kind in columns.items():
+            if kind == 'str':
+                tables[table][column] = StringColumn(
+                    np.load(os.path.join(path, f"{column}.offsets.npy"), mmap_mode=mmap_mode),
+                    np.load(os.path.join(path, f"{column}.bytes.npy"), mmap_mode=mmap_mode))
+            else:
+                tables[table][column] = np.load(os.path.join(path, f"{column}.npy"), mmap_mode=mmap_mode)
+    return tables
+
+
+def _from_column(*, snapshot, keys: typing.Dict[str, str],
+                 table: str, column: str, kind: str, rows: np.ndarray) -> typing.List[typing.Any]:
+    """
+    Reads rows of a snapshot column back as sqlite values
+    :param keys: table -> primary key column, to turn foreign keys back into ids
+    """
+    values = snapshot[table][column]
+    if kind == 'str':
+        return values.take(rows)
+    if kind.startswith('ref:'):
+        referenced = kind[4:]
+        return snapshot[referenced][keys[referenced]].take(values[rows])
+    values = values[rows].tolist()
+    if kind == 'float':
+        return [None if v != v else v for v in values]
+    if kind == 'int':
+        return [None if v == int_null else v for v in values]
+    return [int(v) for v in values]
+
+
+def snapshot2db(snapshot_dir: str,
+                db_file: str,
+                batch_size: int = 10000) -> typing.Dict[str, int]:
+    """
+    Rebuilds a sqlite db with the setup_db schema from a snapshot
+    :param snapshot_dir: Directory of the snapshot
+    :param db_file: Full path to the new sqlite db_file, must not exist
+    :param batch_size: Rows inserted per executemany
+    :return: Number of rows of every table
+    """
+    if os.path.exists(db_file):
+        raise ValueError(f"{db_file} already exists")
+    start = time.time()
+    snapshot = load_snapshot(snapshot_dir)
+    db = bind_db(db_file, create_db=True)
+    schema = snapshot_schema(db)
+    keys = {table: _primary_key(db, table) for table in schema}
+
+    rows = {}
+    conn = sqlite_connect(db)
+    try:
+        conn.execute('BEGIN')
+        for table, columns in schema.items():
+            kinds = {column: kind for column, kind in columns.items() if column in snapshot[table]}
+            num_rows = len(next(iter(snapshot[table].values())))
+            names = ', '.join(f'"{column}"' for column in kinds)
+            insert = f'INSERT INTO "{table}" ({names}) VALUES ({", ".join("?" * len(kinds))})'
+            for batch_start in range(0, num_rows, batch_size):
+                batch = np.arange(batch_start, min(batch_start + batch_size, num_rows))
+                values = [_from_column(snapshot=snapshot, keys=keys, table=table, column=column, kind=kind, rows=batch)
+                          for column, kind in kinds.items()]
+                conn.executemany(insert, zip(*values))
+            rows[table] = num_rows
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    print(f"Restored {sum(rows.values())} rows to {db_file} in {time.time() - start:.2f}s")
+    return rows
+
+
+def snapshot_stats(snapshot_dir: str) -> typing.Dict[str, typing.Any]:
+    """
+    Dataset statistics computed with numpy over a memory mapped snapshot
+    :param snapshot_dir: Directory of the snapshot
+    :return: Row counts, hours of audio, utterances per speaker and transcript length histogram
+    """
+    start = time.time()
+    snapshot = load_snapshot(snapshot_dir)
+    utterances, sentences = snapshot['Utterance'], snapshot['Sentence']
+    per_speaker = np.bincount(utterances['speaker'], minlength=len(snapshot['Speaker']['spk_id']))
+    lengths = sentences['length'][utterances['transcript']]
+    stats = {
+        'rows': {table: len(next(iter(columns.values()))) for table, columns in snapshot.items()},
+        'hours': float(np.nansum(utterances['duration'])) / 3600,
+        'segments': int(np.count_nonzero(utterances['is_segment'])),
+        'utterances_per_speaker': {
+            'min': int(per_speaker.min()) if len(per_speaker) else 0,
+            'median': float(np.median(per_speaker)) if len(per_speaker) else 0.0,
+            'max': int(per_speaker.max()) if len(per_speaker) else 0
+        },
+        'words_per_utterance': {int(n): int(c) for n, c in enumerate(np.bincount(lengths)) if c}
+    }
+    print(f"Computed statistics in {time.time() - start:.3f}s")
+    return stats
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'save': db2snapshot,
+        'restore': snapshot2db,
+        'stats': snapshot_stats
+    })
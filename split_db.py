@@ -1,6 +1,10 @@
 import os
 import fire
+import time
 import typing
+import sqlite3
+import tempfile
+import numpy as np
 
 from utils import *
 from setup_db import *
@@ -12,6 +16,312 @@ train_dev_test = {
     'test': 0.15
 }
 
+# split_by -> (table whose rows are assigned, its key, Utterance column referencing it)
+split_keys = {
+    'utt': ('Utterance', 'utt_id', 'utt_id'),
+    'spk': ('Speaker', 'spk_id', 'speaker'),
+    'sent': ('Sentence', 'sent_id', 'transcript'),
+    # Whole connected components of the speaker-sentence graph; all utterances of a
+    # speaker are in one component, so subsets are still assigned per speaker
+    'spk+sent': ('Speaker', 'spk_id', 'speaker')
+}
+
+# Utterances are fetched this many at a time to build the speaker-sentence graph
+component_fetch_rows = 100000
+
+# Parent rows referenced by a subset's utterances: table -> (key, Utterance column)
+parent_keys = {
+    'Sentence': ('sent_id', 'transcript'),
+    'Speaker': ('spk_id', 'speaker'),
+    'Recording': ('reco_id', 'recording')
+}
+
+
+def _table_columns(conn, table: str, schema: str = 'main') -> typing.List[str]:
+    """
+    Lists the columns of a table
+    :param schema: Attached database the table lives in
+    :return: Column names, in table order
+    """
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info("{table}")')]
+
+
+def _id_durations(select: typing.Callable[[str], typing.List[tuple]],
+                  split_by: str) -> typing.Tuple[typing.List[str], typing.List[float]]:
+    """
+    Sums the audio duration of every id of the split table. Unsegmented utterances without
+    a duration of their own take the duration of their recording.
+    :param select: Runs a SQL query and returns its rows, e.g. Database.select
+    :param split_by: Can be either 'spk', 'utt', or 'sent'
+    :return: ids ordered by key, and their seconds of audio
+    """
+    table, key, column = split_keys[split_by]
+    duration = 'COALESCE(u."duration", r."duration")'
+    rows = select(f'SELECT k."{key}", SUM({duration}), COUNT(u."utt_id") - COUNT({duration}) '
+                  f'FROM "{table}" k LEFT JOIN "Utterance" u ON u."{column}" = k."{key}" '
+                  f'LEFT JOIN "Recording" r ON r."reco_id" = u."recording" '
+                  f'GROUP BY k."{key}" ORDER BY k."{key}"')
+    num_unknown = sum(row[2] for row in rows)
+    if num_unknown:
+        raise ValueError(f"{num_unknown} utterances have no duration: ingest segments, utt2dur "
+                         f"or recording durations before balancing by duration")
+    return [row[0] for row in rows], [row[1] or 0.0 for row in rows]
+
+
+def _component_assignment(conn,
+                          subset_ratio: typing.List[float],
+                          balance: str = 'count') -> typing.Tuple[typing.List[str], typing.List[int]]:
+    """
+    Assigns whole connected components of the bipartite speaker-sentence graph to subsets,
+    so that no speaker and no sentence is shared between subsets. Components are balanced by
+    number of utterances, or by hours of audio. Prints how far the subsets end up from
+    subset_ratio, since a large component cannot be cut.
+    :param conn: DB-API connection of the original db
+    :param subset_ratio: Ratio of each subset
+    :param balance: Balance the subsets by number of utterances ('count') or hours of audio ('duration')
+    :return: spk_ids ordered by key, and their subsets
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT "spk_id" FROM "Speaker" ORDER BY "spk_id"')
+    spk_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT COUNT(*) FROM "Sentence"')
+    num_sentences = cursor.fetchone()[0]
+
+    # Speakers and sentences as their rank by key, so the graph lives in integer arrays
+    cursor.execute('WITH s AS (SELECT "spk_id", ROW_NUMBER() OVER (ORDER BY "spk_id") - 1 AS i FROM "Speaker"), '
+                   't AS (SELECT "sent_id", ROW_NUMBER() OVER (ORDER BY "sent_id") - 1 AS i FROM "Sentence") '
+                   'SELECT s.i, t.i, COALESCE(u."duration", r."duration", -1) FROM "Utterance" u '
+                   'JOIN s ON s."spk_id" = u."speaker" JOIN t ON t."sent_id" = u."transcript" '
+                   'JOIN "Recording" r ON r."reco_id" = u."recording"')
+    chunks = []
+    rows = cursor.fetchmany(component_fetch_rows)
+    while rows:
+        chunks.append(np.array(rows, dtype=np.float64).reshape(-1, 3))
+        rows = cursor.fetchmany(component_fetch_rows)
+    utterances = np.concatenate(chunks) if chunks else np.empty((0, 3))
+    speakers, sentences = utterances[:, 0].astype(np.int64), utterances[:, 1].astype(np.int64)
+    if balance == 'duration':
+        weights = utterances[:, 2]
+        if (weights < 0).any():
+            raise ValueError(f"{int((weights < 0).sum())} utterances have no duration: ingest segments, "
+                             f"utt2dur or recording durations before balancing by duration")
+    else:
+        weights = np.ones(len(utterances))
+
+    roots = connected_components(speakers, sentences, len(spk_ids), num_sentences)
+    # Every component with an utterance has a speaker, so speaker roots cover them all
+    components, spk_component = np.unique(roots[:len(spk_ids)], return_inverse=True)
+    component_weights = np.bincount(spk_component[speakers], weights=weights, minlength=len(components))
+    spk_subset = np.asarray(random_assignment(ratio=subset_ratio, weights=component_weights),
+                            dtype=np.int64)[spk_component]
+
+    requested = np.asarray(subset_ratio, dtype=np.float64) / np.sum(subset_ratio)
+    achieved = np.bincount(spk_subset[speakers], weights=weights, minlength=len(subset_ratio)) / \
+        max(weights.sum(), 1e-9)
+    print(f"{len(components)} speaker-sentence components, the largest holding "
+          f"{component_weights.max(initial=0) / max(weights.sum(), 1e-9):.1%} of the "
+          f"{'audio' if balance == 'duration' else 'utterances'}")
+    print("Subset shares " + ', '.join(f"{a:.3f} (requested {r:.3f})" for a, r in zip(achieved, requested)) +
+          f", max deviation {np.abs(achieved - requested).max(initial=0):.3f}")
+    return spk_ids, spk_subset.tolist()
+
+
+def _write_assignment(*, db_original,
+                      split_by: str,
+                      subset_ratio: typing.List[float],
+                      assignment_file: str,
+                      balance: str = 'count',
+                      profiler: Profiler = None) -> int:
+    """
+    Draws the subset of every id of the split table, and writes them once to a
+    standalone sqlite file that all subset builders attach.
+    :param db_original: Database bound to the original sqlite file
+    :param split_by: Can be either 'spk', 'utt', 'sent', or 'spk+sent'
+    :param subset_ratio: Ratio of each subset
+    :param assignment_file: sqlite file to create, with table assignment(id, subset)
+    :param balance: Balance the subsets by number of ids ('count') or hours of audio ('duration')
+    :param profiler: Counts the statements on the original db
+    :return: Number of assigned ids
+    """
+    profiler = profiler if profiler is not None else Profiler('split_db')
+    table, key, _ = split_keys[split_by]
+    conn = profiler.trace(sqlite_connect(db_original))
+    try:
+        if split_by == 'spk+sent':
+            ids, assignments = _component_assignment(conn, subset_ratio, balance)
+        elif balance == 'duration':
+            ids, durations = _id_durations(lambda sql: conn.execute(sql).fetchall(), split_by)
+            assignments = random_assignment(ratio=subset_ratio, weights=durations)
+        else:
+            ids = [row[0] for row in conn.execute(f'SELECT "{key}" FROM "{table}" ORDER BY "{key}"')]
+            assignments = random_assignment(ratio=subset_ratio, num_id=len(ids))
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(assignment_file, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        conn.execute('CREATE TABLE "assignment" ("id" TEXT PRIMARY KEY, "subset" INTEGER NOT NULL)')
+        conn.executemany('INSERT INTO "assignment" VALUES (?, ?)', zip(ids, assignments))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return len(ids)
+
+
+def _empty_subset(db) -> int:
+    """
+    Deletes the rows a subset db kept from an earlier split. Merging a new split into them would
+    leave ids of one subset in another
+    :param db: Database bound to a subset db
+    :return: Number of deleted utterances
+    """
+    with db_session:
+        num_rows = db.execute('DELETE FROM "Utterance"').rowcount
+        for parent in parent_keys:
+            db.execute(f'DELETE FROM "{parent}"')
+    return num_rows
+
+
+def _fill_subset(*, original_file: str,
+                 assignment_file: str,
+                 sub_db: str,
+                 subset: int,
+                 split_by: str,
+                 fast_ingest: bool = False) -> float:
+    """
+    Fills one (empty, already mapped) subset db with INSERT ... SELECT over the attached
+    original: its utterances, plus the deduplicated sentences, speakers and recordings
+    they reference. Opens its own connection, so subsets can be filled in parallel.
+    :param original_file: Full path to the original sqlite file
+    :param assignment_file: File written by _write_assignment
+    :param sub_db: Full path to the subset sqlite file
+    :param subset: Index of this subset in the assignment
+    :param split_by: Can be either 'spk', 'utt', 'sent', or 'spk+sent'
+    :param fast_ingest: Use setup_db.fast_ingest_pragmas for the subset db
+    :return: Elapsed seconds
+    """
+    start = time.time()
+    _, _, utt_column = split_keys[split_by]
+    conn = sqlite3.connect(sub_db, isolation_level=None)
+    try:
+        if fast_ingest:
+            apply_pragmas(conn, fast_ingest_pragmas)
+        conn.execute('ATTACH DATABASE ? AS "orig"', (original_file,))
+        conn.execute('ATTACH DATABASE ? AS "asg"', (assignment_file,))
+        conn.execute('BEGIN')
+        columns = _table_columns(conn, 'Utterance')
+        insert_columns = ', '.join(f'"{c}"' for c in columns)
+        select_columns = ', '.join(f'u."{c}"' for c in columns)
+        conn.execute(f'INSERT INTO main."Utterance" ({insert_columns}) '
+                     f'SELECT {select_columns} '
+                     f'FROM orig."Utterance" u JOIN asg."assignment" a ON a."id" = u."{utt_column}" '
+                     f'WHERE a."subset" = ?', (subset,))
+        for parent, (parent_key, parent_column) in parent_keys.items():
+            columns = ', '.join(f'"{c}"' for c in _table_columns(conn, parent))
+            conn.execute(f'INSERT INTO main."{parent}" ({columns}) '
+                         f'SELECT {columns} FROM orig."{parent}" '
+                         f'WHERE "{parent_key}" IN (SELECT "{parent_column}" FROM main."Utterance")')
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return time.time() - start
+
+
+def _export_subset(*, sub_db: str, sub_data_dir: str,
+                   cache_dir: typing.Optional[str] = None,
+                   cache_max_gb: float = 10.0) -> float:
+    """
+    Writes one subset db to a Kaldi-style directory
+    :param cache_dir: Export cache, see db2data
+    :return: Elapsed seconds
+    """
+    start = time.time()
+    db2data(db_file=sub_db, data_dir=sub_data_dir, cache_dir=cache_dir, cache_max_gb=cache_max_gb)
+    return time.time() - start
+
+
+def _orm_assignment(*, db_original,
+                    split_by: str,
+                    subset_ratio: typing.List[float],
+                    balance: str = 'count') -> typing.Dict[str, int]:
+    """
+    Draws the subset of every id of the split table, reading only the ids.
+    Must be called inside a db_session.
+    :param db_original: Database bound to the original db
+    :param split_by: Can be either 'spk', 'utt', 'sent', or 'spk+sent'
+    :param subset_ratio: Ratio of each subset
+    :param balance: Balance the subsets by number of ids ('count') or hours of audio ('duration')
+    :return: id -> subset
+    """
+    if split_by == 'spk+sent':
+        index2assignment = dict(zip(*_component_assignment(db_original.get_connection(), subset_ratio, balance)))
+    elif balance == 'duration':
+        ids, durations = _id_durations(db_original.select, split_by)
+        index2assignment = dict(zip(ids, random_assignment(ratio=subset_ratio, weights=durations)))
+    else:
+        # Only the keys: entities would fill Pony's identity map with the whole table
+        table, key, _ = split_keys[split_by]
+        ids = db_original.select(f'SELECT "{key}" FROM "{table}" ORDER BY "{key}"')
+        index2assignment = dict(zip(ids, random_assignment(ratio=subset_ratio, num_id=len(ids))))
+    return index2assignment
+
+
+def _orm_split(*, db_original,
+               db_indexer: typing.List[Database],
+               split_by: str,
+               subset_ratio: typing.List[float],
+               commit_every: typing.Optional[int] = None,
+               balance: str = 'count',
+               profiler: Profiler = None) -> None:
+    """
+    Copies every utterance of the original db into its subset db with Utterance.make_copy.
+    Must be called inside a db_session.
+    :param db_original: Database bound to the original db
+    :param db_indexer: Database of each subset
+    :param split_by: Can be either 'spk', 'utt', 'sent', or 'spk+sent'
+    :param subset_ratio: Ratio of each subset
+    :param commit_every: Copy this many utterances per transaction, dropping the session
+                         cache in between. Default: copy all at once
+    :param balance: Balance the subsets by number of ids ('count') or hours of audio ('duration')
+    :param profiler: Measures the assignment and the copy as stages
+    :return: None
+    """
+    profiler = profiler if profiler is not None else Profiler('split_db')
+    with profiler.stage('assignment') as stage:
+        index2assignment = _orm_assignment(db_original=db_original,
+                                           split_by=split_by,
+                                           subset_ratio=subset_ratio,
+                                           balance=balance)
+        stage['rows'] = len(index2assignment)
+
+    def get_assignment(u):
+        if split_by == 'utt':
+            return index2assignment[u.utt_id]
+        elif split_by in ('spk', 'spk+sent'):
+            return index2assignment[u.speaker.spk_id]
+        return index2assignment[u.transcript.sent_id]
+
+    with profiler.stage('copy') as stage:
+        stage['rows'] = 0
+        if commit_every:
+            # Keyset pagination, so that each chunk is a fresh query after the cache is dropped
+            last_utt_id = ''
+            while True:
+                chunk = db_original.Utterance.select(lambda u: u.utt_id > last_utt_id) \
+                    .order_by(lambda u: u.utt_id)[:commit_every]
+                if not chunk:
+                    break
+                for u in chunk:
+                    u.make_copy(db_indexer[get_assignment(u)])
+                    stage['rows'] += 1
+                last_utt_id = chunk[-1].utt_id
+                release_session()
+        else:
+            for u in db_original.Utterance.select().order_by(lambda u: u.utt_id):
+                u.make_copy(db_indexer[get_assignment(u)])
+                stage['rows'] += 1
+
 
 def split_db(db_file: str,
              split_by: str,
@@ -19,90 +329,149 @@ def split_db(db_file: str,
              db_provider: str = 'sqlite',
              split_ratio: typing.Optional[typing.Dict[str, float]] = None,
              save_db: bool = True,
-             save_data: bool = True) -> None:
-    db_original = setup_db()
-    db_original.bind(provider=db_provider,
-                     filename=db_file,
-                     create_db=False)
-    db_original.generate_mapping(create_tables=False)
-
-    split_ratio = train_dev_test if split_ratio is None else split_ratio
-    db_indexer = []
-    subset_ratio = []
-    subset_names = []
-    subset_dbs = []
-
-    for n, r in split_ratio.items():
-        subset_names.append(n)
-        subset_ratio.append(r)
-        db_indexer.append(setup_db())
-        new_db_file = os.path.join(
-            os.path.dirname(db_file),
-            f"{'.'.join(os.path.basename(db_file).split('.')[:-1])}_{split_by}_{n}.db"
-        )
-        db_indexer[-1].bind(provider=db_provider,
-                            filename=new_db_file,
-                            create_db=True)
-        db_indexer[-1].generate_mapping(create_tables=True)
-        subset_dbs.append(new_db_file)
+             save_data: bool = True,
+             commit_every: int = None,
+             fast_ingest: bool = False,
+             engine: str = 'orm',
+             jobs: int = 1,
+             balance: str = 'count',
+             profile: typing.Union[bool, str] = False,
+             cache_dir: str = None,
+             cache_max_gb: float = 10.0) -> None:
+    """
+    Splits a db into subset dbs, and optionally writes each subset to a Kaldi-style directory
+    :param db_file: Full path to db_file
+    :param split_by: Reserve whole speakers ('spk'), sentences ('sent') or utterances ('utt'), or
+                     both speakers and sentences ('spk+sent'), so that no subset shares either
+    :param data_dir: Directory to write one Kaldi-style directory per subset into
+    :param db_provider: db type.
+    :param split_ratio: Subset name -> ratio, defaults to train_dev_test
+    :param save_db: Keep the subset dbs
+    :param save_data: Write the subsets to data_dir
+    :param commit_every: Copy this many utterances per transaction, dropping the session
+                         cache in between, so memory stays bounded. Default: copy all at once
+    :param fast_ingest: Use setup_db.fast_ingest_pragmas while building the subset dbs
+    :param engine: 'orm' copies every utterance with Utterance.make_copy, 'sql' fills
+                   each subset with INSERT ... SELECT over the attached original (sqlite only)
+    :param jobs: Number of worker processes building (sql engine) and exporting subsets
+    :param balance: Make subset sizes follow split_ratio by number of ids ('count'), or by
+                    hours of audio ('duration', needs utterance or recording durations)
+    :param profile: Report wall time, rows/sec, peak RSS and SQL statements of every stage as one JSON
+                    line, printed at the end, or appended to this file (see utils.Profiler). Subsets built
+                    or exported by worker processes are timed, but their statements are not counted
+    :param cache_dir: Export the subsets through this export cache, see db2data. A subset db that comes
+                      out the same as in an earlier split (same db, split_by, ratio and seed) is linked
+                      from there instead of exported again
+    :param cache_max_gb: Size limit of cache_dir
+    :return: None
+    """
+    if balance not in ('count', 'duration'):
+        raise ValueError(f"balance can be either 'count' or 'duration', got {balance}")
+    if engine not in ('orm', 'sql'):
+        raise ValueError(f"engine can be either 'orm' or 'sql', got {engine}")
+    if engine == 'sql' and db_provider != 'sqlite':
+        raise ValueError(f"engine 'sql' only supports sqlite, got {db_provider}")
+    if split_by not in split_keys:
+        raise ValueError(f"split_by can be either 'spk', 'utt', 'sent', or 'spk+sent'. Got {split_by}")
+    profiler = Profiler('split_db', profile)
+    with profiler.stage('setup'):
+        db_original = bind_db(db_file, db_provider)
 
-    with db_session:
-        if split_by == 'utt':
-            num_rows = count(utt for utt in db_original.Utterance)
-            assignments = random_assignment(ratio=subset_ratio, num_id=num_rows)
-            index2assignment = {utt.utt_id: assignment
-                                for assignment, utt in zip(assignments,
-                                                           db_original.Utterance
-                                                           .select()
-                                                           .order_by(lambda utt: utt.utt_id)[:])}
-
-            def get_assignment(u):
-                return index2assignment[u.utt_id]
-
-        elif split_by == 'spk':
-            num_rows = count(utt for utt in db_original.Speaker)
-            assignments = random_assignment(ratio=subset_ratio, num_id=num_rows)
-            index2assignment = {spk.spk_id: assignment
-                                for assignment, spk in zip(assignments,
-                                                           db_original.Speaker
-                                                           .select()
-                                                           .order_by(lambda spk: spk.spk_id)[:])}
-
-            def get_assignment(u):
-                return index2assignment[u.speaker.spk_id]
-
-        elif split_by == 'sent':
-            num_rows = count(utt for utt in db_original.Sentence)
-            assignments = random_assignment(ratio=subset_ratio, num_id=num_rows)
-            index2assignment = {sent.sent_id: assignment
-                                for assignment, sent in zip(assignments,
-                                                            db_original.Sentence
-                                                            .select()
-                                                            .order_by(lambda sent: sent.sent_id)[:])}
-
-            def get_assignment(u):
-                return index2assignment[u.transcript.sent_id]
-        else:
-            raise ValueError(f"split_by can be either 'spk', 'utt', or 'sent'. Got {split_by}")
+        split_ratio = train_dev_test if split_ratio is None else split_ratio
+        db_indexer = []
+        subset_ratio = []
+        subset_names = []
+        subset_dbs = []
+
+        for n, r in split_ratio.items():
+            subset_names.append(n)
+            subset_ratio.append(r)
+            new_db_file = os.path.join(
+                os.path.dirname(db_file),
+                f"{'.'.join(os.path.basename(db_file).split('.')[:-1])}_{split_by}_{n}.db"
+            )
+            db_indexer.append(bind_db(new_db_file, db_provider, create_db=True, fast_ingest=fast_ingest))
+            subset_dbs.append(db_indexer[-1].provider.pool.filename if db_provider == 'sqlite'
+                              else new_db_file)
+            num_stale = _empty_subset(db_indexer[-1])
+            if num_stale:
+                print(f"Emptied {new_db_file}, which held {num_stale} utterances of an earlier split")
+    profiler.watch(db_original, *db_indexer)
 
-        for u in db_original.Utterance.select().order_by(lambda u: u.utt_id):
-            tgt_db = db_indexer[get_assignment(u)]
-            if not tgt_db.Utterance.get(utt_id=u.utt_id):
-                u.make_copy(tgt_db)
+    if save_data and not data_dir:
+        raise ValueError(f"data_dir required when save_data is True")
+
+    wall_start = time.time()
+    timings = {n: {} for n in subset_names}
+    if engine == 'sql':
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            assignment_file = os.path.join(tmp_dir, 'assignment.db')
+            with profiler.stage('assignment') as stage:
+                stage['rows'] = _write_assignment(db_original=db_original,
+                                                  split_by=split_by,
+                                                  subset_ratio=subset_ratio,
+                                                  assignment_file=assignment_file,
+                                                  balance=balance,
+                                                  profiler=profiler)
+            with profiler.stage('build') as stage:
+                build_times = parallel_map(_fill_subset,
+                                           [dict(original_file=db_original.provider.pool.filename,
+                                                 assignment_file=assignment_file,
+                                                 sub_db=sub_db,
+                                                 subset=i,
+                                                 split_by=split_by,
+                                                 fast_ingest=fast_ingest)
+                                            for i, sub_db in enumerate(subset_dbs)],
+                                           jobs=jobs)
+                stage['subsets'] = {n: round(t, 4) for n, t in zip(subset_names, build_times)}
+        for n, t in zip(subset_names, build_times):
+            timings[n]['build'] = t
+    else:
+        # One pass over the original db feeds all subsets, so this cannot be split per subset
+        start = time.time()
+        with db_session:
+            for db in [db_original] + db_indexer:
+                profiler.trace(db.get_connection())
+            _orm_split(db_original=db_original,
+                       db_indexer=db_indexer,
+                       split_by=split_by,
+                       subset_ratio=subset_ratio,
+                       commit_every=commit_every,
+                       balance=balance,
+                       profiler=profiler)
+            with profiler.stage('commit'):
+                commit()
+        print(f"Built all subsets in {time.time() - start:.2f}s")
+    if fast_ingest:
+        with profiler.stage('end fast ingest'):
+            for sub_db in subset_dbs:
+                end_fast_ingest(sub_db, db_provider)
 
-        commit()
     if save_data:
-        if not data_dir:
-            raise ValueError(f"data_dir required when save_data is True")
         if not os.path.exists(data_dir):
             os.mkdir(data_dir)
-        for sub_db, sub_name in zip(subset_dbs, subset_names):
-            sub_data_dir = os.path.join(data_dir, sub_name)
-            db2data(db_file=sub_db, data_dir=sub_data_dir)
+        with profiler.stage('export') as stage:
+            export_times = parallel_map(_export_subset,
+                                        [dict(sub_db=sub_db,
+                                              sub_data_dir=os.path.join(data_dir, sub_name),
+                                              cache_dir=cache_dir,
+                                              cache_max_gb=cache_max_gb)
+                                         for sub_db, sub_name in zip(subset_dbs, subset_names)],
+                                        jobs=jobs)
+            stage['subsets'] = {n: round(t, 4) for n, t in zip(subset_names, export_times)}
+        for n, t in zip(subset_names, export_times):
+            timings[n]['export'] = t
+
+    for n, t in timings.items():
+        if t:
+            print(f"{n}: " + ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in t.items()))
+    print(f"Wall clock {time.time() - wall_start:.2f}s with {jobs} job(s)")
 
     if not save_db:
         for sub_db in subset_dbs:
+            release_db(sub_db, db_provider)
             os.remove(sub_db)
+    profiler.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,29 @@
+import sqlite3
+
+import pytest
+
+from benchmark import make_corpus
+from data2db import main as data2db
+
+
+def _tables(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return {table: conn.execute(f'SELECT * FROM "{table}" ORDER BY 1').fetchall()
+                for table in ('Sentence', 'Speaker', 'Recording', 'Utterance')}
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('segments_per_recording', [4, 0])
+def test_engines_agree(tmp_path, segments_per_recording):
+    data_dir = str(tmp_path / 'data')
+    make_corpus(data_dir, 3000, num_speakers=30, segments_per_recording=segments_per_recording)
+    data2db(data_dir, db_file=str(tmp_path / 'orm.db'), engine='orm')
+    reference = _tables(str(tmp_path / 'orm.db'))
+    assert len(reference['Utterance']) == 3000
+    for jobs in (1, 2):
+        db_file = str(tmp_path / f"bulk_{jobs}.db")
+        data2db(data_dir, db_file=db_file, engine='bulk', jobs=jobs)
+        assert _tables(db_file) == reference
+
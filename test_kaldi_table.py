@@ -0,0 +1,161 @@
+import gzip
+import wave
+import struct
+
+import pytest
+
+from kaldi_table import KaldiTableError, table_path, table_chunks, read_table, diff_table, segments_source, \
+    read_segments, wav_duration, matrix_shape, ark_shapes
+
+
+def _write(path, lines):
+    path.write_text(''.join(line + '\n' for line in lines))
+    return str(path)
+
+
+def test_read_table_joins_fields_and_skips_blank_lines(tmp_path):
+    text = _write(tmp_path / 'text', ['utt1 hello   world', '', 'utt2', 'utt3 a b c'])
+    assert list(read_table(text)) == [('utt1', 'hello world'), ('utt2', ''), ('utt3', 'a b c')]
+
+
+@pytest.mark.parametrize('name, line', [('utt2spk', 'utt2 spk1 extra'),
+                                        ('utt2spk', 'utt2'),
+                                        ('segments', 'utt2 reco1 0.0'),
+                                        ('wav.scp', 'reco2')])
+def test_read_table_reports_bad_lines(tmp_path, name, line):
+    good = {'utt2spk': 'utt1 spk1', 'segments': 'utt1 reco1 0.0 1.0', 'wav.scp': 'reco1 a.wav'}[name]
+    file = _write(tmp_path / name, [good, '', line, good])
+    with pytest.raises(KaldiTableError) as error:
+        list(read_table(file))
+    assert error.value.line_no == 3
+    assert str(error.value).startswith(f"{file}:3: ")
+
+
+def test_read_table_line_numbers_of_later_chunks(tmp_path):
+    lines = [f"utt{i:04d} spk{i % 7}" for i in range(1000)]
+    lines[876] = 'utt0876'
+    file = _write(tmp_path / 'utt2spk', lines)
+    chunks = table_chunks(file, 1000)
+    assert len(chunks) > 1
+    with pytest.raises(KaldiTableError) as error:
+        for start, end in chunks:
+            list(read_table(file, start=start, end=end))
+    assert error.value.line_no == 877
+
+
+def test_read_table_chunks_cover_the_file(tmp_path):
+    lines = [f"utt{i:04d} some words {i}" for i in range(500)]
+    file = _write(tmp_path / 'text', lines)
+    rows = [row for start, end in table_chunks(file, 300) for row in read_table(file, start=start, end=end)]
+    assert rows == list(read_table(file))
+
+
+def test_gzipped_tables(tmp_path):
+    with gzip.open(tmp_path / 'utt2spk.gz', 'wt') as fp:
+        fp.write('utt1 spk1\nutt2 spk2 extra\n')
+    file = table_path(str(tmp_path), 'utt2spk')
+    assert file == str(tmp_path / 'utt2spk.gz')
+    assert table_chunks(file, 1) == [(0, None)]
+    with pytest.raises(KaldiTableError) as error:
+        list(read_table(file))
+    assert error.value.line_no == 2
+    with pytest.raises(ValueError):
+        list(read_table(file, start=4))
+
+
+def test_virtual_segments(tmp_path):
+    _write(tmp_path / 'text', ['utt1 a b', 'utt2 c'])
+    file, virtual = segments_source(str(tmp_path))
+    assert (file, virtual) == (str(tmp_path / 'text'), True)
+    assert list(read_segments(file, virtual)) == [('utt1', 'utt1', '-1.0', '-1.0'), ('utt2', 'utt2', '-1.0', '-1.0')]
+
+    _write(tmp_path / 'segments', ['utt1 reco1 0.00 1.50', 'utt2 reco1 1.50 2.25'])
+    file, virtual = segments_source(str(tmp_path))
+    assert (file, virtual) == (str(tmp_path / 'segments'), False)
+    assert list(read_segments(file, virtual)) == [('utt1', 'reco1', '0.00', '1.50'), ('utt2', 'reco1', '1.50', '2.25')]
+
+
+def test_diff_table(tmp_path):
+    old = _write(tmp_path / 'old', ['utt1 a', 'utt2 b', 'utt3 c'])
+    new = _write(tmp_path / 'new', ['utt1 a', 'utt2 B', 'utt4  d'])
+    assert diff_table(old, new) == ([('utt2', 'B'), ('utt4', 'd')], [('utt2', 'b'), ('utt3', 'c')])
+    assert diff_table(old, old) == ([], [])
+    assert diff_table(None, old) == (list(read_table(old)), [])
+
+
+def _wav(path, seconds, rate=16000, channels=1, width=2):
+    with wave.open(str(path), 'wb') as fp:
+        fp.setnchannels(channels)
+        fp.setsampwidth(width)
+        fp.setframerate(rate)
+        fp.writeframes(b'\0' * int(seconds * rate) * channels * width)
+    return str(path)
+
+
+def test_wav_duration(tmp_path):
+    assert wav_duration(_wav(tmp_path / 'a.wav', 1.5)) == pytest.approx(1.5)
+    assert wav_duration(_wav(tmp_path / 'b.wav', 0.25, rate=8000, channels=2)) == pytest.approx(0.25)
+
+
+def test_wav_duration_skips_other_chunks(tmp_path):
+    data = open(_wav(tmp_path / 'a.wav', 2.0), 'rb').read()
+    # A LIST chunk of odd size, padded to an even one, between the RIFF header and fmt
+    extra = b'LIST' + struct.pack('<I', 5) + b'INFOx\0'
+    patched = data[:4] + struct.pack('<I', len(data) - 8 + len(extra)) + data[8:12] + extra + data[12:]
+    (tmp_path / 'b.wav').write_bytes(patched)
+    assert wav_duration(str(tmp_path / 'b.wav')) == pytest.approx(2.0)
+
+
+def test_wav_duration_open_and_truncated_sizes(tmp_path):
+    data = bytearray(open(_wav(tmp_path / 'a.wav', 1.0), 'rb').read())
+    data_size = data.index(b'data') + 4
+    streamed = data[:data_size] + struct.pack('<I', 0xFFFFFFFF) + data[data_size + 4:]
+    (tmp_path / 'streamed.wav').write_bytes(streamed)
+    assert wav_duration(str(tmp_path / 'streamed.wav')) == pytest.approx(1.0)
+    (tmp_path / 'truncated.wav').write_bytes(data[:len(data) - 16000])
+    assert wav_duration(str(tmp_path / 'truncated.wav')) == pytest.approx(0.5)
+
+
+def test_wav_duration_rejects_other_files(tmp_path):
+    (tmp_path / 'a.txt').write_bytes(b'not a wav file at all')
+    with pytest.raises(ValueError):
+        wav_duration(str(tmp_path / 'a.txt'))
+    data = open(_wav(tmp_path / 'a.wav', 1.0), 'rb').read()
+    (tmp_path / 'no_data.wav').write_bytes(data[:data.index(b'data')])
+    with pytest.raises(ValueError):
+        wav_duration(str(tmp_path / 'no_data.wav'))
+
+
+def _matrix(key, token, rows, cols):
+    if token in (b'FM', b'DM'):
+        header = struct.pack('<bibi', 4, rows, 4, cols)
+    else:
+        header = struct.pack('<ffii', -1.0, 2.0, rows, cols)
+    return key + b' ', b'\0B' + token + b' ' + header + b'\0' * 16
+
+
+def test_matrix_shape():
+    for token in (b'FM', b'DM', b'CM', b'CM2', b'CM3'):
+        key, matrix = _matrix(b'utt1', token, 123, 40)
+        assert matrix_shape(key + matrix, len(key)) == (123, 40)
+
+
+def test_matrix_shape_rejects_other_objects():
+    key, matrix = _matrix(b'utt1', b'FM', 3, 4)
+    with pytest.raises(ValueError):
+        matrix_shape(key + matrix, 0)
+    with pytest.raises(ValueError):
+        matrix_shape(b'\0BFV ' + matrix[5:], 0)
+    with pytest.raises(ValueError):
+        matrix_shape(b'\0BFM ' + struct.pack('<bibi', 8, 3, 4, 4), 0)
+
+
+def test_ark_shapes(tmp_path):
+    parts, offsets = [], []
+    for i, (token, rows) in enumerate([(b'FM', 10), (b'CM', 20), (b'DM', 30)]):
+        key, matrix = _matrix(f"utt{i}".encode(), token, rows, 13)
+        offsets.append(sum(map(len, parts)) + len(key))
+        parts += [key, matrix]
+    (tmp_path / 'a.ark').write_bytes(b''.join(parts))
+    assert ark_shapes(str(tmp_path / 'a.ark'), [offsets[2], offsets[0], 1, offsets[1]]) == \
+        [(30, 13), (10, 13), None, (20, 13)]
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+from benchmark import make_corpus
+from data2db import main as data2db
+from snapshot_db import db2snapshot, snapshot2db, load_snapshot
+
+
+def _tables(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return {table: conn.execute(f'SELECT * FROM "{table}" ORDER BY 1').fetchall()
+                for table in ('Sentence', 'Speaker', 'Recording', 'Utterance')}
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('segments_per_recording', [4, 0])
+def test_snapshot_round_trip(tmp_path, segments_per_recording):
+    make_corpus(str(tmp_path / 'data'), 2000, num_speakers=20, segments_per_recording=segments_per_recording)
+    db_file = str(tmp_path / 'corpus.db')
+    data2db(str(tmp_path / 'data'), db_file=db_file, engine='bulk')
+
+    rows = db2snapshot(db_file, str(tmp_path / 'snapshot'))
+    original = _tables(db_file)
+    assert rows == {table: len(values) for table, values in original.items()}
+    snapshot2db(str(tmp_path / 'snapshot'), str(tmp_path / 'restored.db'))
+    assert _tables(str(tmp_path / 'restored.db')) == original
+    with pytest.raises(ValueError):
+        snapshot2db(str(tmp_path / 'snapshot'), str(tmp_path / 'restored.db'))
+
+
+def test_load_snapshot_columns(tmp_path):
+    make_corpus(str(tmp_path / 'data'), 500, num_speakers=5)
+    db_file = str(tmp_path / 'corpus.db')
+    data2db(str(tmp_path / 'data'), db_file=db_file, engine='bulk')
+    db2snapshot(db_file, str(tmp_path / 'snapshot'))
+
+    conn = sqlite3.connect(db_file)
+    expected = conn.execute('SELECT u."utt_id", u."speaker", t."text", u."duration" FROM "Utterance" u '
+                            'JOIN "Sentence" t ON t."sent_id" = u."transcript" ORDER BY u."utt_id"').fetchall()
+    conn.close()
+    for mmap_mode in ('r', None):
+        snapshot = load_snapshot(str(tmp_path / 'snapshot'), mmap_mode=mmap_mode)
+        utterances = snapshot['Utterance']
+        assert list(utterances['utt_id'].take(range(len(expected)))) == [row[0] for row in expected]
+        assert snapshot['Speaker']['spk_id'].take(utterances['speaker']) == [row[1] for row in expected]
+        assert snapshot['Sentence']['text'].take(utterances['transcript']) == [row[2] for row in expected]
+        assert utterances['duration'].tolist() == pytest.approx([row[3] for row in expected])
+        assert utterances['utt_id'].index(expected[7][0]) == 7
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+from benchmark import make_corpus
+from data2db import main as data2db
+from split_db import split_db, train_dev_test
+
+
+def _subsets(db_file, split_by):
+    subsets = {}
+    for name in train_dev_test:
+        conn = sqlite3.connect(f"{os.path.splitext(db_file)[0]}_{split_by}_{name}.db")
+        try:
+            subsets[name] = {column: set(conn.execute(f'SELECT "{column}" FROM "Utterance"'))
+                             for column in ('utt_id', 'speaker', 'transcript')}
+            subsets[name]['text'] = set(conn.execute('SELECT "text" FROM "Sentence"'))
+        finally:
+            conn.close()
+    return subsets
+
+
+@pytest.fixture(scope='module')
+def corpus_db(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('split')
+    make_corpus(str(tmp_path / 'data'), 3000, num_speakers=60)
+    db_file = str(tmp_path / 'corpus.db')
+    data2db(str(tmp_path / 'data'), db_file=db_file, engine='bulk')
+    conn = sqlite3.connect(db_file)
+    num_utts = conn.execute('SELECT COUNT(*) FROM "Utterance"').fetchone()[0]
+    conn.close()
+    return db_file, num_utts
+
+
+@pytest.mark.parametrize('engine', ['orm', 'sql'])
+@pytest.mark.parametrize('split_by', ['utt', 'spk', 'sent', 'spk+sent'])
+def test_split_does_not_leak(corpus_db, engine, split_by):
+    db_file, num_utts = corpus_db
+    # The second split reuses the subset dbs of the first, whose rows must not survive
+    for seed in (0, 1):
+        np.random.seed(seed)
+        split_db(db_file, split_by, save_data=False, engine=engine)
+        subsets = list(_subsets(db_file, split_by).values())
+        assert sum(len(s['utt_id']) for s in subsets) == num_utts
+        shared = [column for column in ('utt_id', 'speaker', 'transcript', 'text')
+                  for i, a in enumerate(subsets) for b in subsets[i + 1:] if a[column] & b[column]]
+        expected = {'utt': {'speaker', 'transcript', 'text'},
+                    'spk': {'transcript', 'text'},
+                    'sent': {'speaker'},
+                    'spk+sent': set()}[split_by]
+        assert set(shared) <= expected
+
+
+def test_split_engines_agree(corpus_db):
+    db_file, _ = corpus_db
+    results = []
+    for engine in ('orm', 'sql'):
+        np.random.seed(3)
+        split_db(db_file, 'spk', save_data=False, engine=engine)
+        results.append(_subsets(db_file, 'spk'))
+    assert results[0] == results[1]
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from utils import connected_components, random_assignment, balanced_assignment
+
+
+def _components(left, right, num_left, num_right):
+    # Plain union-find over python ints, the reference the vectorized version must match
+    parent = list(range(num_left + num_right))
+
+    def find(node):
+        while parent[node] != node:
+            node = parent[node]
+        return node
+
+    for u, v in zip(left, right):
+        a, b = find(u), find(v + num_left)
+        parent[max(a, b)] = min(a, b)
+    return [find(node) for node in range(num_left + num_right)]
+
+
+def test_connected_components_small_graph():
+    # Speakers 0 and 1 share sentence 0, speaker 2 has sentence 1 alone, sentence 2 is unused
+    roots = connected_components(np.array([0, 1, 2]), np.array([0, 0, 1]), num_left=3, num_right=3)
+    assert roots.tolist() == [0, 0, 2, 0, 2, 5]
+
+
+def test_connected_components_chain_and_duplicate_edges():
+    # A chain 3 - 0 - 2 - 1 - 1 over alternating sides, every edge twice
+    left = np.array([3, 2, 2, 1] * 2)
+    right = np.array([0, 0, 1, 1] * 2)
+    roots = connected_components(left, right, num_left=4, num_right=2)
+    assert roots.tolist() == [0, 1, 1, 1, 1, 1]
+
+
+def test_connected_components_without_edges():
+    roots = connected_components(np.array([], dtype=np.int64), np.array([], dtype=np.int64), num_left=2, num_right=2)
+    assert roots.tolist() == [0, 1, 2, 3]
+
+
+def test_connected_components_match_reference():
+    rng = np.random.default_rng(0)
+    for num_left, num_right, num_edges in [(50, 80, 60), (200, 30, 150), (500, 500, 700)]:
+        left = rng.integers(0, num_left, num_edges)
+        right = rng.integers(0, num_right, num_edges)
+        roots = connected_components(left, right, num_left, num_right)
+        assert roots.tolist() == _components(left.tolist(), right.tolist(), num_left, num_right)
+
+
+def test_random_assignment_by_count():
+    np.random.seed(0)
+    assignment = np.array(random_assignment(ratio=[0.8, 0.1, 0.1], num_id=100000))
+    assert set(assignment.tolist()) == {0, 1, 2}
+    assert np.allclose(np.bincount(assignment) / len(assignment), [0.8, 0.1, 0.1], atol=0.01)
+
+
+def test_random_assignment_normalizes_ratio():
+    np.random.seed(1)
+    fractions = random_assignment(ratio=[0.8, 0.1, 0.1], num_id=1000)
+    np.random.seed(1)
+    assert random_assignment(ratio=[8, 1, 1], num_id=1000) == fractions
+
+
+def test_random_assignment_by_weight():
+    np.random.seed(0)
+    weights = np.random.uniform(1, 20, 20000)
+    assignment = np.array(random_assignment(ratio=[0.5, 0.5], weights=weights))
+    share = weights[assignment == 0].sum() / weights.sum()
+    assert abs(share - 0.5) < 0.01
+
+
+def test_random_assignment_weight_outweighs_count():
+    # One id holding most of the weight fills the larger split on its own
+    np.random.seed(0)
+    assignment = random_assignment(ratio=[0.9, 0.1], weights=[100] + [1] * 10)
+    assert assignment[0] == 0
+
+
+def test_random_assignment_edge_cases():
+    assert random_assignment(ratio=[0.5, 0.5], num_id=0) == []
+    assert random_assignment(ratio=[0.5, 0.5], weights=[]) == []
+    with pytest.raises(ValueError):
+        random_assignment(ratio=[0.5, 0.5], weights=[0, 0])
+
+
+def test_balanced_assignment_balances_loads():
+    rng = np.random.default_rng(0)
+    weights = rng.integers(1, 100, 500)
+    assignment = np.array(balanced_assignment(weights, 8))
+    loads = np.bincount(assignment, weights=weights, minlength=8)
+    # Greedy on sorted weights ends within one item of perfect balance
+    assert loads.max() - loads.min() <= weights.max()
+
+
+def test_balanced_assignment_greedy_order():
+    # Heaviest first, each to the lightest bin; equal loads go to the bin with fewer items, then the lowest bin
+    assert balanced_assignment([5, 1, 4, 2, 2], 2) == [0, 1, 1, 1, 0]
+    # The last two items tie on load, the second one goes to the bin with one item
+    assert balanced_assignment([2, 2, 0, 0], 2) == [0, 1, 0, 1]
+
+
+def test_balanced_assignment_more_bins_than_items():
+    assert sorted(balanced_assignment([3, 2, 1], 5)) == [0, 1, 2]
+    with pytest.raises(ValueError):
+        balanced_assignment([1], 0)
@@ -1,17 +1,90 @@
 import os
+import sys
+import json
+import time
+import heapq
+import sqlite3
+import hashlib
+import resource
+import contextlib
+import itertools
+import collections
+import concurrent.futures
 import numpy as np
 from typing import *
 
 T = TypeVar('T')
 
 
-def chain_fold(A: Iterable[T],
-               λ: Callable[[T, T], T],
-               init: T) -> Iterable[T]:
-    if A:
-        step = λ(A[0], init)
-        yield step
-        yield from chain_fold(A[1:], λ, step)
+def batched(A: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Groups an iterable into lists of at most `size` items
+    :param A: Any iterable, consumed lazily
+    :param size: Maximum number of items per batch
+    :return: Iterator over batches
+    """
+    it = iter(A)
+    batch = list(itertools.islice(it, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(it, size))
+
+
+def parallel_map(func: Callable[..., T],
+                 kwargs_list: List[Dict[str, Any]],
+                 jobs: int = 1) -> List[T]:
+    """
+    Calls func once per kwargs dict, in a process pool when jobs > 1
+    :param func: Module level function, so it can be pickled
+    :param kwargs_list: Keyword arguments of each call
+    :param jobs: Number of worker processes, 1 runs everything in this process
+    :return: Results, in the order of kwargs_list
+    """
+    if jobs <= 1 or len(kwargs_list) <= 1:
+        return [func(**kwargs) for kwargs in kwargs_list]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(kwargs_list))) as pool:
+        futures = [pool.submit(func, **kwargs) for kwargs in kwargs_list]
+        return [f.result() for f in futures]
+
+
+def parallel_imap(func: Callable[..., T],
+                  kwargs_list: List[Dict[str, Any]],
+                  jobs: int = 1,
+                  window: int = None) -> Iterator[T]:
+    """
+    Lazy parallel_map: yields results in order while later calls are still running,
+    keeping at most `window` calls submitted but not consumed
+    :param func: Module level function, so it can be pickled
+    :param kwargs_list: Keyword arguments of each call
+    :param jobs: Number of worker processes, 1 runs every call in this process when its result is needed
+    :param window: Maximum number of pending results, defaults to 2 * jobs
+    :return: Iterator over results, in the order of kwargs_list
+    """
+    if jobs <= 1 or len(kwargs_list) <= 1:
+        yield from (func(**kwargs) for kwargs in kwargs_list)
+        return
+    window = window if window else 2 * jobs
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(kwargs_list))) as pool:
+        pending = collections.deque()
+        for kwargs in kwargs_list:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, **kwargs))
+        while pending:
+            yield pending.popleft().result()
+
+
+def file_digest(path: str) -> str:
+    """
+    Hashes a file's content
+    :param path: Full path to file
+    :return: sha1 hex digest
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
 
 def remove_empty(data_dir: str) -> None:
@@ -27,24 +100,230 @@ def remove_empty(data_dir: str) -> None:
 
 
 def random_assignment(*, ratio: List[float],
-                      num_id: int) -> Iterable[int]:
+                      num_id: int = None,
+                      weights: Optional[Sequence[float]] = None) -> List[int]:
+    """
+    Randomly assigns ids to splits, in O(num_id) memory
+    :param ratio: Relative size of each split
+    :param num_id: Number of ids, to split by count
+    :param weights: Size of each id (e.g. seconds of audio) to split by total size instead of count.
+                    Ids are shuffled, laid end to end, and each goes to the split its midpoint falls in
+    :return: Split of each id
+    """
+    bounds = np.cumsum(np.asarray(ratio, dtype=np.float64))
+    bounds /= bounds[-1]
+    if weights is None:
+        position = np.random.rand(num_id)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        order = np.random.permutation(len(weights))
+        ends = np.cumsum(weights[order])
+        if len(weights) and ends[-1] <= 0:
+            raise ValueError("weights must have a positive sum")
+        position = np.empty(len(weights))
+        position[order] = (ends - weights[order] / 2) / (ends[-1] if len(weights) else 1)
+    return np.minimum(np.searchsorted(bounds, position), len(bounds) - 1).tolist()
+
+
+def connected_components(left: np.ndarray,
+                         right: np.ndarray,
+                         num_left: int,
+                         num_right: int) -> np.ndarray:
+    """
+    Finds the connected components of a bipartite graph with a vectorized union-find:
+    every round hooks the larger of two linked roots under the smaller, then compresses
+    all paths by pointer jumping. Edges found inside one component drop out.
+    :param left: Left node of each edge, in [0, num_left)
+    :param right: Right node of each edge, in [0, num_right)
+    :param num_left: Number of left nodes
+    :param num_right: Number of right nodes
+    :return: Root of every node, left nodes first then right nodes. The root is the smallest
+             node of its component, so a component with a left node has a left root
+    """
+    key = np.unique(np.asarray(left, dtype=np.int64) * num_right + np.asarray(right, dtype=np.int64))
+    u, v = key // num_right, key % num_right + num_left
+    parent = np.arange(num_left + num_right)
+    while len(u):
+        pu, pv = parent[u], parent[v]
+        linked = pu != pv
+        u, v, pu, pv = u[linked], v[linked], pu[linked], pv[linked]
+        np.minimum.at(parent, np.maximum(pu, pv), np.minimum(pu, pv))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    return parent
+
+
+def balanced_assignment(weights: Sequence[float], num_bins: int) -> List[int]:
+    """
+    Assigns items to bins of about equal total weight: heaviest first, each to the
+    currently lightest bin (ties go to the bin with fewer items)
+    :param weights: Weight of each item, e.g. its number of utterances
+    :param num_bins: Number of bins
+    :return: Bin of each item
+    """
+    if num_bins < 1:
+        raise ValueError(f"num_bins must be positive, got {num_bins}")
+    weights = np.asarray(weights, dtype=np.float64)
+    bins = [(0.0, 0, b) for b in range(num_bins)]
+    assignment = np.empty(len(weights), dtype=np.int64)
+    for i in np.argsort(-weights, kind='stable').tolist():
+        load, count, b = heapq.heappop(bins)
+        assignment[i] = b
+        heapq.heappush(bins, (load + weights[i], count + 1, b))
+    return assignment.tolist()
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: Peak resident memory of this process or any finished child process so far, in MB
+    """
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+
+class Profiler:
+    """
+    Collects the --profile report of a run: wall time, rows/sec, peak RSS and SQL statements per stage.
+    Statements are counted two ways: 'orm_statements' and 'orm_sql_seconds' come from Pony's own query
+    statistics of the watched databases, 'sql_statements' from a sqlite3 trace callback on the traced
+    connections, which also sees the statements run outside Pony (every row of an executemany counts).
+    Statements of worker processes are not counted. A disabled Profiler only runs the stages.
+    """
+
+    def __init__(self, command: str, output: Union[bool, str] = False):
+        """
+        :param command: Name of the entry point, e.g. 'data2db'
+        :param output: True prints the report as one JSON line, a path appends that line to the file,
+                       False disables profiling
+        """
+        self.command = command
+        self.output = output
+        self.enabled = bool(output)
+        self.stages = []
+        self._dbs = []
+        self._traced = []
+        self._statements = 0
+        self._current = None
+        self._start = time.time()
+
+    def watch(self, *dbs) -> None:
+        """
+        Counts the statements Pony issues through these databases
+        :param dbs: Bound pony Databases
+        :return: None
+        """
+        if self.enabled:
+            self._dbs.extend(db for db in dbs if db not in self._dbs)
+
+    def trace(self, connection):
+        """
+        Counts every statement sqlite executes on a connection
+        :param connection: sqlite3 connection, e.g. db.get_connection() inside a db_session
+        :return: The connection
+        """
+        if self.enabled:
+            connection.set_trace_callback(self._count_statement)
+            self._traced.append(connection)
+        return connection
 
-    num_splits = len(ratio)
-    np_ratio = np.array(ratio)
-    np_ratio /= np.sum(np_ratio)
-    accumulate_rate = np.array(list(chain_fold(ratio, lambda x, y: x + y, 0))).reshape(-1, 1)
+    def _count_statement(self, _: str) -> None:
+        self._statements += 1
 
-    rand_res = np.random.rand(num_id)
-    rand_res = rand_res.reshape([1, -1])
+    def _orm_stats(self) -> Tuple[int, float]:
+        stats = [db.local_stats.get(None) for db in self._dbs]
+        return (sum(s.db_count for s in stats if s is not None),
+                sum((s.sum_time or 0.0 for s in stats if s is not None), 0.0))
 
-    acc_rate = np.repeat(accumulate_rate, num_id, 1)  # [num_splits, num_id]
-    rand_res = np.repeat(rand_res, num_splits, 0)  # [num_splits, num_id]
-    mask = np.where(rand_res <= acc_rate, 1.0, 0.0)  # [num_splits, num_id]
+    @contextlib.contextmanager
+    def stage(self, name: str, **fields) -> Iterator[Dict[str, Any]]:
+        """
+        Measures a stage. Stages do not nest.
+        :param name: Stage name
+        :param fields: Extra fields of the stage record
+        :return: The stage record; set record['rows'] to get rows_per_sec
+        """
+        record = dict(stage=name, **fields)
+        if not self.enabled:
+            yield record
+            return
+        self._current = record
+        statements = self._statements
+        orm_statements, orm_seconds = self._orm_stats()
+        start = time.time()
+        try:
+            yield record
+        finally:
+            seconds = time.time() - start
+            orm_statements_after, orm_seconds_after = self._orm_stats()
+            record['seconds'] = round(seconds, 4)
+            if 'rows' in record:
+                record['rows_per_sec'] = round(record['rows'] / max(seconds, 1e-9), 1)
+            record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+            record['sql_statements'] = self._statements - statements
+            record['orm_statements'] = orm_statements_after - orm_statements
+            record['orm_sql_seconds'] = round(orm_seconds_after - orm_seconds, 4)
+            self._current = None
+            self.stages.append(record)
 
-    category = np.arange(num_splits, 0, -1).reshape(-1, 1)
-    category = np.repeat(category, num_id, 1)
+    def add(self, key: str, value: float) -> None:
+        """
+        Adds to a field of the running stage
+        :param key: Field name
+        :param value: Amount to add
+        :return: None
+        """
+        if self._current is not None:
+            self._current[key] = self._current.get(key, 0) + value
 
-    assignments = np.argmax(mask * category, 0)  # [num_id]
-    assignments = assignments.tolist()
+    def timed(self, iterable: Iterable[T], key: str) -> Iterator[T]:
+        """
+        Adds the time spent producing each item to `key` of the stage running at that moment,
+        e.g. parsing that happens lazily while a stage consumes the rows
+        :param iterable: Any iterable
+        :param key: Field name
+        :return: The items of iterable
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add(key, time.time() - start)
+            yield item
 
-    return assignments
\ No newline at end of file
+    def report(self) -> Optional[Dict[str, Any]]:
+        """
+        Writes the report to the output given at construction
+        :return: The report, None when disabled
+        """
+        if not self.enabled:
+            return None
+        # Connections of setup_db.bind_db outlive the run
+        for connection in self._traced:
+            with contextlib.suppress(sqlite3.ProgrammingError):
+                connection.set_trace_callback(None)
+        for record in self.stages:
+            for key, value in record.items():
+                if key.endswith('_seconds') and isinstance(value, float):
+                    record[key] = round(value, 4)
+        report = {'command': self.command,
+                  'seconds': round(time.time() - self._start, 4),
+                  'peak_rss_mb': round(peak_rss_mb(), 1),
+                  'stages': self.stages}
+        line = json.dumps(report)
+        if self.output is True:
+            print(line)
+        else:
+            with open(self.output, 'a') as fp:
+                fp.write(line + '\n')
+        return report